@@ -0,0 +1,94 @@
+/*!
+**************************************************************************************************
+* Python bindings of the 3D multi-scale deformable attention, dispatching on the
+* device of the value tensor. The CUDA kernels are only built with WITH_CUDA.
+**************************************************************************************************
+*/
+
+#include <torch/extension.h>
+
+at::Tensor ms_deform_attn_cpu_forward(const at::Tensor &value,
+                                      const at::Tensor &spatial_shapes,
+                                      const at::Tensor &level_start_index,
+                                      const at::Tensor &sampling_loc,
+                                      const at::Tensor &attn_weight,
+                                      const int im2col_step);
+
+void ms_deform_attn_cpu_backward(
+    const at::Tensor &value, const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index, const at::Tensor &sampling_loc,
+    const at::Tensor &attn_weight, const at::Tensor &grad_output,
+    at::Tensor &grad_value, at::Tensor &grad_sampling_loc,
+    at::Tensor &grad_attn_weight, const int im2col_step);
+
+#ifdef WITH_CUDA
+at::Tensor ms_deform_attn_cuda_forward(const at::Tensor &value,
+                                       const at::Tensor &spatial_shapes,
+                                       const at::Tensor &level_start_index,
+                                       const at::Tensor &sampling_loc,
+                                       const at::Tensor &attn_weight,
+                                       const int im2col_step);
+
+void ms_deform_attn_cuda_backward(
+    const at::Tensor &value, const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index, const at::Tensor &sampling_loc,
+    const at::Tensor &attn_weight, const at::Tensor &grad_output,
+    at::Tensor &grad_value, at::Tensor &grad_sampling_loc,
+    at::Tensor &grad_attn_weight, const int im2col_step);
+#endif
+
+at::Tensor ms_deform_attn_forward(const at::Tensor &value,
+                                  const at::Tensor &spatial_shapes,
+                                  const at::Tensor &level_start_index,
+                                  const at::Tensor &sampling_loc,
+                                  const at::Tensor &attn_weight,
+                                  const int im2col_step) {
+  if (value.is_cuda()) {
+#ifdef WITH_CUDA
+    return ms_deform_attn_cuda_forward(value, spatial_shapes, level_start_index,
+                                       sampling_loc, attn_weight, im2col_step);
+#else
+    AT_ERROR("deform3dattn_custom_cn is not compiled with GPU support");
+#endif
+  }
+  return ms_deform_attn_cpu_forward(value, spatial_shapes, level_start_index,
+                                    sampling_loc, attn_weight, im2col_step);
+}
+
+void ms_deform_attn_backward(
+    const at::Tensor &value, const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index, const at::Tensor &sampling_loc,
+    const at::Tensor &attn_weight, const at::Tensor &grad_output,
+    at::Tensor &grad_value, at::Tensor &grad_sampling_loc,
+    at::Tensor &grad_attn_weight, const int im2col_step) {
+  if (value.is_cuda()) {
+#ifdef WITH_CUDA
+    ms_deform_attn_cuda_backward(value, spatial_shapes, level_start_index,
+                                 sampling_loc, attn_weight, grad_output,
+                                 grad_value, grad_sampling_loc,
+                                 grad_attn_weight, im2col_step);
+    return;
+#else
+    AT_ERROR("deform3dattn_custom_cn is not compiled with GPU support");
+#endif
+  }
+  ms_deform_attn_cpu_backward(value, spatial_shapes, level_start_index,
+                              sampling_loc, attn_weight, grad_output,
+                              grad_value, grad_sampling_loc, grad_attn_weight,
+                              im2col_step);
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("ms_deform_attn_forward", &ms_deform_attn_forward,
+        "forward function of multi-scale deformable attention",
+        py::arg("value"), py::arg("value_spatial_shapes"),
+        py::arg("value_level_start_index"), py::arg("sampling_locations"),
+        py::arg("attention_weights"), py::arg("im2col_step"));
+  m.def("ms_deform_attn_backward", &ms_deform_attn_backward,
+        "backward function of multi-scale deformable attention",
+        py::arg("value"), py::arg("value_spatial_shapes"),
+        py::arg("value_level_start_index"), py::arg("sampling_locations"),
+        py::arg("attention_weights"), py::arg("grad_output"),
+        py::arg("grad_value"), py::arg("grad_sampling_loc"),
+        py::arg("grad_attn_weight"), py::arg("im2col_step"));
+}
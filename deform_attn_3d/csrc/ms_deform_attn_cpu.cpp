@@ -0,0 +1,263 @@
+/*!
+**************************************************************************************************
+* CPU implementation of the 3D multi-scale deformable attention.
+*
+* Same layouts as ms_deform_attn_cuda.cu:
+*   value              (bs, num_keys, num_heads, channels), the keys of a level
+*                      being ordered as (h, w, z)
+*   spatial_shapes     (num_levels, 3), (h, w, z) of each level
+*   sampling_loc       (bs, num_query, num_heads, num_levels, num_point, 3), (w, h, z) in [0, 1]
+*   attn_weight        (bs, num_query, num_heads, num_levels, num_point)
+*   output             (bs, num_query, num_heads * channels)
+*
+* The forward pass is threaded over (batch, query, head). The backward pass is
+* threaded over (batch, head): a thread owns the gradient of the values of its
+* head, so the accumulation needs no atomics.
+**************************************************************************************************
+*/
+
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include <cmath>
+
+namespace {
+
+// Trilinear sampling of one point: offsets of the 8 corners in the value
+// tensor (-1 outside the volume) and their interpolation weights.
+template <typename scalar_t>
+struct TrilinearCorners {
+  int64_t offset[8];
+  scalar_t weight[8];
+  // derivatives of the weights with respect to h, w and z
+  scalar_t grad_h[8], grad_w[8], grad_z[8];
+};
+
+template <typename scalar_t>
+inline bool trilinear_corners(const scalar_t h, const scalar_t w, const scalar_t z,
+                              const int height, const int width, const int depth,
+                              const int64_t key_stride,
+                              TrilinearCorners<scalar_t> &corners) {
+  if (!(h > -1 && w > -1 && z > -1 && h < height && w < width && z < depth)) {
+    return false;
+  }
+  const int h_low = std::floor(h);
+  const int w_low = std::floor(w);
+  const int z_low = std::floor(z);
+  const scalar_t lh = h - h_low, lw = w - w_low, lz = z - z_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw, hz = 1 - lz;
+
+  for (int k = 0; k < 8; ++k) {
+    const int dh = (k >> 2) & 1, dw = (k >> 1) & 1, dz = k & 1;
+    const int h_k = h_low + dh, w_k = w_low + dw, z_k = z_low + dz;
+    const scalar_t fh = dh ? lh : hh, fw = dw ? lw : hw, fz = dz ? lz : hz;
+    corners.weight[k] = fh * fw * fz;
+    corners.grad_h[k] = (dh ? 1 : -1) * fw * fz;
+    corners.grad_w[k] = (dw ? 1 : -1) * fh * fz;
+    corners.grad_z[k] = (dz ? 1 : -1) * fh * fw;
+    if (h_k >= 0 && h_k < height && w_k >= 0 && w_k < width && z_k >= 0 && z_k < depth) {
+      corners.offset[k] = ((int64_t)(h_k * width + w_k) * depth + z_k) * key_stride;
+    } else {
+      corners.offset[k] = -1;
+    }
+  }
+  return true;
+}
+
+template <typename scalar_t>
+void ms_deformable_im2col_cpu(const scalar_t *data_value,
+                              const int64_t *data_spatial_shapes,
+                              const int64_t *data_level_start_index,
+                              const scalar_t *data_sampling_loc,
+                              const scalar_t *data_attn_weight,
+                              const int batch_size, const int spatial_size,
+                              const int num_heads, const int channels,
+                              const int num_levels, const int num_query,
+                              const int num_point, scalar_t *data_col) {
+  const int64_t key_stride = (int64_t)num_heads * channels;
+  const int64_t num_kernels = (int64_t)batch_size * num_query * num_heads;
+
+  at::parallel_for(0, num_kernels, 16, [&](int64_t begin, int64_t end) {
+    TrilinearCorners<scalar_t> corners;
+    for (int64_t index = begin; index < end; ++index) {
+      const int m = index % num_heads;
+      const int b = index / num_heads / num_query;
+      scalar_t *col = data_col + index * channels;
+      for (int c = 0; c < channels; ++c) {
+        col[c] = 0;
+      }
+
+      int64_t weight_ptr = index * num_levels * num_point;
+      for (int l = 0; l < num_levels; ++l) {
+        const int spatial_h = data_spatial_shapes[l * 3];
+        const int spatial_w = data_spatial_shapes[l * 3 + 1];
+        const int spatial_z = data_spatial_shapes[l * 3 + 2];
+        const scalar_t *value = data_value +
+            ((int64_t)b * spatial_size + data_level_start_index[l]) * key_stride +
+            (int64_t)m * channels;
+        for (int p = 0; p < num_point; ++p, ++weight_ptr) {
+          const scalar_t *loc = data_sampling_loc + weight_ptr * 3;
+          const scalar_t attn = data_attn_weight[weight_ptr];
+          if (!trilinear_corners<scalar_t>(loc[1] * spatial_h - 0.5, loc[0] * spatial_w - 0.5,
+                                           loc[2] * spatial_z - 0.5, spatial_h, spatial_w,
+                                           spatial_z, key_stride, corners)) {
+            continue;
+          }
+          for (int k = 0; k < 8; ++k) {
+            if (corners.offset[k] < 0) continue;
+            const scalar_t weight = corners.weight[k] * attn;
+            const scalar_t *value_k = value + corners.offset[k];
+            for (int c = 0; c < channels; ++c) {
+              col[c] += weight * value_k[c];
+            }
+          }
+        }
+      }
+    }
+  });
+}
+
+template <typename scalar_t>
+void ms_deformable_col2im_cpu(const scalar_t *grad_col, const scalar_t *data_value,
+                              const int64_t *data_spatial_shapes,
+                              const int64_t *data_level_start_index,
+                              const scalar_t *data_sampling_loc,
+                              const scalar_t *data_attn_weight,
+                              const int batch_size, const int spatial_size,
+                              const int num_heads, const int channels,
+                              const int num_levels, const int num_query,
+                              const int num_point, scalar_t *grad_value,
+                              scalar_t *grad_sampling_loc,
+                              scalar_t *grad_attn_weight) {
+  const int64_t key_stride = (int64_t)num_heads * channels;
+
+  at::parallel_for(0, (int64_t)batch_size * num_heads, 1, [&](int64_t begin, int64_t end) {
+    TrilinearCorners<scalar_t> corners;
+    for (int64_t bm = begin; bm < end; ++bm) {
+      const int b = bm / num_heads;
+      const int m = bm % num_heads;
+      for (int q = 0; q < num_query; ++q) {
+        const int64_t index = ((int64_t)b * num_query + q) * num_heads + m;
+        const scalar_t *top_grad = grad_col + index * channels;
+
+        int64_t weight_ptr = index * num_levels * num_point;
+        for (int l = 0; l < num_levels; ++l) {
+          const int spatial_h = data_spatial_shapes[l * 3];
+          const int spatial_w = data_spatial_shapes[l * 3 + 1];
+          const int spatial_z = data_spatial_shapes[l * 3 + 2];
+          const int64_t value_offset =
+              ((int64_t)b * spatial_size + data_level_start_index[l]) * key_stride +
+              (int64_t)m * channels;
+          const scalar_t *value = data_value + value_offset;
+          scalar_t *grad_value_l = grad_value + value_offset;
+          for (int p = 0; p < num_point; ++p, ++weight_ptr) {
+            const scalar_t *loc = data_sampling_loc + weight_ptr * 3;
+            const scalar_t attn = data_attn_weight[weight_ptr];
+            if (!trilinear_corners<scalar_t>(loc[1] * spatial_h - 0.5, loc[0] * spatial_w - 0.5,
+                                             loc[2] * spatial_z - 0.5, spatial_h, spatial_w,
+                                             spatial_z, key_stride, corners)) {
+              continue;
+            }
+            scalar_t val = 0, grad_h = 0, grad_w = 0, grad_z = 0;
+            for (int k = 0; k < 8; ++k) {
+              if (corners.offset[k] < 0) continue;
+              const scalar_t *value_k = value + corners.offset[k];
+              scalar_t *grad_value_k = grad_value_l + corners.offset[k];
+              const scalar_t weight = corners.weight[k] * attn;
+              // dot product of the corner value with the output gradient
+              scalar_t dot = 0;
+              for (int c = 0; c < channels; ++c) {
+                dot += value_k[c] * top_grad[c];
+                grad_value_k[c] += weight * top_grad[c];
+              }
+              val += corners.weight[k] * dot;
+              grad_h += corners.grad_h[k] * dot;
+              grad_w += corners.grad_w[k] * dot;
+              grad_z += corners.grad_z[k] * dot;
+            }
+            grad_attn_weight[weight_ptr] = val;
+            grad_sampling_loc[weight_ptr * 3] = spatial_w * grad_w * attn;
+            grad_sampling_loc[weight_ptr * 3 + 1] = spatial_h * grad_h * attn;
+            grad_sampling_loc[weight_ptr * 3 + 2] = spatial_z * grad_z * attn;
+          }
+        }
+      }
+    }
+  });
+}
+
+void check_inputs(const at::Tensor &value, const at::Tensor &spatial_shapes,
+                  const at::Tensor &level_start_index, const at::Tensor &sampling_loc,
+                  const at::Tensor &attn_weight) {
+  AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+  AT_ASSERTM(spatial_shapes.is_contiguous(),
+             "spatial_shapes tensor has to be contiguous");
+  AT_ASSERTM(level_start_index.is_contiguous(),
+             "level_start_index tensor has to be contiguous");
+  AT_ASSERTM(sampling_loc.is_contiguous(),
+             "sampling_loc tensor has to be contiguous");
+  AT_ASSERTM(attn_weight.is_contiguous(),
+             "attn_weight tensor has to be contiguous");
+  AT_ASSERTM(spatial_shapes.size(1) == 3, "spatial_shapes must give (h, w, z) per level");
+  AT_ASSERTM(sampling_loc.size(5) == 3, "sampling_loc must give (w, h, z) per point");
+}
+
+}  // namespace
+
+at::Tensor ms_deform_attn_cpu_forward(const at::Tensor &value,
+                                      const at::Tensor &spatial_shapes,
+                                      const at::Tensor &level_start_index,
+                                      const at::Tensor &sampling_loc,
+                                      const at::Tensor &attn_weight,
+                                      const int im2col_step) {
+  check_inputs(value, spatial_shapes, level_start_index, sampling_loc, attn_weight);
+
+  const int batch = value.size(0);
+  const int spatial_size = value.size(1);
+  const int num_heads = value.size(2);
+  const int channels = value.size(3);
+  const int num_levels = spatial_shapes.size(0);
+  const int num_query = sampling_loc.size(1);
+  const int num_point = sampling_loc.size(4);
+
+  auto output = at::empty({batch, num_query, num_heads, channels}, value.options());
+
+  AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_forward_cpu", ([&] {
+    ms_deformable_im2col_cpu(
+        value.data_ptr<scalar_t>(), spatial_shapes.data_ptr<int64_t>(),
+        level_start_index.data_ptr<int64_t>(), sampling_loc.data_ptr<scalar_t>(),
+        attn_weight.data_ptr<scalar_t>(), batch, spatial_size, num_heads, channels,
+        num_levels, num_query, num_point, output.data_ptr<scalar_t>());
+  }));
+
+  return output.view({batch, num_query, num_heads * channels});
+}
+
+void ms_deform_attn_cpu_backward(
+    const at::Tensor &value, const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index, const at::Tensor &sampling_loc,
+    const at::Tensor &attn_weight, const at::Tensor &grad_output,
+    at::Tensor &grad_value, at::Tensor &grad_sampling_loc,
+    at::Tensor &grad_attn_weight, const int im2col_step) {
+  check_inputs(value, spatial_shapes, level_start_index, sampling_loc, attn_weight);
+  AT_ASSERTM(grad_output.is_contiguous(),
+             "grad_output tensor has to be contiguous");
+
+  const int batch = value.size(0);
+  const int spatial_size = value.size(1);
+  const int num_heads = value.size(2);
+  const int channels = value.size(3);
+  const int num_levels = spatial_shapes.size(0);
+  const int num_query = sampling_loc.size(1);
+  const int num_point = sampling_loc.size(4);
+
+  AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_backward_cpu", ([&] {
+    ms_deformable_col2im_cpu(
+        grad_output.data_ptr<scalar_t>(), value.data_ptr<scalar_t>(),
+        spatial_shapes.data_ptr<int64_t>(), level_start_index.data_ptr<int64_t>(),
+        sampling_loc.data_ptr<scalar_t>(), attn_weight.data_ptr<scalar_t>(), batch,
+        spatial_size, num_heads, channels, num_levels, num_query, num_point,
+        grad_value.data_ptr<scalar_t>(), grad_sampling_loc.data_ptr<scalar_t>(),
+        grad_attn_weight.data_ptr<scalar_t>());
+  }));
+}
@@ -363,20 +363,3 @@ void ms_deform_attn_cuda_backward(
         }));
   }
 }
-
-
-PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-  m.def("ms_deform_attn_forward", &ms_deform_attn_cuda_forward,
-        "forward function of multi-scale deformable attention",
-        py::arg("value"), py::arg("value_spatial_shapes"),
-        py::arg("value_level_start_index"), py::arg("sampling_locations"),
-        py::arg("attention_weights"), py::arg("im2col_step"));
-  m.def("ms_deform_attn_backward", &ms_deform_attn_cuda_backward,
-        "backward function of multi-scale deformable attention",
-        py::arg("value"), py::arg("value_spatial_shapes"),
-        py::arg("value_level_start_index"), py::arg("sampling_locations"),
-        py::arg("attention_weights"), py::arg("grad_output"),
-        py::arg("grad_value"), py::arg("grad_sampling_loc"),
-        py::arg("grad_attn_weight"), py::arg("im2col_step"));
-
-}
@@ -23,19 +23,25 @@ def get_extensions():
         print(f'Compiling {ext_name} with CUDA')
         define_macros += [('WITH_CUDA', None)]
         # op_files = glob.glob('./csrc/*')
-        op_files = glob.glob('./csrc/*.cu')
+        # the CPU kernels and the bindings are built along the CUDA ones
+        op_files = glob.glob('./csrc/*.cu') + glob.glob('./csrc/*.cpp')
         extension = CUDAExtension 
     else:
         print(f'Compiling {ext_name} without CUDA')
         op_files = glob.glob('./csrc/*.cpp')
         extension = CppExtension
 
+    # at::parallel_for of the CPU kernels is threaded with OpenMP
+    extra_compile_args = {'cxx': ['-O3', '-fopenmp'], 'nvcc': []}
+
     include_path = os.path.abspath('./csrc')
     ext_ops = extension( 
         name=ext_name,
         sources=op_files,
         include_dirs=[include_path],
-        define_macros=define_macros)
+        define_macros=define_macros,
+        extra_compile_args=extra_compile_args,
+        extra_link_args=['-fopenmp'])
     extensions.append(ext_ops)
     return extensions 
 
@@ -9,17 +9,7 @@ import imageio
 
 def unpack(compressed):
   ''' given a bit encoded voxel grid, make a normal voxel grid out of it.  '''
-  uncompressed = np.zeros(compressed.shape[0] * 8, dtype=np.uint8)
-  uncompressed[::8] = compressed[:] >> 7 & 1
-  uncompressed[1::8] = compressed[:] >> 6 & 1
-  uncompressed[2::8] = compressed[:] >> 5 & 1
-  uncompressed[3::8] = compressed[:] >> 4 & 1
-  uncompressed[4::8] = compressed[:] >> 3 & 1
-  uncompressed[5::8] = compressed[:] >> 2 & 1
-  uncompressed[6::8] = compressed[:] >> 1 & 1
-  uncompressed[7::8] = compressed[:] & 1
-
-  return uncompressed
+  return np.unpackbits(compressed.astype(np.uint8, copy=False))
 
 
 def img_normalize(img, mean, std):
@@ -32,14 +22,7 @@ def img_normalize(img, mean, std):
 
 def pack(array):
   """ convert a boolean array into a bitwise array. """
-  array = array.reshape((-1))
-
-  #compressing bit flags.
-  # yapf: disable
-  compressed = array[::8] << 7 | array[1::8] << 6  | array[2::8] << 5 | array[3::8] << 4 | array[4::8] << 3 | array[5::8] << 2 | array[6::8] << 1 | array[7::8]
-  # yapf: enable
-
-  return np.array(compressed, dtype=np.uint8)
+  return np.packbits(array.reshape((-1)))
 
 
 def get_grid_coords(dims, resolution):
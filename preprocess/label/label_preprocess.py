@@ -6,13 +6,59 @@ from tqdm import tqdm
 import numpy.matlib
 import os
 import glob
+from multiprocessing import Pool, cpu_count
 import io_data as SemanticKittiIO
 import argparse
 import yaml
 
+def _blocks(grid, k_size):
+    """View a grid as its non-overlapping k_size^3 blocks.
+
+    Shape:
+        grid, (X, Y, Z), cropped to multiples of k_size
+        blocks, (X // k_size, Y // k_size, Z // k_size, k_size ** 3)
+    """
+    X, Y, Z = (s // k_size for s in grid.shape[:3])
+    grid = grid[: X * k_size, : Y * k_size, : Z * k_size]
+    blocks = grid.reshape(X, k_size, Y, k_size, Z, k_size).transpose(0, 2, 4, 1, 3, 5)
+    return blocks.reshape(X, Y, Z, k_size ** 3).astype(np.int64)
+
+
+def _block_statistics(blocks):
+    """Count the empty (0) and unknown (255) voxels of every block and find the
+    most frequent semantic label (0 < label < 255) in it.
+
+    Ties go to the smallest label, as np.argmax(np.bincount(...)) and
+    np.unique(...) + np.argmax(counts) do. Labels are expected in [0, 255].
+
+    Returns:
+        tuple: counts of 0, counts of 255, majority label (0 when the block
+            has no semantic label) and whether the block has one.
+    """
+    shape = blocks.shape[:-1]
+    blocks = blocks.reshape(-1, blocks.shape[-1])
+    count_0 = (blocks == 0).sum(-1)
+    count_255 = (blocks == 255).sum(-1)
+    valid = (blocks > 0) & (blocks < 255)
+    values = np.where(valid, blocks, 0)
+    num_bins = int(values.max()) + 1
+    # one bincount over all blocks, every block owning num_bins bins
+    offsets = np.arange(blocks.shape[0])[:, None] * num_bins
+    counts = np.bincount((values + offsets).ravel(), minlength=blocks.shape[0] * num_bins)
+    counts = counts.reshape(-1, num_bins)
+    counts[:, 0] = 0
+    majority = counts.argmax(-1)
+    return (
+        count_0.reshape(shape),
+        count_255.reshape(shape),
+        majority.reshape(shape),
+        valid.any(-1).reshape(shape),
+    )
+
+
 def _downsample_label(label, voxel_size=(240, 144, 240), downscale=4):
     r"""downsample the labeled data,
-    code taken from https://github.com/waterljwant/SSC/blob/master/dataloaders/dataloader.py#L262
+    vectorized version of https://github.com/waterljwant/SSC/blob/master/dataloaders/dataloader.py#L262
     Shape:
         label, (240, 144, 240)
         label_downscale, if downsample==4, then (60, 36, 60)
@@ -20,6 +66,28 @@ def _downsample_label(label, voxel_size=(240, 144, 240), downscale=4):
     if downscale == 1:
         return label
     ds = downscale
+    label = np.asarray(label)[: voxel_size[0], : voxel_size[1], : voxel_size[2]]
+    empty_t = 0.95 * ds * ds * ds  # threshold
+    count_0, count_255, majority, _ = _block_statistics(_blocks(label, ds))
+    empty = (count_0 + count_255) > empty_t
+    label_downscale = np.where(
+        empty, np.where(count_0 > count_255, 0, 255), majority
+    )
+    return label_downscale.astype(np.uint8)
+
+
+def majority_pooling(grid, k_size=2):
+    count_0, _, majority, has_label = _block_statistics(_blocks(grid, k_size))
+    # semantic labels first, then empty, unknown only when nothing else is seen
+    result = np.where(has_label, majority, np.where(count_0 > 0, 0, 255))
+    return result.astype(np.float64)
+
+
+def _downsample_label_loop(label, voxel_size=(240, 144, 240), downscale=4):
+    """Per-voxel reference of _downsample_label, used by --check."""
+    if downscale == 1:
+        return label
+    ds = downscale
     small_size = (
         voxel_size[0] // ds,
         voxel_size[1] // ds,
@@ -54,7 +122,8 @@ def _downsample_label(label, voxel_size=(240, 144, 240), downscale=4):
     return label_downscale
 
 
-def majority_pooling(grid, k_size=2):
+def _majority_pooling_loop(grid, k_size=2):
+    """Per-voxel reference of majority_pooling, used by --check."""
     result = np.zeros(
         (grid.shape[0] // k_size, grid.shape[1] // k_size, grid.shape[2] // k_size)
     )
@@ -81,17 +150,78 @@ def majority_pooling(grid, k_size=2):
     return result
 
 
+SCENE_SIZE = (256, 256, 32)
+DOWNSCALING = {"1_1": 1, "1_2": 2}
+
+
+def _read_label(label_path, invalid_path, remap_lut):
+    LABEL = SemanticKittiIO._read_label_SemKITTI(label_path)
+    INVALID = SemanticKittiIO._read_invalid_SemKITTI(invalid_path)
+    LABEL = remap_lut[LABEL.astype(np.uint16)].astype(
+        np.float32
+    )  # Remap 20 classes semanticKITTI SSC
+    LABEL[
+        np.isclose(INVALID, 1)
+    ] = 255  # Setting to unknown all voxels marked on invalid mask...
+    return LABEL.reshape(SCENE_SIZE).astype(np.uint8)  # classes 0-19 and 255
+
+
+def _process_frame(task):
+    """Write the missing scales of one frame, run in the worker processes."""
+    label_path, invalid_path, out_dir, remap_lut = task
+    frame_id = os.path.splitext(os.path.basename(label_path))[0]
+    LABEL = _read_label(label_path, invalid_path, remap_lut)
+    for scale, downscale in DOWNSCALING.items():
+        label_filename = os.path.join(out_dir, frame_id + "_" + scale + ".npy")
+        if not os.path.exists(label_filename):
+            np.save(label_filename, _downsample_label(LABEL, SCENE_SIZE, downscale))
+    return frame_id
+
+
+def _outputs_exist(label_path, out_dir):
+    frame_id = os.path.splitext(os.path.basename(label_path))[0]
+    return all(
+        os.path.exists(os.path.join(out_dir, frame_id + "_" + scale + ".npy"))
+        for scale in DOWNSCALING
+    )
+
+
+def pack_sequence(out_dir):
+    """Pack the labels of a sequence into ``<out_dir>.npz``, uint8 and deflate
+    compressed with one member per frame and scale, as read by
+    SemanticKittiLabels. Labels written as float32 are converted."""
+    labels = {}
+    for filename in sorted(os.listdir(out_dir)):
+        key, extension = os.path.splitext(filename)
+        if extension == ".npy" and key.split("_", 1)[-1] in DOWNSCALING:
+            labels[key] = np.load(os.path.join(out_dir, filename)).astype(np.uint8)
+    with open(out_dir + ".npz.tmp", "wb") as f:
+        np.savez_compressed(f, **labels)
+    os.replace(out_dir + ".npz.tmp", out_dir + ".npz")
+
+
+def check(label_paths, invalid_paths, remap_lut, num_frames):
+    """Compare the vectorized downsampling with the per-voxel loops."""
+    for label_path, invalid_path in list(zip(label_paths, invalid_paths))[:num_frames]:
+        LABEL = _read_label(label_path, invalid_path, remap_lut)
+        for downscale in DOWNSCALING.values():
+            assert np.array_equal(
+                _downsample_label(LABEL, SCENE_SIZE, downscale),
+                _downsample_label_loop(LABEL, SCENE_SIZE, downscale),
+            ), label_path
+        assert np.array_equal(majority_pooling(LABEL), _majority_pooling_loop(LABEL)), label_path
+        print("identical outputs for", label_path)
+
 
 def main(config):
-    scene_size = (256, 256, 32)
-    sequences = ["00", "01", "02", "03", "04", "05", "06", "07", "08", "09", "10"]
     remap_lut = SemanticKittiIO._get_remap_lut(
         os.path.join(
             "./label/semantic-kitti.yaml",
         )
     )
 
-    for sequence in sequences:
+    pool = Pool(config.num_workers) if config.num_workers > 0 else None
+    for sequence in config.sequences:
         sequence_path = os.path.join(
             config.kitti_root, "dataset", "sequences", sequence
         )
@@ -101,38 +231,36 @@ def main(config):
         invalid_paths = sorted(
             glob.glob(os.path.join(sequence_path, "voxels", "*.invalid"))
         )
+        if config.check > 0:
+            check(label_paths, invalid_paths, remap_lut, config.check)
+            continue
+
         out_dir = os.path.join(config.kitti_preprocess_root, "labels", sequence)
         os.makedirs(out_dir, exist_ok=True)
 
-        downscaling = {"1_1": 1, "1_2": 2}
-
-        for i in tqdm(range(len(label_paths))):
-
-            frame_id, extension = os.path.splitext(os.path.basename(label_paths[i]))
-
-            LABEL = SemanticKittiIO._read_label_SemKITTI(label_paths[i])
-            INVALID = SemanticKittiIO._read_invalid_SemKITTI(invalid_paths[i])
-            LABEL = remap_lut[LABEL.astype(np.uint16)].astype(
-                np.float32
-            )  # Remap 20 classes semanticKITTI SSC
-            LABEL[
-                np.isclose(INVALID, 1)
-            ] = 255  # Setting to unknown all voxels marked on invalid mask...
-            LABEL = LABEL.reshape([256, 256, 32])
-
-            for scale in downscaling:
-                filename = frame_id + "_" + scale + ".npy"
-                label_filename = os.path.join(out_dir, filename)
-                # If files have not been created...
-                if not os.path.exists(label_filename):
-                    if scale != "1_1":
-                        LABEL_ds = _downsample_label(
-                            LABEL, (256, 256, 32), downscaling[scale]
-                        )
-                    else:
-                        LABEL_ds = LABEL
-                    np.save(label_filename, LABEL_ds)
-                    print("wrote to", label_filename)
+        # If files have not been created...
+        tasks = [
+            (label_path, invalid_path, out_dir, remap_lut)
+            for label_path, invalid_path in zip(label_paths, invalid_paths)
+            if not _outputs_exist(label_path, out_dir)
+        ]
+        progress = tqdm(
+            total=len(label_paths),
+            initial=len(label_paths) - len(tasks),
+            desc="sequence " + sequence,
+        )
+        frames = map(_process_frame, tasks) if pool is None else \
+            pool.imap_unordered(_process_frame, tasks, chunksize=4)
+        for _ in frames:
+            progress.update()
+        progress.close()
+
+        if config.pack:
+            pack_sequence(out_dir)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
@@ -152,5 +280,32 @@ if __name__ == "__main__":
         required=True,
         help='kitti_preprocess_root',
     )
+    parser.add_argument(
+        '--num_workers',
+        '-j',
+        type=int,
+        default=cpu_count(),
+        help='number of worker processes, 0 to run in the main process',
+    )
+
+    parser.add_argument(
+        '--sequences',
+        nargs='+',
+        default=["00", "01", "02", "03", "04", "05", "06", "07", "08", "09", "10"],
+        help='sequences to preprocess',
+    )
+
+    parser.add_argument(
+        '--check',
+        type=int,
+        default=0,
+        help='compare the vectorized downsampling with the per-voxel loops '
+        'on the first N frames of every sequence instead of writing labels',
+    )
+    parser.add_argument(
+        '--pack',
+        action='store_true',
+        help='also pack the labels of every sequence into labels/<sequence>.npz',
+    )
     config, unparsed = parser.parse_known_args()
     main(config)
@@ -4,12 +4,15 @@
 #include <pybind11/stl.h>
 
 // C/C++ includes
+#include <algorithm>
 #include <cmath>
 #include <cfloat>
 #include <vector>
 #include <chrono>
 
-// #include <omp.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 namespace py = pybind11;
 
@@ -611,13 +614,131 @@ std::tuple<Eigen::VectorXf, Eigen::VectorXb, Eigen::VectorXb> _compute_logodds_a
     return std::make_tuple(logodds, original_visible_point_mask, sampled_visible_point_mask);
 }
 
+// voxel states of the ray casting, a voxel is occupied if it ends an untruncated ray
+// and free if it is only traversed
+const unsigned char VOXEL_FREE = 1;
+const unsigned char VOXEL_OCCUPIED = 2;
+
+
+/*
+ * @brief casts the rays from an origin to points and marks the voxels they traverse
+ * @param state   : voxel states, OR-ed with VOXEL_FREE and VOXEL_OCCUPIED
+ * @param indices : rows of the points to cast rays to
+ * @param dedup   : cast a single ray per endpoint voxel
+ * @param num_threads : number of OpenMP threads, all available when not positive
+ *
+ * The states are OR-ed atomically, so the rays are split across threads without locks
+ * and the result does not depend on the order of the rays. With lo_occupied > 0 it
+ * matches the serial update of the log-odds, where a voxel once occupied is never
+ * freed and a free voxel becomes occupied when a later ray ends in it.
+ *
+ * With dedup, the rays ending in the same voxel of the grid are replaced by the ray
+ * to the first of their points. The occupied voxels are unchanged, but the free
+ * voxels are those traversed by the kept rays only.
+ */
+void _cast_rays(std::vector<unsigned char> & state,
+                const Eigen::Vector3d & origin,
+                const Eigen::MatrixXf & points,
+                const std::vector<int> & indices,
+                const Eigen::RowVector4f & offset4d,
+                const Eigen::Vector3i & grid_size,
+                const double voxel_size,
+                const bool dedup,
+                const int num_threads)
+{
+    const int vxsize = grid_size[0], vysize = grid_size[1], vzsize = grid_size[2];
+    const int G1 = vxsize;
+    const int G2 = vysize * G1;
+
+    std::vector<int> rays;
+    if (dedup) {
+        std::vector<int> first_ray(state.size(), -1);
+        rays.reserve(indices.size());
+        for (const int & i : indices) {
+            Eigen::Vector3d point = (points.row(i) - offset4d).head(3).cast<double>();
+            const int vx = floor(point[0]/voxel_size);
+            const int vy = floor(point[1]/voxel_size);
+            const int vz = floor(point[2]/0.2f);
+            if (0 <= vz && vz < vzsize && 0 <= vy && vy < vysize && 0 <= vx && vx < vxsize) {
+                int & ray = first_ray[vz * G2 + vy * G1 + vx];
+                if (ray < 0) {
+                    ray = i;
+                    rays.push_back(i);
+                }
+            } else { // rays leaving the grid are truncated, keep them all
+                rays.push_back(i);
+            }
+        }
+    } else {
+        rays = indices;
+    }
+    const int N = rays.size();
+
+#ifdef _OPENMP
+    const int threads = (num_threads > 0) ? num_threads : omp_get_max_threads();
+#else
+    (void) num_threads;
+#endif
+
+    #pragma omp parallel num_threads(threads) if(N > 1024)
+    {
+        // reused by all the rays of a thread
+        std::vector<Eigen::Vector3i> visited_voxels;
+        visited_voxels.reserve(4 * (vxsize + vysize + vzsize));
+
+        #pragma omp for schedule(dynamic, 256)
+        for (int r = 0; r < N; ++ r) {
+            Eigen::Vector3d point = (points.row(rays[r]) - offset4d).head(3).cast<double>();
+            visited_voxels.clear();
+            bool truncated = _voxel_traversal(visited_voxels, origin, point, grid_size, voxel_size);
+            const int M = visited_voxels.size();
+            for (int j = 0; j < M; ++ j) {
+                const int &vx = visited_voxels[j][0], &vy = visited_voxels[j][1], &vz = visited_voxels[j][2];
+                const int vidx = vz * G2 + vy * G1 + vx;
+                // the last voxel of an untrunc ray is occupied, the others are free
+                const unsigned char flag = (j == M-1 && !truncated) ? VOXEL_OCCUPIED : VOXEL_FREE;
+                unsigned char current;
+                #pragma omp atomic read
+                current = state[vidx];
+                if (!(current & flag)) {
+                    #pragma omp atomic update
+                    state[vidx] |= flag;
+                }
+            }
+        }
+    }
+}
+
+
+/*
+ * @brief log-odds of the voxel states, occupied taking precedence over free
+ */
+Eigen::VectorXf _states_to_logodds(const std::vector<unsigned char> & state,
+                                   const double lo_occupied,
+                                   const double lo_free)
+{
+    const int G3 = state.size();
+    Eigen::VectorXf logodds = Eigen::VectorXf::Zero(G3);
+    for (int vidx = 0; vidx < G3; ++ vidx) {
+        if (state[vidx] & VOXEL_OCCUPIED) {
+            logodds[vidx] = lo_occupied;
+        } else if (state[vidx] & VOXEL_FREE) {
+            logodds[vidx] = lo_free;
+        }
+    }
+    return logodds;
+}
+
+
 Eigen::VectorXf _compute_logodds_dp(const Eigen::MatrixXf & original_points,
                                  const Eigen::MatrixXf & sensor_origins,
                                  const Eigen::VectorXf & pc_range,
                                  std::vector<int> original_indices,
                                  const double voxel_size,
                                  const double lo_occupied,
-                                 const double lo_free)
+                                 const double lo_free,
+                                 const bool dedup,
+                                 const int num_threads)
 {
     // py::gil_scoped_acquire acquire;
 
@@ -636,9 +757,7 @@ Eigen::VectorXf _compute_logodds_dp(const Eigen::MatrixXf & original_points,
     const Eigen::Vector3i grid_size(vxsize, vysize, vzsize);
 
     //
-    const int G1 = vxsize;
-    const int G2 = vysize * G1;
-    const int G3 = vzsize * G2;
+    const int G3 = vzsize * vysize * vxsize;
 
     //
     Eigen::RowVector3f offset3d(pxmin, pymin, pzmin);
@@ -648,31 +767,11 @@ Eigen::VectorXf _compute_logodds_dp(const Eigen::MatrixXf & original_points,
 
 
     // COMPUTE VISIBILITY
-    Eigen::VectorXf update = Eigen::VectorXf::Zero(G3);
+    std::vector<unsigned char> state(G3, 0);
     Eigen::Vector3d origin = (sensor_origins.row(0) - offset3d).cast<double>();
+    _cast_rays(state, origin, original_points, original_indices, offset4d, grid_size, voxel_size, dedup, num_threads);
 
-    for (const int & i : original_indices) {
-        Eigen::Vector3d point = (original_points.row(i) - offset4d).head(3).cast<double>();
-        //std::cout<<i<<" "<<point[0]<<" "<<point[1]<<" "<<point[2]<<" "<<std::endl;
-
-        std::vector<Eigen::Vector3i> visited_voxels;
-        bool truncated = _voxel_traversal(visited_voxels, origin, point, grid_size, voxel_size);
-        const int M = visited_voxels.size();
-
-        for (int j = 0; j < M; ++ j) {
-            const int &vx = visited_voxels[j][0], &vy = visited_voxels[j][1], &vz = visited_voxels[j][2];
-            const int vidx = vz * G2 + vy * G1 + vx;
-            if (update[vidx] > 0) { // if the voxel has been marked as occupied, move on
-                continue;
-            } else if (j == M-1 && !truncated) { // if it is the last voxel of an untrunc ray, mark it as occupied
-                update[vidx] = lo_occupied;
-            } else { // otherwise it must be a free voxel
-                update[vidx] = lo_free;
-            }
-        }
-    }
-
-    return update;
+    return _states_to_logodds(state, lo_occupied, lo_free);
 }
 
 
@@ -682,7 +781,9 @@ Eigen::VectorXf _compute_logodds(const Eigen::MatrixXf & original_points,
                                  const Eigen::VectorXf & pc_range,
                                  const double voxel_size,
                                  const double lo_occupied,
-                                 const double lo_free)
+                                 const double lo_free,
+                                 const bool dedup,
+                                 const int num_threads)
 {
     // py::gil_scoped_acquire acquire;
 
@@ -702,9 +803,7 @@ Eigen::VectorXf _compute_logodds(const Eigen::MatrixXf & original_points,
 
     //
     const int T = time_stamps.size() - 1;
-    const int G1 = vxsize;
-    const int G2 = vysize * G1;
-    const int G3 = vzsize * G2;
+    const int G3 = vzsize * vysize * vxsize;
 
     //
     Eigen::RowVector3f offset3d(pxmin, pymin, pzmin);
@@ -730,32 +829,15 @@ Eigen::VectorXf _compute_logodds(const Eigen::MatrixXf & original_points,
         }
     }
 
-    // #pragma omp parallel for num_threads(3)
+    // the rays of each sweep are cast in parallel
+    std::vector<unsigned char> state(G3);
     for (int t = 0; t < T; ++ t) {
         // COMPUTE VISIBILITY
-        Eigen::VectorXf update = Eigen::VectorXf::Zero(G3);
+        std::fill(state.begin(), state.end(), 0);
         Eigen::Vector3d origin = (sensor_origins.row(t) - offset3d).cast<double>();
+        _cast_rays(state, origin, original_points, original_indices[t], offset4d, grid_size, voxel_size, dedup, num_threads);
 
-        for (const int & i : original_indices[t]) {
-            Eigen::Vector3d point = (original_points.row(i) - offset4d).head(3).cast<double>();
-            std::vector<Eigen::Vector3i> visited_voxels;
-            bool truncated = _voxel_traversal(visited_voxels, origin, point, grid_size, voxel_size);
-            const int M = visited_voxels.size();
-            for (int j = 0; j < M; ++ j) {
-                const int &vx = visited_voxels[j][0], &vy = visited_voxels[j][1], &vz = visited_voxels[j][2];
-                const int vidx = vz * G2 + vy * G1 + vx;
-                if (update[vidx] > 0) { // if the voxel has been marked as occupied, move on
-                    continue;
-                } else if (j == M-1 && !truncated) { // if it is the last voxel of an untrunc ray, mark it as occupied
-                    update[vidx] = lo_occupied;
-                } else { // otherwise it must be a free voxel
-                    update[vidx] = lo_free;
-                }
-            }
-        }
-
-        // #pragma omp critical
-        logodds += update;
+        logodds += _states_to_logodds(state, lo_occupied, lo_free);
     }
 
     return logodds;
@@ -807,7 +889,9 @@ PYBIND11_MODULE(mapping, m) {
           py::arg("pc_range"),
           py::arg("voxel_size"),
           py::arg("lo_occupied")=std::log(0.7/(1-0.7)),
-          py::arg("lo_free")=std::log(0.4/(1-0.4))
+          py::arg("lo_free")=std::log(0.4/(1-0.4)),
+          py::arg("dedup")=false,
+          py::arg("num_threads")=0
           );
 
     m.def("compute_logodds_dp",
@@ -818,6 +902,8 @@ PYBIND11_MODULE(mapping, m) {
           py::arg("indices"),
           py::arg("voxel_size"),
           py::arg("lo_occupied")=std::log(0.7/(1-0.7)),
-          py::arg("lo_free")=std::log(0.4/(1-0.4))
+          py::arg("lo_free")=std::log(0.4/(1-0.4)),
+          py::arg("dedup")=false,
+          py::arg("num_threads")=0
           );
 }
@@ -23,14 +23,7 @@ import mapping
 
 def pack(array):
   """ convert a boolean array into a bitwise array. """
-  array = array.reshape((-1))
-
-  #compressing bit flags.
-  # yapf: disable
-  compressed = array[::8] << 7 | array[1::8] << 6  | array[2::8] << 5 | array[3::8] << 4 | array[4::8] << 3 | array[5::8] << 2 | array[6::8] << 1 | array[7::8]
-  # yapf: enable
-
-  return np.array(compressed, dtype=np.uint8)
+  return np.packbits(array.reshape((-1)))
 
 def parse_calibration(filename):
   """ read calibration file with given filename
@@ -130,7 +123,7 @@ def parallel_work_sequence(f):
     filter_idx = np.where((area_extents[0, 0] < pts[:, 0]) & (pts[:, 0] < area_extents[0, 1]) & (area_extents[1, 0] < pts[:, 1]) & (pts[:, 1] < area_extents[1, 1]) & (area_extents[2, 0] < pts[:, 2]) & (pts[:, 2] < area_extents[2, 1]))[0]
     pts = pts[filter_idx]
       
-    visibility_maps.append(mapping.compute_logodds_dp(pts, origins[[0],:3], pc_range, range(pts.shape[0]), 0.2)) #, lo_occupied, lo_free
+    visibility_maps.append(mapping.compute_logodds_dp(pts, origins[[0],:3], pc_range, range(pts.shape[0]), 0.2, dedup=FLAGS.dedup, num_threads=1)) #, lo_occupied, lo_free
     visibility_maps = np.asarray(visibility_maps)
     visibility_maps = visibility_maps.reshape(-1, map_dims[2], map_dims[0], map_dims[1])
     visibility_maps = np.swapaxes(visibility_maps,2,3)  # annotate when generating mesh for coordinate issues - > car heading y
@@ -199,6 +192,20 @@ if __name__ == '__main__':
       help='length of sequence, i.e., how many scans are concatenated.',
   )
 
+  parser.add_argument(
+      '--num_threads',
+      '-t',
+      type=int,
+      default=0,
+      help='threads casting the rays of a scan, all cores if 0. single sweeps run one thread per process.',
+  )
+
+  parser.add_argument(
+      '--dedup',
+      action='store_true',
+      help='cast one ray per endpoint voxel, same occupied voxels with slightly fewer free ones.',
+  )
+
   
   FLAGS, unparsed = parser.parse_known_args()
   dataset = FLAGS.dataset
@@ -320,7 +327,7 @@ if __name__ == '__main__':
         filter_idx = np.where((area_extents[0, 0] < pts[:, 0]) & (pts[:, 0] < area_extents[0, 1]) & (area_extents[1, 0] < pts[:, 1]) & (pts[:, 1] < area_extents[1, 1]) & (area_extents[2, 0] < pts[:, 2]) & (pts[:, 2] < area_extents[2, 1]))[0]
         pts = pts[filter_idx]
           
-        visibility_maps.append(mapping.compute_logodds_dp(pts, origins[[0],:3], pc_range, range(pts.shape[0]), 0.2)) #, lo_occupied, lo_free
+        visibility_maps.append(mapping.compute_logodds_dp(pts, origins[[0],:3], pc_range, range(pts.shape[0]), 0.2, dedup=FLAGS.dedup, num_threads=FLAGS.num_threads)) #, lo_occupied, lo_free
         visibility_maps = np.asarray(visibility_maps)
         visibility_maps = visibility_maps.reshape(-1, map_dims[2], map_dims[0], map_dims[1])
         visibility_maps = np.swapaxes(visibility_maps,2,3)  # annotate when generating mesh for coordinate issues - > car heading y
@@ -55,6 +55,7 @@ model = dict(
        CE_ssc_loss=True,
        geo_scal_loss=_geo_scal_loss_,
        sem_scal_loss=_sem_scal_loss_,
+       ensemble_proposal=dict(root='./deepensemble_qpn', num_members=5),
        cross_transformer=dict(
            type='PerceptionTransformer',
            rotate_prev_bev=True,
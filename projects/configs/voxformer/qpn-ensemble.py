@@ -0,0 +1,18 @@
+_base_ = [
+    './qpn.py'
+]
+
+# test only: the members are trained one by one with qpn.py, then fused here
+# the five QPN members fused into one network, tested in a single pass:
+# ./tools/dist_test.sh ./projects/configs/voxformer/qpn-ensemble.py '' 4
+model = dict(
+    type='LMSCNet_SS_Ensemble',
+    member_checkpoints=[
+        './my_result/voxformer_0/qpn/epoch_20.pth',
+        './my_result/voxformer_1/qpn/epoch_19.pth',
+        './my_result/voxformer_2/qpn/epoch_23.pth',
+        './my_result/voxformer_3/qpn/epoch_18.pth',
+        './my_result/voxformer_4/qpn/epoch_6.pth',
+    ],
+    # members 0-4 are written as five separate runs would
+    proposal_output = dict(root='./deepensemble_qpn', member=0, fmt='npy'))
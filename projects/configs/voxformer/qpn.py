@@ -44,6 +44,8 @@ model = dict(
     out_scale = "1_2",
     gamma = _gamma_,
     alpha = _alpha_,
+    # fmt='uint8' or 'float16' merges the members into one compact ProposalStore under root
+    proposal_output = dict(root='./deepensemble_qpn', member=0, fmt='npy'),
     # model training and testing settings
     train_cfg=dict(pts=dict(
         grid_size=[512, 512, 1],
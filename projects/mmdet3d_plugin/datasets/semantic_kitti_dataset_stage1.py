@@ -18,6 +18,7 @@ from torchvision import transforms
 from mmdet.datasets import DATASETS
 from mmcv.parallel import DataContainer as DC
 from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics
+from .semantic_kitti_label import SemanticKittiLabels
 
 @DATASETS.register_module()
 class SemanticKittiDatasetStage1(Dataset):
@@ -33,6 +34,7 @@ class SemanticKittiDatasetStage1(Dataset):
         super().__init__()
         self.data_root = data_root
         self.label_root = os.path.join(preprocess_root, "labels")
+        self.labels = SemanticKittiLabels(self.label_root)
         self.n_classes = 2
         splits = {
             "train": ["00", "01", "02", "03", "04", "05", "06", "07", "09", "10"],
@@ -119,29 +121,7 @@ class SemanticKittiDatasetStage1(Dataset):
         Returns:
             dict: Training data dict of the corresponding index.
         """
-        data_queue = []
-        example = self.get_data_info(index)
-
-        data_queue.insert(0, example)
-
-        return self.union2one(data_queue)
-
-    def union2one(self, queue):
-        """
-        convert sample queue into one single sample.
-        """
-        imgs_list = [each['img'] for each in queue]
-        metas_map = {}
-        
-        for i, each in enumerate(queue):
-            metas_map[i] = each['img_metas']
-
-        queue[-1]['img'] = DC(torch.stack(imgs_list),
-                              cpu_only=False, stack=True)
-        queue[-1]['img_metas'] = DC(metas_map, cpu_only=True)
-
-        queue = queue[-1]
-        return queue
+        return self.get_data_info(index)
 
     def get_data_info(self, index):
         """Get data info according to the given index.
@@ -165,71 +145,32 @@ class SemanticKittiDatasetStage1(Dataset):
         image_paths = []
         image_paths.append(rgb_path)
 
-        # load voxelized pseudo point cloud
-        pseudo_pc_bin = self.read_occupancy_SemKITTI(voxel_path)
+        # load voxelized pseudo point cloud, bit-packed [256*256*32/8], decoded on the GPU
+        pseudo_pc_bin = np.fromfile(voxel_path, dtype=np.uint8)
 
         if self.split == "train" or self.split == "val":
             # load ground truth
-            target_1_2_path = os.path.join(self.label_root, sequence, frame_id + "_1_2.npy")
-            target = np.load(target_1_2_path)
-            target = target.reshape(-1)
+            target = self.labels.read(sequence, frame_id, "1_2") # uint8, cast on the GPU
             target = target.reshape(128, 128, 16)
-            target = target.astype(np.float32)
         else:
-            target = np.ones((128,128,16))
+            target = np.ones((128,128,16), dtype=np.uint8)
 
         meta_dict = dict(
-            target=target,
             sequence_id = sequence,
-            voxel=None,
-            pseudo_pc=pseudo_pc_bin,
+            frame_id = frame_id,
             img_filename=image_paths,
             img_shape = [(370,1220)]
         )
 
+        # no image: the QPN only sees the pseudo voxels, batched like the target
         data_info = dict(
-            img_metas = meta_dict,
-            img = torch.zeros((1, 3, 370, 1220)),
-            target = meta_dict['target']
+            img_metas = DC(meta_dict, cpu_only=True),
+            pseudo_pc = DC(torch.from_numpy(pseudo_pc_bin), stack=True),
+            target = DC(torch.from_numpy(target), stack=True)
         )
  
         return data_info
 
-    def unpack(self, compressed):
-        ''' given a bit encoded voxel grid, make a normal voxel grid out of it.  '''
-        uncompressed = np.zeros(compressed.shape[0] * 8, dtype=np.uint8)
-        uncompressed[::8] = compressed[:] >> 7 & 1
-        uncompressed[1::8] = compressed[:] >> 6 & 1
-        uncompressed[2::8] = compressed[:] >> 5 & 1
-        uncompressed[3::8] = compressed[:] >> 4 & 1
-        uncompressed[4::8] = compressed[:] >> 3 & 1
-        uncompressed[5::8] = compressed[:] >> 2 & 1
-        uncompressed[6::8] = compressed[:] >> 1 & 1
-        uncompressed[7::8] = compressed[:] & 1
-
-        return uncompressed
-
-    def pack(self, array):
-        """ convert a boolean array into a bitwise array. """
-        array = array.reshape((-1))
-
-        #compressing bit flags.
-        # yapf: disable
-        compressed = array[::8] << 7 | array[1::8] << 6  | array[2::8] << 5 | array[3::8] << 4 | array[4::8] << 3 | array[5::8] << 2 | array[6::8] << 1 | array[7::8]
-        # yapf: enable
-
-        return np.array(compressed, dtype=np.uint8)
-
-    def read_SemKITTI(self, path, dtype, do_unpack):
-        bin = np.fromfile(path, dtype=dtype)  # Flattened array
-        if do_unpack:
-            bin = self.unpack(bin)
-        return bin
-
-    def read_occupancy_SemKITTI(self, path):
-        occupancy = self.read_SemKITTI(path, dtype=np.uint8, do_unpack=True).astype(np.float32)
-        return occupancy
-
     def evaluate(self,
                  results,
                  metric='bbox',
@@ -242,7 +183,8 @@ class SemanticKittiDatasetStage1(Dataset):
         """Evaluation in SemanticKITTI protocol.
 
         Args:
-            results (list[dict]): Testing results of the dataset.
+            results (list[dict] | SSCMetrics): Testing results of the dataset,
+                or the metrics accumulated by a streaming evaluation.
             metric (str | list[str]): Metrics to be evaluated.
             logger (logging.Logger | str | None): Logger used for printing
                 related information during evaluation. Default: None.
@@ -262,11 +204,16 @@ class SemanticKittiDatasetStage1(Dataset):
 
         detail = dict()
 
-        for result in results:
-            self.metrics.add_batch(result['y_pred'], result['y_true'])
+        if isinstance(results, SSCMetrics):
+            # counters already accumulated by a streaming evaluation
+            metrics = results
+        else:
+            metrics = self.metrics
+            for result in results:
+                metrics.add_batch(result['y_pred'], result['y_true'])
         metric_prefix = f'{result_name}_SemanticKITTI'
 
-        stats = self.metrics.get_stats()
+        stats = metrics.get_stats()
         for i, class_name in enumerate(self.class_names):
             detail["{}/SemIoU_{}".format(metric_prefix, class_name)] = stats["iou_ssc"][i]
 
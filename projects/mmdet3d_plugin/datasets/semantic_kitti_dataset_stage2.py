@@ -19,6 +19,9 @@ from torchvision import transforms
 from mmdet.datasets import DATASETS
 from mmcv.parallel import DataContainer as DC
 from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics
+from projects.mmdet3d_plugin.voxformer.utils import voxel_codec
+from .semantic_kitti_shard import SemanticKittiShard
+from .semantic_kitti_label import SemanticKittiLabels
 
 @DATASETS.register_module()
 class SemanticKittiDatasetStage2(Dataset):
@@ -35,11 +38,16 @@ class SemanticKittiDatasetStage2(Dataset):
         labels_tag = 'labels',
         query_tag = 'query_iou5203_pre7712_rec6153',
         color_jitter=None,
+        shard_root=None,
     ):
         super().__init__()
         
         self.data_root = data_root
+        # packed sequences from tools/pack_semantickitti.py, images are then kept in uint8 and normalized on the GPU
+        self.shard_root = shard_root
+        self.shards = dict()
         self.label_root = os.path.join(preprocess_root, labels_tag)
+        self.labels = SemanticKittiLabels(self.label_root)
         self.query_tag = query_tag
         self.nsweep=str(nsweep)
         self.depthmodel = depthmodel
@@ -173,6 +181,21 @@ class SemanticKittiDatasetStage2(Dataset):
             T_velo_2_cam = calib["Tr"]
             proj_matrix = P @ T_velo_2_cam
 
+            if self.shard_root is not None:
+                for frame_id in self.get_shard(sequence).frames():
+                    self.scans.append(
+                        {
+                            "sequence": sequence,
+                            "pose": self.poses[sequence],
+                            "P": P,
+                            "T_velo_2_cam": T_velo_2_cam,
+                            "proj_matrix": proj_matrix,
+                            "frame_id": frame_id,
+                            "proposal_path": None
+                        }
+                    )
+                continue
+
             glob_path = os.path.join(
                 self.data_root, "dataset", "sequences_" + self.depthmodel + "_sweep"+ self.nsweep, sequence, "queries", "*." + self.query_tag
             )
@@ -190,6 +213,28 @@ class SemanticKittiDatasetStage2(Dataset):
                     }
                 )
 
+    def get_shard(self, sequence):
+        """Packed data of a sequence."""
+        if sequence not in self.shards:
+            shard = SemanticKittiShard(self.shard_root, sequence)
+            self.check_shard(shard, sequence)
+            self.shards[sequence] = shard
+        return self.shards[sequence]
+
+    def check_shard(self, shard, sequence):
+        """Check that a shard was packed by tools/pack_semantickitti.py with the settings of the dataset."""
+        attrs = shard.index['attrs']
+        expected = dict(query_tag=self.query_tag, depthmodel=self.depthmodel, nsweep=int(self.nsweep),
+                        img_size=[self.img_H, self.img_W])
+        for name, value in expected.items():
+            if attrs.get(name) != value:
+                raise ValueError('shard of sequence {} in {} was packed with {}={}, the dataset expects {}'.format(
+                    sequence, self.shard_root, name, attrs.get(name), value))
+        missing = sorted(set(self.target_frames) - set(attrs.get('temporal') or []))
+        if missing:
+            raise ValueError('shard of sequence {} in {} was packed with temporal={}, without the offsets {} '
+                             'of the dataset'.format(sequence, self.shard_root, attrs.get('temporal'), missing))
+
     def set_group_flag(self):
         """Set flag according to image aspect ratio.
 
@@ -245,8 +290,11 @@ class SemanticKittiDatasetStage2(Dataset):
         proposal_path = scan["proposal_path"]
 
         sequence = scan["sequence"]
-        filename = os.path.basename(proposal_path)
-        frame_id = os.path.splitext(filename)[0]
+        if self.shard_root is not None:
+            frame_id = scan["frame_id"]
+        else:
+            filename = os.path.basename(proposal_path)
+            frame_id = os.path.splitext(filename)[0]
 
         meta_dict = self.get_meta_info(scan, sequence, frame_id, proposal_path)
         img = self.get_input_info(sequence, frame_id)
@@ -329,7 +377,10 @@ class SemanticKittiDatasetStage2(Dataset):
             cam_intrinsics.append(intrinsic)
             image_paths.append(rgb_path)
 
-        proposal_bin = self.read_occupancy_SemKITTI(proposal_path)
+        if self.shard_root is not None:
+            proposal_bin = voxel_codec.unpack(self.get_shard(sequence).proposal(frame_id), dtype=np.float32)
+        else:
+            proposal_bin = self.read_occupancy_SemKITTI(proposal_path)
 
         meta_dict = dict(
             sequence_id = sequence,
@@ -354,6 +405,9 @@ class SemanticKittiDatasetStage2(Dataset):
         Returns:
             torch.tensor: Img.
         """
+        if self.shard_root is not None:
+            return self.get_packed_input_info(sequence, frame_id)
+
         seq_len = len(self.poses[sequence])
         image_list = []
 
@@ -395,6 +449,39 @@ class SemanticKittiDatasetStage2(Dataset):
 
         return image_tensor
 
+    def get_packed_input_info(self, sequence, frame_id):
+        """Get the uint8 images of the specific frame from the packed sequence.
+
+        Args:
+            sequence (str): sequence id,
+            frame_id (str): frame id.
+
+        Returns:
+            torch.tensor: Img, normalized by the model on the GPU.
+        """
+        seq_len = len(self.poses[sequence])
+        shard = self.get_shard(sequence)
+        target_ids = [frame_id]
+        for i in self.target_frames:
+            id = int(frame_id)
+            if id + i < 0 or id + i > seq_len-1:
+                target_ids.append(frame_id)
+            else:
+                target_ids.append(str(id + i).zfill(6))
+
+        image_list = []
+        for target_id in target_ids:
+            img = torch.from_numpy(shard.image(target_id)) # [3, 370, 1220]
+            # Image augmentation, on the cropped uint8 tensor: unlike the jitter of the full
+            # PIL image above, the contrast is taken over the crop and the uint8 rounding differs
+            if self.color_jitter is not None:
+                img = self.color_jitter(img)
+            image_list.append(img)
+
+        image_tensor = torch.stack(image_list, dim=0) #[N, 3, 370, 1220]
+
+        return image_tensor
+
     def get_gt_info(self, sequence, frame_id):
         """Get the ground truth.
 
@@ -407,8 +494,12 @@ class SemanticKittiDatasetStage2(Dataset):
         """
         if self.split == "train" or self.split == "val":
             # load full-range groundtruth
-            target_1_path = os.path.join(self.label_root, sequence, frame_id + "_1_1.npy")
-            target = np.load(target_1_path)
+            if self.shard_root is not None:
+                target = self.get_shard(sequence).label(frame_id) # uint8, cast on the GPU
+                if self.eval_range != 51.2:
+                    target = target.copy()
+            else:
+                target = self.labels.read(sequence, frame_id, "1_1") # uint8, cast on the GPU
             # short-range groundtruth
             if self.eval_range == 25.6:
                 target[128:, :, :] = 255
@@ -424,36 +515,10 @@ class SemanticKittiDatasetStage2(Dataset):
 
         return target
 
-    def read_SemKITTI(self, path, dtype, do_unpack):
-        bin = np.fromfile(path, dtype=dtype)  # Flattened array
-        if do_unpack:
-            bin = self.unpack(bin)
-        return bin
-
     def read_occupancy_SemKITTI(self, path):
-        occupancy = self.read_SemKITTI(path, dtype=np.uint8, do_unpack=True).astype(np.float32)
+        occupancy = voxel_codec.read_occupancy(path, dtype=np.float32)
         return occupancy
 
-    def unpack(self, compressed):
-        ''' given a bit encoded voxel grid, make a normal voxel grid out of it.  '''
-        uncompressed = np.zeros(compressed.shape[0] * 8, dtype=np.uint8)
-        uncompressed[::8] = compressed[:] >> 7 & 1
-        uncompressed[1::8] = compressed[:] >> 6 & 1
-        uncompressed[2::8] = compressed[:] >> 5 & 1
-        uncompressed[3::8] = compressed[:] >> 4 & 1
-        uncompressed[4::8] = compressed[:] >> 3 & 1
-        uncompressed[5::8] = compressed[:] >> 2 & 1
-        uncompressed[6::8] = compressed[:] >> 1 & 1
-        uncompressed[7::8] = compressed[:] & 1
-
-        return uncompressed
-
-    def pack(self, array):
-        """ convert a boolean array into a bitwise array. """
-        array = array.reshape((-1))
-        compressed = array[::8] << 7 | array[1::8] << 6  | array[2::8] << 5 | array[3::8] << 4 | array[4::8] << 3 | array[5::8] << 2 | array[6::8] << 1 | array[7::8]
-        return np.array(compressed, dtype=np.uint8)
-
     def evaluate(self,
                  results,
                  metric='bbox',
@@ -466,7 +531,8 @@ class SemanticKittiDatasetStage2(Dataset):
         """Evaluation in SemanticKITTI protocol.
 
         Args:
-            results (list[dict]): Testing results of the dataset.
+            results (list[dict] | SSCMetrics): Testing results of the dataset,
+                or the metrics accumulated by a streaming evaluation.
             metric (str | list[str]): Metrics to be evaluated.
             logger (logging.Logger | str | None): Logger used for printing
                 related information during evaluation. Default: None.
@@ -486,11 +552,16 @@ class SemanticKittiDatasetStage2(Dataset):
 
         detail = dict()
 
-        for result in results:
-            self.metrics.add_batch(result['y_pred'], result['y_true'])
+        if isinstance(results, SSCMetrics):
+            # counters already accumulated by a streaming evaluation
+            metrics = results
+        else:
+            metrics = self.metrics
+            for result in results:
+                metrics.add_batch(result['y_pred'], result['y_true'])
         metric_prefix = f'{result_name}_SemanticKITTI'
 
-        stats = self.metrics.get_stats()
+        stats = metrics.get_stats()
         for i, class_name in enumerate(self.class_names):
             detail["{}/SemIoU_{}".format(metric_prefix, class_name)] = stats["iou_ssc"][i]
 
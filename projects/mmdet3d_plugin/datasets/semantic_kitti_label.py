@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+
+
+class SemanticKittiLabels(object):
+    """Reader of the preprocessed SemanticKITTI ground truth.
+
+    Labels are uint8 grids with the classes 0-19 and 255 for unknown voxels.
+    A sequence is read from ``<label_root>/<sequence>.npz`` when it has been
+    packed by ``pack_sequence`` of preprocess/label/label_preprocess.py,
+    otherwise from the per-frame ``<label_root>/<sequence>/<frame_id>_<scale>.npy``
+    files. Files written as float32 by former preprocessing are cast to uint8
+    on read.
+
+    Labels stay uint8 through the data pipeline, the models cast them to the
+    dtype of their losses on the device.
+
+    Args:
+        label_root (str): Folder of the preprocessed labels.
+    """
+
+    def __init__(self, label_root):
+        self.label_root = label_root
+        self.shards = dict()
+
+    def get_shard(self, sequence):
+        # opened on first access, i.e. inside the dataloader workers
+        if sequence not in self.shards:
+            path = os.path.join(self.label_root, sequence + '.npz')
+            self.shards[sequence] = np.load(path) if os.path.exists(path) else None
+        return self.shards[sequence]
+
+    def has_label(self, sequence, frame_id, scale='1_1'):
+        key = frame_id + '_' + scale
+        shard = self.get_shard(sequence)
+        if shard is not None:
+            return key in shard.files
+        return os.path.exists(os.path.join(self.label_root, sequence, key + '.npy'))
+
+    def read(self, sequence, frame_id, scale='1_1'):
+        """Read the label of a frame at scale ``1_1`` or ``1_2``."""
+        key = frame_id + '_' + scale
+        shard = self.get_shard(sequence)
+        if shard is not None:
+            return shard[key]
+        label = np.load(os.path.join(self.label_root, sequence, key + '.npy'))
+        return label.astype(np.uint8, copy=False)
+
+    def __getstate__(self):
+        # open npz files do not pickle, workers open their own
+        state = self.__dict__.copy()
+        state['shards'] = dict()
+        return state
+
@@ -0,0 +1,100 @@
+import json
+import os
+
+import numpy as np
+
+
+class SemanticKittiShard(object):
+    """Memory-mapped view of a packed SemanticKITTI sequence.
+
+    A sequence is packed into ``<shard_root>/<sequence>.bin``, a single file
+    holding three uint8 sections one after the other:
+
+    - ``images``: cropped RGB images with shape [num_images, 3, H, W].
+    - ``labels``: full-scale semantic labels with shape [num_labels, 256, 256, 32].
+    - ``proposals``: bit-packed query proposals with shape [num_proposals, num_bytes].
+
+    ``<shard_root>/<sequence>.json`` gives the byte offset and shape of each
+    section and the row of every frame id in it. Rows are copy-on-write
+    views, so reading a frame does not copy data.
+
+    Args:
+        shard_root (str): Folder of the packed sequences.
+        sequence (str): Sequence id.
+    """
+
+    SECTIONS = ('images', 'labels', 'proposals')
+
+    def __init__(self, shard_root, sequence):
+        self.path = os.path.join(shard_root, sequence + '.bin')
+        with open(os.path.join(shard_root, sequence + '.json')) as f:
+            self.index = json.load(f)
+        self.rows = {name: self.index[name] for name in self.SECTIONS}
+        self._sections = None
+
+    @property
+    def sections(self):
+        # mapped on first access, i.e. inside the dataloader workers
+        if self._sections is None:
+            self._sections = {}
+            for name in self.SECTIONS:
+                section = self.index['sections'][name]
+                if section['shape'][0] == 0:
+                    self._sections[name] = None
+                else:
+                    self._sections[name] = np.memmap(
+                        self.path, dtype=np.uint8, mode='c',
+                        offset=section['offset'], shape=tuple(section['shape']))
+        return self._sections
+
+    def frames(self):
+        """Frame ids with a query proposal."""
+        return sorted(self.rows['proposals'])
+
+    def has_label(self, frame_id):
+        return frame_id in self.rows['labels']
+
+    def image(self, frame_id):
+        return self.sections['images'][self.rows['images'][frame_id]]
+
+    def label(self, frame_id):
+        return self.sections['labels'][self.rows['labels'][frame_id]]
+
+    def proposal(self, frame_id):
+        return self.sections['proposals'][self.rows['proposals'][frame_id]]
+
+
+def write_shard(shard_root, sequence, images, labels, proposals, attrs=None):
+    """Pack a sequence into a shard readable by :class:`SemanticKittiShard`.
+
+    Args:
+        shard_root (str): Folder of the packed sequences.
+        sequence (str): Sequence id.
+        images, labels, proposals (list[tuple]): ``(frame_id, load)`` pairs of
+            each section, ``load`` returning the uint8 array of the frame.
+            Arrays of a section must share their shape, they are loaded one
+            at a time while writing.
+        attrs (dict, optional): Extra attributes kept in the index.
+    """
+    os.makedirs(shard_root, exist_ok=True)
+    index = dict(sections=dict(), attrs=attrs or {})
+    items = dict(images=images, labels=labels, proposals=proposals)
+    path = os.path.join(shard_root, sequence + '.bin')
+    with open(path + '.tmp', 'wb') as f:
+        for name in SemanticKittiShard.SECTIONS:
+            offset = f.tell()
+            rows = dict()
+            shape = None
+            for frame_id, load in items[name]:
+                array = np.ascontiguousarray(load(), dtype=np.uint8)
+                if shape is None:
+                    shape = array.shape
+                assert array.shape == shape, \
+                    '{} of frame {} has shape {}, expected {}'.format(name, frame_id, array.shape, shape)
+                rows[frame_id] = len(rows)
+                f.write(array.tobytes())
+            index['sections'][name] = dict(offset=offset, shape=[len(rows)] + list(shape or [0]))
+            index[name] = rows
+    os.replace(path + '.tmp', path)
+    with open(os.path.join(shard_root, sequence + '.json'), 'w') as f:
+        json.dump(index, f)
@@ -10,6 +10,7 @@
 #  Modified by Zhiqi Li
 # ---------------------------------------------
 
+import math
 import os.path as osp
 import pickle
 import shutil
@@ -23,6 +24,7 @@ from mmcv.image import tensor2imgs
 from mmcv.runner import get_dist_info
 
 from mmdet.core import encode_mask_results
+from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics
 
 
 import mmcv
@@ -58,21 +60,34 @@ def apply_dropout(m):
         print("Dropout")
         m.train()
         
-def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
+def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False, streaming=False,
+                          uq_metrics=None, logit_cache=None):
     """Test model with multiple gpus.
     This method tests model with multiple gpus and collects the results
     under two different modes: gpu and cpu modes. By setting 'gpu_collect=True'
     it encodes results to gpu tensors and use gpu communication for results
     collection. On cpu mode it saves the results on different gpus to 'tmpdir'
     and collects them by the rank 0 worker.
+    With 'streaming=True' no result is kept: each rank folds its predictions
+    into a local SSCMetrics and only the counters are all-reduced.
+    Given a UQMetrics, the class probabilities (``y_prob``) or logits
+    (``y_logit``) returned by the model are folded into it on the device and
+    dropped from the results, in both modes. Given a LogitStore, they are
+    also cached per frame for offline evaluation.
     Args:
         model (nn.Module): Model to be tested.
         data_loader (nn.Dataloader): Pytorch data loader.
         tmpdir (str): Path of directory to save the temporary results from
             different gpus under cpu mode.
         gpu_collect (bool): Option to use either gpu or cpu to collect results.
+        streaming (bool): Option to evaluate on the fly.
+        uq_metrics (UQMetrics, optional): Uncertainty metrics accumulated in
+            place, all-reduced at the end.
+        logit_cache (LogitStore, optional): Store the scores of every frame
+            are written to.
     Returns:
-        list: The prediction results.
+        list | SSCMetrics: The prediction results, or the accumulated metrics
+            in streaming mode.
     """
     
     model.eval()
@@ -82,13 +97,20 @@ def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
 
     dataset = data_loader.dataset
     rank, world_size = get_dist_info()
+    if streaming:
+        metrics = SSCMetrics(dataset.metrics.n_classes)
+    return_prob = uq_metrics is not None or logit_cache is not None
+    if streaming or return_prob:
+        # the sampler pads the last rank with samples from the start of the dataset,
+        # each rank handling a contiguous chunk, so padded samples have positions >= len(dataset)
+        position = rank * int(math.ceil(len(dataset) / world_size))
     if rank == 0:
         prog_bar = mmcv.ProgressBar(len(dataset))
     time.sleep(2)  # This line can prevent deadlock problem in some cases.
     # have_mask = False
     for i, data in enumerate(data_loader):
         with torch.no_grad():
-            result = model(return_loss=False, rescale=True, **data)
+            result = model(return_loss=False, rescale=True, return_prob=return_prob, **data)
 
             # print(result)
             # encode mask results
@@ -96,11 +118,37 @@ def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
                 # if 'y_pred' in result.keys():
                 # y_pred = result['y_pred']
                 batch_size = len(result['y_pred'])
+                # outputs on the device are never kept
+                prob = result.pop('y_prob', None)
+                logit = result.pop('y_logit', None)
+                img_metas = result.pop('img_metas', None)
+                if streaming or return_prob:
+                    num_valid = min(batch_size, len(dataset) - position)
+                    position += batch_size
+                if uq_metrics is not None and num_valid > 0:
+                    if prob is None and logit is not None:
+                        prob = logit[:num_valid].float().softmax(1)
+                    if prob is not None:
+                        uq_metrics.add_batch(prob[:num_valid], result['y_true'][:num_valid])
+                if logit_cache is not None and num_valid > 0:
+                    if logit is None:
+                        assert prob is not None, 'the model outputs no class scores to cache'
+                        logit = prob.clamp(min=1e-12).log()
+                    for b in range(num_valid):
+                        logit_cache.add(img_metas[b]['sequence_id'], img_metas[b]['frame_id'],
+                                        logit[b], result['y_true'][b])
                 # y_preds.extend(y_pred)
 
                 # y_true = result['y_true']
                 # batch_size = len(result['y_true'])
-                results.append(result)
+                if streaming:
+                    if num_valid > 0:
+                        metrics.add_batch(result['y_pred'][:num_valid], result['y_true'][:num_valid])
+                else:
+                    # one result per frame, so that the padding of the sampler is cut per frame
+                    results.extend(
+                        {key: value[b:b + 1] for key, value in result.items()}
+                        for b in range(batch_size))
                 # if 'mask_results' in result.keys() and result['mask_results'] is not None:
                 #     mask_result = custom_encode_mask_results(result['mask_results'])
                 #     mask_results.extend(mask_result)
@@ -117,6 +165,12 @@ def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
             for _ in range(batch_size * world_size):
                 prog_bar.update()
 
+    if uq_metrics is not None:
+        uq_metrics.all_reduce()
+    if streaming:
+        metrics.all_reduce()
+        return metrics
+
     # collect results from all ranks
     if gpu_collect:
         results = collect_results_gpu(results, len(dataset))
@@ -139,6 +193,8 @@ def custom_multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
 
 def collect_results_cpu(result_part, size, tmpdir=None):
     rank, world_size = get_dist_info()
+    if world_size == 1:
+        return result_part[:size]
     # create a tmp dir if it is not specified
     if tmpdir is None:
         MAX_LEN = 512
@@ -188,4 +244,4 @@ def collect_results_cpu(result_part, size, tmpdir=None):
         return ordered_results
 
 def collect_results_gpu(result_part, size):
-    collect_results_cpu(result_part, size)
+    return collect_results_cpu(result_part, size)
@@ -21,7 +21,9 @@ from mmdet.models.utils import build_transformer
 from mmdet.core import (multi_apply, multi_apply, reduce_mean)
 from mmcv.cnn.bricks.transformer import build_positional_encoding
 from projects.mmdet3d_plugin.voxformer.utils.header import Header
-from projects.mmdet3d_plugin.voxformer.utils.ssc_loss import sem_scal_loss, KL_sep, geo_scal_loss, CE_ssc_loss
+from projects.mmdet3d_plugin.voxformer.utils.crps import crps_ensemble
+from projects.mmdet3d_plugin.voxformer.utils.ensemble_proposal import EnsembleProposalProvider
+from projects.mmdet3d_plugin.voxformer.utils.ssc_loss import scal_losses, KL_sep, CE_ssc_loss
 from projects.mmdet3d_plugin.models.utils.bricks import run_time
 
 @HEADS.register_module()
@@ -40,6 +42,8 @@ class VoxFormerHead(nn.Module):
         geo_scal_loss=True,
         sem_scal_loss=True,
         save_flag = False,
+        ensemble_proposal=None,
+        header_cfg=None,
         **kwargs
     ):
         super().__init__()
@@ -55,7 +59,8 @@ class VoxFormerHead(nn.Module):
         self.positional_encoding = build_positional_encoding(positional_encoding)
         self.cross_transformer = build_transformer(cross_transformer)
         self.self_transformer = build_transformer(self_transformer)
-        self.header = Header(self.n_classes, nn.BatchNorm3d, feature=self.embed_dims)
+        # e.g. dict(tile_size=16, output='argmax') to bound the memory of inference
+        self.header = Header(self.n_classes, nn.BatchNorm3d, feature=self.embed_dims, **(header_cfg or {}))
         self.class_names =  [ "empty", "car", "bicycle", "motorcycle", "truck", "other-vehicle", "person", "bicyclist", "motorcyclist", "road", 
                             "parking", "sidewalk", "other-ground", "building", "fence", "vegetation", "trunk", "terrain", "pole", "traffic-sign",]
         self.class_weights = torch.from_numpy(np.array([0.446, 0.603, 0.852, 0.856, 0.747, 0.734, 0.801, 0.796, 0.818, 0.557, 
@@ -64,6 +69,13 @@ class VoxFormerHead(nn.Module):
         self.sem_scal_loss = sem_scal_loss
         self.geo_scal_loss = geo_scal_loss
         self.save_flag = save_flag
+        self.ensemble_proposal = EnsembleProposalProvider(**ensemble_proposal) if ensemble_proposal is not None else None
+
+        # the voxel grid is fixed, keep its coordinates and reference points on the device
+        vox_coords, ref_3d = self.get_ref_3d()
+        self.register_buffer('vox_coords', torch.from_numpy(vox_coords), persistent=False)
+        self.register_buffer('ref_3d', torch.from_numpy(ref_3d), persistent=False)
+        self._bev_pos_cache = None
         
     def forward(self, mlvl_feats, img_metas, target):
         """Forward function.
@@ -75,6 +87,11 @@ class VoxFormerHead(nn.Module):
             target: Semantic completion ground truth. 
         Returns:
             ssc_logit (Tensor): Outputs from the segmentation head.
+
+        Samples of a batch share one set of queries, the union of their
+        proposals. Cross attention treats every query independently, so the
+        seed features of a sample do not depend on the proposals of the
+        others; voxels outside the proposal of a sample get the mask token.
         """
 
         bs, num_cam, _, _, _ = mlvl_feats[0].shape
@@ -82,54 +99,23 @@ class VoxFormerHead(nn.Module):
         bev_queries = self.bev_embed.weight.to(dtype) #[128*128*16, dim]
 
         # Generate bev postional embeddings for cross and self attention
-        bev_pos_cross_attn = self.positional_encoding(torch.zeros((bs, 512, 512), device=bev_queries.device).to(dtype)).to(dtype) # [1, dim, 128*4, 128*4]
-        bev_pos_self_attn = self.positional_encoding(torch.zeros((bs, 512, 512), device=bev_queries.device).to(dtype)).to(dtype) # [1, dim, 128*4, 128*4]
-
-        # Load query proposals
-        proposal =  img_metas[0]['proposal'].reshape(self.bev_h, self.bev_w, self.bev_z)
-
-
-
-
-        frame_id=img_metas[0]["frame_id"]
-        root="/root/autodl-tmp/vox/mmdetection3d/VoxFormer-UQ/deepensemble_qpn"
-        y_pred_list=[]
-        # print(img_metas[0].keys())
-        for i in range(5):
-            try:
-                y_pred_tmp = np.load(os.path.join(root,str(i).zfill(2),img_metas[0]["sequence_id"],str(frame_id).zfill(8)+".npy"))
-                y_pred_list.append(y_pred_tmp)
-            except:
-                print(os.path.join(root,str(i).zfill(2),img_metas[0]["sequence_id"],str(frame_id).zfill(8)+".npy"))
-        #求平均值
-        y_pred=np.mean(y_pred_list,axis=0)
-        y_pred = torch.softmax(torch.from_numpy(y_pred), dim=1).detach().cpu().numpy()
-
-        y = np.argmax(y_pred, axis=1).astype(np.uint8) # [1, 128, 128, 16]
-        p=y_pred[:,1:2,...].reshape(self.bev_h, self.bev_w, self.bev_z)
-
-
-        # hp=-p * torch.log(p) - (1 - p) * torch.log(1 - p)
-        hp=-p*np.log(p)-(1-p)*np.log(1-p)
-
-        y=y.reshape(self.bev_h, self.bev_w, self.bev_z)
-
-        #y=1的地方prob=1-0.5*hp，否则prob=0.5*hp
-        prob=np.where(y==1,1-0.5*hp,0.5*hp)
-
-
-
-
-        
-        prob = torch.tensor(prob, device=self.bev_embed.weight.device).to(dtype)
-        prob = prob.unsqueeze(-1)
-        bev_queries = prob * bev_queries.reshape(self.bev_h, self.bev_w, self.bev_z, self.embed_dims) 
-        bev_queries = bev_queries.reshape(-1, self.embed_dims)
-
-        proposal=np.ones_like(proposal)
-        unmasked_idx = np.asarray(np.where(proposal.reshape(-1)>0)).astype(np.int32)
-        masked_idx = np.asarray(np.where(proposal.reshape(-1)==0)).astype(np.int32)
-        vox_coords, ref_3d = self.get_ref_3d()
+        bev_pos_cross_attn = self.get_bev_pos(bs, dtype, bev_queries.device) # [bs, dim, 128*4, 128*4]
+        bev_pos_self_attn = bev_pos_cross_attn
+
+        vox_coords, ref_3d = self.vox_coords, self.ref_3d
+
+        # Weight queries by the entropy of the stage-1 deep ensemble, all voxels are kept as queries
+        if self.ensemble_proposal is not None:
+            prob = self.ensemble_proposal(img_metas, bev_queries.device).to(dtype) # [bs, 128*128*16]
+            bev_queries = prob.t().unsqueeze(-1) * bev_queries.unsqueeze(1) # [128*128*16, bs, dim]
+            unmasked_idx = torch.arange(vox_coords.shape[0], device=bev_queries.device).unsqueeze(0)
+            proposal = None
+        else:
+            # Load query proposals, [bs, 128*128*16]
+            proposal = torch.stack([
+                torch.as_tensor(img_meta['proposal']).reshape(-1) for img_meta in img_metas
+            ]).to(bev_queries.device) > 0
+            unmasked_idx = torch.nonzero(proposal.any(0)).reshape(1, -1)
 
         # Compute seed features of query proposals by deformable cross attention
         seed_feats = self.cross_transformer.get_vox_features(
@@ -147,15 +133,19 @@ class VoxFormerHead(nn.Module):
         )
 
         # Complete voxel features by adding mask tokens
-        vox_feats = torch.empty((self.bev_h, self.bev_w, self.bev_z, self.embed_dims), device=bev_queries.device)
-        vox_feats_flatten = vox_feats.reshape(-1, self.embed_dims)
-        vox_feats_flatten[vox_coords[unmasked_idx[0], 3], :] = seed_feats[0]
-        vox_feats_flatten[vox_coords[masked_idx[0], 3], :] = self.mask_embed.weight.view(1, self.embed_dims).expand(masked_idx.shape[1], self.embed_dims).to(dtype)
+        mask_token = self.mask_embed.weight.view(1, 1, self.embed_dims).to(dtype)
+        vox_feats_flatten = torch.empty((bs, vox_coords.shape[0], self.embed_dims), device=bev_queries.device)
+        vox_feats_flatten[:] = mask_token
+        if proposal is None:
+            vox_feats_flatten[:, vox_coords[unmasked_idx[0], 3], :] = seed_feats
+        else:
+            keep = proposal[:, unmasked_idx[0]].unsqueeze(-1) # [bs, num_unmasked, 1]
+            vox_feats_flatten[:, vox_coords[unmasked_idx[0], 3], :] = torch.where(keep, seed_feats, mask_token)
 
         # Diffuse voxel features by deformable self attention
         vox_feats_diff = self.self_transformer.diffuse_vox_features(
             mlvl_feats,
-            vox_feats_flatten,
+            vox_feats_flatten.permute(1, 0, 2), # [128*128*16, bs, dim]
             512,
             512,
             ref_3d=ref_3d,
@@ -166,86 +156,43 @@ class VoxFormerHead(nn.Module):
             img_metas=img_metas,
             prev_bev=None,
         )
-        vox_feats_diff = vox_feats_diff.reshape(self.bev_h, self.bev_w, self.bev_z, self.embed_dims)
+        vox_feats_diff = vox_feats_diff.reshape(bs, self.bev_h, self.bev_w, self.bev_z, self.embed_dims)
         input_dict = {
-            "x3d": vox_feats_diff.permute(3, 0, 1, 2).unsqueeze(0),
+            "x3d": vox_feats_diff.permute(0, 4, 1, 2, 3),
         }
         out = self.header(input_dict)
         return out 
 
-    def nll(self, y_pred, target, img_metas):
-        cls_prob = y_pred  # Model's predictions
-        target = target.cpu().numpy().astype(np.int32)  # Convert target to NumPy array
+    def get_bev_pos(self, bs, dtype, device):
+        """Positional embeddings of the 512x512 bev grid.
 
-        # Index arrays for advanced indexing
-        batch_index = np.arange(cls_prob.shape[0])[:, None, None, None]
-        height_index = np.arange(cls_prob.shape[2])[None, :, None, None]
-        width_index = np.arange(cls_prob.shape[3])[None, None, :, None]
-        depth_index = np.arange(cls_prob.shape[4])[None, None, None, :]
-
-        mask = target != 255  # Mask to exclude pixels with 255 in target
-        target_valid = np.where(mask, target, 0)  # Replace 255 with 0 in target
-
-        # Extract probabilities for the actual classes
-        correct_probs = cls_prob[batch_index, target_valid, height_index, width_index, depth_index]
-        correct_probs_masked = correct_probs[mask]
-
-        # Calculate Negative Log-Likelihood
-        nll = -np.log(correct_probs_masked)
-        total_nll = np.sum(nll)
-        mean_nll = np.mean(nll)
-
-        # Print mean NLL and frame ID
-        # print("\nmean_nll", mean_nll, img_metas[0]["frame_id"])
-        return mean_nll
+        The embeddings only depend on the positional encoding weights, so
+        they are cached per (bs, dtype, device) and recomputed when the
+        weights are updated. While the weights are trained, the embeddings
+        are computed once per forward to keep them in the autograd graph.
+        """
+        params = tuple(self.positional_encoding.parameters())
+        key = (bs, dtype, device, tuple(p._version for p in params))
+        cacheable = not (torch.is_grad_enabled() and any(p.requires_grad for p in params))
+        if cacheable and self._bev_pos_cache is not None and self._bev_pos_cache[0] == key:
+            return self._bev_pos_cache[1]
 
+        bev_pos = self.positional_encoding(torch.zeros((bs, 512, 512), device=device).to(dtype)).to(dtype)
+        self._bev_pos_cache = (key, bev_pos) if cacheable else None
+        return bev_pos
 
     def crps(self, y_pred, target, img_metas):
-        from properscoring import crps_ensemble
-
-        cls_prob = y_pred  # Model's predicted probabilities
-        target = target.cpu().numpy().astype(np.int32)  # Convert target to a NumPy array
-
-        num_classes = 20  # Assuming there are 20 classes
-        batch_size, _, height, width, depth = cls_prob.shape  # Extract shape information from predictions
-
-        # Create a mask to identify valid pixels (not marked as 255 in the target)
-        mask = target != 255
-
-        # Initialize an array for one-hot encoding of the target
-        target_one_hot = np.zeros((batch_size, num_classes, height, width, depth))
+        """Mean CRPS of the class probabilities against the one-hot target.
 
-        # Create one-hot encoding for each valid pixel
-        for c in range(num_classes):
-            target_one_hot[:, c, :, :, :] = (target == c) & mask
-
-        # Calculate CRPS for the predictions compared to the one-hot encoded target
-        crps = crps_ensemble(cls_prob, target_one_hot)
-        crps = crps.mean()  # Compute the mean CRPS across all pixels
-        # print("crps", crps, img_metas[0]["frame_id"])  # Print the mean CRPS and frame ID
-        return crps
-
-    def ece(self, y_pred, target, img_metas):
-        cls_prob = y_pred  # Model's predicted probabilities
-        # Assuming the calibration library 'cal' is correctly imported
-        import calibration as cal
-
-        # Create a mask to exclude pixels marked as 255 in the target
-        mask = target != 255
-
-        # Flatten the target and apply the mask
-        target_flat_masked = target[mask].flatten()
-
-        # Reshape cls_prob and apply the mask, then convert to a NumPy array
-        # Reshape to (N, 20), where N = 1*256*256*32 (flattened dimensions of the input)
-        cls_prob_reshaped = cls_prob.permute(0, 2, 3, 4, 1).reshape(-1, 20)
-        cls_prob_masked_flat = cls_prob_reshaped[mask.view(-1), :].cpu().numpy()
-
-        # Calculate the marginal calibration error
-        cls_marginal_calibration_error = cal.get_calibration_error(
-            cls_prob_masked_flat, target_flat_masked.cpu().numpy().astype(np.int32))
-        # print("\ncls_marginal_calibration_error", cls_marginal_calibration_error, img_metas[0]["frame_id"])  # Print calibration error and frame ID
-        return cls_marginal_calibration_error
+        As with properscoring, every class probability is a deterministic
+        forecast of its one-hot indicator, which is 0 for all classes of the
+        unknown voxels. See categorical_crps for the CRPS of the class
+        distribution.
+        """
+        cls_prob = torch.as_tensor(y_pred, device=target.device)  # [bs, C, ...]
+        classes = torch.arange(cls_prob.size(1), device=target.device).view(1, -1, *[1] * (target.dim() - 1))
+        target_one_hot = target.long().unsqueeze(1) == classes
+        return crps_ensemble(cls_prob, target_one_hot).mean().item()
 
     def step(self, out_dict, target, img_metas, step_type):
         """Training/validation function.
@@ -258,7 +205,7 @@ class VoxFormerHead(nn.Module):
             loss or predictions
         """
 
-        ssc_pred = out_dict["ssc_logit"]
+        ssc_pred = out_dict.get("ssc_logit")
 
         if step_type== "train":
             loss_dict = dict()
@@ -268,19 +215,24 @@ class VoxFormerHead(nn.Module):
                 loss_ssc = CE_ssc_loss(ssc_pred, target, class_weight)
                 loss_dict['loss_ssc'] = loss_ssc
 
-            if self.sem_scal_loss:
-                loss_sem_scal = sem_scal_loss(ssc_pred, target)
-                loss_dict['loss_sem_scal'] = loss_sem_scal
-
-            if self.geo_scal_loss:
-                loss_geo_scal = geo_scal_loss(ssc_pred, target)
-                loss_dict['loss_geo_scal'] = loss_geo_scal
+            if self.sem_scal_loss or self.geo_scal_loss:
+                # one softmax and one reduction for both
+                loss_sem_scal, loss_geo_scal = scal_losses(
+                    ssc_pred, target, sem=self.sem_scal_loss, geo=self.geo_scal_loss)
+                if self.sem_scal_loss:
+                    loss_dict['loss_sem_scal'] = loss_sem_scal
+                if self.geo_scal_loss:
+                    loss_dict['loss_geo_scal'] = loss_geo_scal
 
             return loss_dict
 
         elif step_type== "val" or "test":
             y_true = target.cpu().numpy()
-            y_pred = ssc_pred.detach().cpu().numpy()
+            if "ssc_pred" in out_dict:
+                # labels computed by the header
+                y_pred = out_dict["ssc_pred"].cpu().numpy()
+            else:
+                y_pred = (ssc_pred if ssc_pred is not None else out_dict["ssc_prob"]).detach().cpu().numpy()
 
 
             
@@ -330,7 +282,8 @@ class VoxFormerHead(nn.Module):
             # np.save(root+img_metas[0]["frame_id"]+".npy",outnp)
 
 
-            y_pred = np.argmax(y_pred, axis=1)
+            if "ssc_pred" not in out_dict:
+                y_pred = np.argmax(y_pred, axis=1)
 
             result = dict()
             result['y_pred'] = y_pred
@@ -359,6 +312,9 @@ class VoxFormerHead(nn.Module):
         Returns:
             vox_coords (Array): Voxel indices
             ref_3d (Array): 3D reference points
+
+        The grid only depends on the config, it is built once in __init__ and
+        kept as the `vox_coords` and `ref_3d` buffers.
         """
         scene_size = (51.2, 51.2, 6.4)
         vox_origin = np.array([0, -25.6, -2])
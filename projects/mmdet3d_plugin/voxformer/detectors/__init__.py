@@ -1,2 +1,2 @@
 from .voxformer import VoxFormer
-from .lmscnet import LMSCNet_SS
+from .lmscnet import LMSCNet_SS, LMSCNet_SS_Ensemble
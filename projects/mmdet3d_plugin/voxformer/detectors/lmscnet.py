@@ -23,6 +23,11 @@ import numpy as np
 import mmdet3d
 from projects.mmdet3d_plugin.models.utils.bricks import run_time
 from projects.mmdet3d_plugin.voxformer.utils.ssc_loss import sem_scal_loss, CE_ssc_loss, KL_sep, geo_scal_loss, BCE_ssc_loss
+from projects.mmdet3d_plugin.voxformer.utils.ensemble_proposal import ProposalStore
+from projects.mmdet3d_plugin.voxformer.utils import voxel_codec
+from projects.mmdet3d_plugin.voxformer.utils.crps import crps_ensemble
+from mmcv.runner import get_dist_info, _load_checkpoint
+from collections import OrderedDict
 
 @DETECTORS.register_module()
 class LMSCNet_SS(MVXTwoStageDetector):
@@ -45,7 +50,8 @@ class LMSCNet_SS(MVXTwoStageDetector):
                  img_rpn_head=None,
                  train_cfg=None,
                  test_cfg=None,
-                 pretrained=None
+                 pretrained=None,
+                 proposal_output=None
                  ):
 
         super(LMSCNet_SS,
@@ -60,6 +66,9 @@ class LMSCNet_SS(MVXTwoStageDetector):
         '''
 
         super().__init__()
+        # fmt 'npy' saves the raw logits of one member, 'uint8'/'float16' merge members into a ProposalStore
+        self.proposal_output = dict(root='./deepensemble_qpn', member=0, fmt='npy') if proposal_output is None else proposal_output
+        self._proposal_store = None
         self.out_scale=out_scale
         self.nbr_classes = class_num
         self.gamma = gamma
@@ -185,7 +194,7 @@ class LMSCNet_SS(MVXTwoStageDetector):
         elif self.out_scale=="1_4":
           # Out 1_4
           out = self.deconv1_8(out_scale_1_8__2D)
-          out = torch.cat((out, _skip_1_4), 1)
+          out = self.cat_features(out, _skip_1_4)
           out = F.relu(self.conv1_4(out))
           out_scale_1_4__2D = self.conv_out_scale_1_4(out)
 
@@ -196,14 +205,14 @@ class LMSCNet_SS(MVXTwoStageDetector):
         elif self.out_scale=="1_2":
           # Out 1_4
           out = self.deconv1_8(out_scale_1_8__2D)
-          out = torch.cat((out, _skip_1_4), 1)
+          out = self.cat_features(out, _skip_1_4)
           out = F.relu(self.conv1_4(out))
           out = self.drop1(out)
           out_scale_1_4__2D = self.conv_out_scale_1_4(out)
 
           # Out 1_2
           out = self.deconv1_4(out_scale_1_4__2D)
-          out = torch.cat((out, _skip_1_2, self.deconv_1_8__1_2(out_scale_1_8__2D)), 1)
+          out = self.cat_features(out, _skip_1_2, self.deconv_1_8__1_2(out_scale_1_8__2D))
           out = F.relu(self.conv1_2(out)) # torch.Size([1, 48, 128, 128])
           out = self.drop2(out)
           out_scale_1_2__2D = self.conv_out_scale_1_2(out) # torch.Size([1, 16, 128, 128])
@@ -216,7 +225,7 @@ class LMSCNet_SS(MVXTwoStageDetector):
           # Out 1_4
           out = self.deconv1_8(out_scale_1_8__2D)
           print('out.shape', out.shape)  # [1, 4, 64, 64]
-          out = torch.cat((out, _skip_1_4), 1)
+          out = self.cat_features(out, _skip_1_4)
           out = F.relu(self.conv1_4(out))
           out_scale_1_4__2D = self.conv_out_scale_1_4(out)
           # print('out_scale_1_4__2D.shape', out_scale_1_4__2D.shape)  # [1, 8, 64, 64]
@@ -224,14 +233,14 @@ class LMSCNet_SS(MVXTwoStageDetector):
           # Out 1_2
           out = self.deconv1_4(out_scale_1_4__2D)
           print('out.shape', out.shape)  # [1, 8, 128, 128]
-          out = torch.cat((out, _skip_1_2, self.deconv_1_8__1_2(out_scale_1_8__2D)), 1)
+          out = self.cat_features(out, _skip_1_2, self.deconv_1_8__1_2(out_scale_1_8__2D))
           out = F.relu(self.conv1_2(out)) # torch.Size([1, 48, 128, 128])
           out_scale_1_2__2D = self.conv_out_scale_1_2(out) # torch.Size([1, 16, 128, 128])
           # print('out_scale_1_2__2D.shape', out_scale_1_2__2D.shape)  # [1, 16, 128, 128]
 
           # Out 1_1
           out = self.deconv1_2(out_scale_1_2__2D)
-          out = torch.cat((out, _skip_1_1, self.deconv_1_4__1_1(out_scale_1_4__2D), self.deconv_1_8__1_1(out_scale_1_8__2D)), 1)
+          out = self.cat_features(out, _skip_1_1, self.deconv_1_4__1_1(out_scale_1_4__2D), self.deconv_1_8__1_1(out_scale_1_8__2D))
           out_scale_1_1__2D = F.relu(self.conv1_1(out)) # [bs, 32, 256, 256]
 
           out_scale_1_1__3D = self.seg_head_1_1(out_scale_1_1__2D)
@@ -240,16 +249,28 @@ class LMSCNet_SS(MVXTwoStageDetector):
           return out_scale_1_1__3D
 
 
-    def pack(self, array):
-        """ convert a boolean array into a bitwise array. """
-        array = array.reshape((-1))
+    def cat_features(self, *feats):
+        """Concatenate feature maps along the channels."""
+        return torch.cat(feats, 1)
 
-        #compressing bit flags.
-        # yapf: disable
-        compressed = array[::8] << 7 | array[1::8] << 6  | array[2::8] << 5 | array[3::8] << 4 | array[4::8] << 3 | array[5::8] << 2 | array[6::8] << 1 | array[7::8]
-        # yapf: enable
+    def save_proposal(self, y_pred, sequence_id, frame_id):
+        """Save the QPN logits [M, 2, H, W, Z] of M members of a frame as configured by `proposal_output`.
 
-        return np.array(compressed, dtype=np.uint8)
+        The members are numbered from `proposal_output['member']` on.
+        """
+        cfg = self.proposal_output
+        if cfg['fmt'] == 'npy':
+            for i in range(len(y_pred)):
+                root = os.path.join(cfg['root'], str(cfg['member'] + i).zfill(2), sequence_id)
+                os.makedirs(root, exist_ok=True)
+                np.save(os.path.join(root, str(frame_id).zfill(8)+".npy"), y_pred[i:i + 1])
+            return
+
+        if self._proposal_store is None:
+            rank, _ = get_dist_info()
+            self._proposal_store = ProposalStore(cfg['root'], fmt=cfg['fmt'], shape=y_pred.shape[2:], rank=rank)
+        self._proposal_store.add_members(
+            sequence_id, frame_id, y_pred, list(range(cfg['member'], cfg['member'] + len(y_pred))))
 
     def forward(self, return_loss=True, **kwargs):
         """Calls either forward_train or forward_test depending on whether
@@ -261,29 +282,39 @@ class LMSCNet_SS(MVXTwoStageDetector):
         list[list[dict]]), with the outer list indicating test time
         augmentations.
         """
+        target = kwargs.get('target')
+        if target is not None and not target.is_floating_point():
+            # uint8 labels are cast on the device
+            kwargs['target'] = target.float()
         if return_loss:
             return self.foward_training(**kwargs)
         else:
             return self.foward_test(**kwargs)
 
 
+    def decode_input(self, pseudo_pc):
+        """Decode the bit-packed pseudo voxels [bs, 256*256*32/8] on their device.
+
+        Returns:
+            Tensor: Occupancy [bs, 32, 256, 256], height as channels for the 2D convs.
+        """
+        x, z, y = self.input_dimensions
+        occupancy = voxel_codec.unpack_torch(pseudo_pc, dtype=torch.float32)
+        return occupancy.view(-1, x, y, z).permute(0, 3, 1, 2)
+
     # @auto_fp16(apply_to=('img', 'points'))
     def foward_training(self,
                         img_metas=None,
-                        img=None,
+                        pseudo_pc=None,
                         target=None):
 
 
         # for binary classification
         ones = torch.ones_like(target).to(target.device)
-        target = torch.where(torch.logical_or(target==255, target==0), target, ones) # [1, 128, 128, 16]
+        target = torch.where(torch.logical_or(target==255, target==0), target, ones) # [bs, 128, 128, 16]
         # target[target==255] = 2
 
-        len_queue = img.size(1)
-        img_metas = [each[len_queue-1] for each in img_metas] # [dict(), dict(), ...] 
-
-        depth =  torch.from_numpy(img_metas[0]["pseudo_pc"]).reshape(256, 256, 32).unsqueeze(0) # [1, 256, 256, 32]
-        out_level_1 = self.step(depth.permute(0, 3, 1, 2).to(target.device))
+        out_level_1 = self.step(self.decode_input(pseudo_pc))
 
         # calculate loss
         losses = dict()
@@ -297,121 +328,40 @@ class LMSCNet_SS(MVXTwoStageDetector):
         return losses
 
     
-    def nll(self, y_pred, target, img_metas):
-        cls_prob = y_pred  # Model's predictions
-        target = target.cpu().numpy().astype(np.int32)  # Convert target to NumPy array
-
-        # Index arrays for advanced indexing
-        batch_index = np.arange(cls_prob.shape[0])[:, None, None, None]
-        height_index = np.arange(cls_prob.shape[2])[None, :, None, None]
-        width_index = np.arange(cls_prob.shape[3])[None, None, :, None]
-        depth_index = np.arange(cls_prob.shape[4])[None, None, None, :]
-
-        mask = target != 255  # Mask to exclude pixels with 255 in target
-        target_valid = np.where(mask, target, 0)  # Replace 255 with 0 in target
-
-        # Extract probabilities for the actual classes
-        correct_probs = cls_prob[batch_index, target_valid, height_index, width_index, depth_index]
-        correct_probs_masked = correct_probs[mask]
-
-        # Calculate Negative Log-Likelihood
-        nll = -np.log(correct_probs_masked)
-        total_nll = np.sum(nll)
-        mean_nll = np.mean(nll)
-
-        # Print mean NLL and frame ID
-        # print("\nmean_nll", mean_nll, img_metas[0]["frame_id"])
-        return mean_nll
-
-
     def crps(self, y_pred, target, img_metas):
-        from properscoring import crps_ensemble
-
-        cls_prob = y_pred  # Model's predicted probabilities
-        target = target.cpu().numpy().astype(np.int32)  # Convert target to a NumPy array
-
-        num_classes = 2  # Assuming there are 20 classes
-        batch_size, _, height, width, depth = cls_prob.shape  # Extract shape information from predictions
-
-        # Create a mask to identify valid pixels (not marked as 255 in the target)
-        mask = target != 255
-
-        # Initialize an array for one-hot encoding of the target
-        target_one_hot = np.zeros((batch_size, num_classes, height, width, depth))
-
-        # Create one-hot encoding for each valid pixel
-        for c in range(num_classes):
-            target_one_hot[:, c, :, :, :] = (target == c) & mask
-
-        # Calculate CRPS for the predictions compared to the one-hot encoded target
-        # raise NotImplementedError(cls_prob.shape, target_one_hot.shape)
-        crps = crps_ensemble(cls_prob, target_one_hot)
-        crps = crps.mean()  # Compute the mean CRPS across all pixels
-        # print("crps", crps, img_metas[0]["frame_id"])  # Print the mean CRPS and frame ID
-        return crps
-
-    def ece(self, y_pred, target, img_metas):
-        cls_prob = y_pred  # Model's predicted probabilities
-        # Assuming the calibration library 'cal' is correctly imported
-        import calibration as cal
-
-        # Create a mask to exclude pixels marked as 255 in the target
-        mask = target != 255
-
-        # Flatten the target and apply the mask
-        target_flat_masked = target[mask].flatten()
-
-        # Reshape cls_prob and apply the mask, then convert to a NumPy array
-        # Reshape to (N, 20), where N = 1*256*256*32 (flattened dimensions of the input)
-        cls_prob_reshaped = cls_prob.permute(0, 2, 3, 4, 1).reshape(-1, 2)
-        cls_prob_masked_flat = cls_prob_reshaped[mask.view(-1), :].cpu().numpy()
-
-        # Calculate the marginal calibration error
-        cls_marginal_calibration_error = cal.get_calibration_error(
-            cls_prob_masked_flat, target_flat_masked.cpu().numpy().astype(np.int32))
-        # print("\ncls_marginal_calibration_error", cls_marginal_calibration_error, img_metas[0]["frame_id"])  # Print calibration error and frame ID
-        return cls_marginal_calibration_error
+        """Mean CRPS of the class probabilities against the one-hot target.
 
+        As with properscoring, every class probability is a deterministic
+        forecast of its one-hot indicator, which is 0 for all classes of the
+        unknown voxels. See categorical_crps for the CRPS of the class
+        distribution.
+        """
+        cls_prob = torch.as_tensor(y_pred, device=target.device)  # [bs, C, ...]
+        classes = torch.arange(cls_prob.size(1), device=target.device).view(1, -1, *[1] * (target.dim() - 1))
+        target_one_hot = target.long().unsqueeze(1) == classes
+        return crps_ensemble(cls_prob, target_one_hot).mean().item()
 
     def foward_test(self,
                         img_metas=None,
-                        sequence_id=None,
-                        img=None,
-                        target=None,
-                        T_velo_2_cam=None,
-                        cam_k=None, **kwargs):
-
-        # 07/12/2022, Yiming Li, only support batch_size = 1
+                        pseudo_pc=None,
+                        target=None, return_prob=False, **kwargs):
 
         # for binary classification
         ones = torch.ones_like(target).to(target.device)
-        target = torch.where(torch.logical_or(target==255, target==0), target, ones) # [1, 128, 128, 16]
+        target = torch.where(torch.logical_or(target==255, target==0), target, ones) # [bs, 128, 128, 16]
 
         # target[target==255] = 2
 
-        len_queue = img.size(1)
-        img_metas = [each[len_queue-1] for each in img_metas] # [dict(), dict(), ...] 
+        ssc_pred = self.step(self.decode_input(pseudo_pc))
 
-        depth =  torch.from_numpy(img_metas[0]["pseudo_pc"]).reshape(256, 256, 32).unsqueeze(0) # [1, 256, 256, 32] 
-        # depth =  torch.from_numpy(img_metas[0]["pseudo_pc"]).reshape(256, 256, 32).unsqueeze(0) # [1, 256, 256, 32]
-        ssc_pred = self.step(depth.permute(0, 3, 1, 2).to(target.device))
-
-        y_pred = ssc_pred.detach().cpu().numpy() # [1, 20, 128, 128, 16]
+        y_pred = ssc_pred.detach().cpu().numpy() # [bs, 2, 128, 128, 16]
         
 
         #save query proposal 
-        img_path = img_metas[0]['img_filename'] 
-        frame_id = os.path.splitext(img_path[0])[0][-6:]
-        sequence_id = str(img_metas[0]['sequence_id']).zfill(2)
-
-
-        # raise NotImplementedError(img_metas[0].keys(),sequence_id)
-
-        #存储结果
-        # root="/root/autodl-tmp/vox/mmdetection3d/VoxFormer-UQ/deepensemble_qpn/04/"
-        root="./deepensemble_qpn/00/"
-        os.makedirs(os.path.join(root,sequence_id),exist_ok=True)
-        np.save(os.path.join(root,sequence_id,str(frame_id).zfill(8)+".npy"),y_pred)
+        for b, img_meta in enumerate(img_metas):
+            sequence_id = str(img_meta['sequence_id']).zfill(2)
+            #存储结果
+            self.save_proposal(y_pred[b:b + 1], sequence_id, img_meta['frame_id'])
 
         #         #读取10个结果
         # root="/root/autodl-tmp/vox/mmdetection3d/VoxFormer-UQ/MCDropout_qpn"
@@ -443,7 +393,7 @@ class LMSCNet_SS(MVXTwoStageDetector):
         # np.save(root+str(frame_id).zfill(8)+".npy",outnp)
 
 
-        y_pred = np.argmax(y_pred, axis=1).astype(np.uint8) # [1, 128, 128, 16]
+        y_pred = np.argmax(y_pred, axis=1).astype(np.uint8) # [bs, 128, 128, 16]
 
         # y_pred = torch.softmax(torch.from_numpy(y_pred).to(self.bev_embed.weight.device), dim=1).detach().cpu().numpy()
         
@@ -468,7 +418,7 @@ class LMSCNet_SS(MVXTwoStageDetector):
             # os.makedirs(os.path.join("./kitti/dataset/sequences_msnet3d_sweep10", img_metas[0]['sequence_id'], 'queries'))
         # save_query_path = os.path.join("./kitti/dataset/sequences_msnet3d_sweep10", img_metas[0]['sequence_id'], 'queries', frame_id + ".query_iou5203_pre7712_rec6153")
 
-        # y_pred_bin = self.pack(y_pred)
+        # y_pred_bin = voxel_codec.pack(y_pred)
         # y_pred_bin.tofile(save_query_path)
         #---------------------------------------------------------------------------------------------------
         
@@ -476,6 +426,114 @@ class LMSCNet_SS(MVXTwoStageDetector):
         y_true = target.cpu().numpy()
         result['y_pred'] = y_pred
         result['y_true'] = y_true
+        if return_prob:
+            result['y_logit'] = ssc_pred
+            result['img_metas'] = img_metas
+        return result
+
+
+@DETECTORS.register_module()
+class LMSCNet_SS_Ensemble(LMSCNet_SS):
+    """Deep ensemble of LMSCNet_SS members fused into one network.
+
+    Every convolution and norm of the members is stacked along the channels
+    into a grouped layer with one group per member, the first convolution
+    reading the shared input. One forward yields the logits of all members,
+    which are saved as if every member had been tested on its own. Inference
+    only, the members are trained with LMSCNet_SS.
+
+    Args:
+        member_checkpoints (list[str], optional): Checkpoints of the members,
+            fused into the network when given.
+        num_members (int, optional): Number of members. Defaults to the
+            number of checkpoints.
+    """
+
+    def __init__(self, member_checkpoints=None, num_members=None, **kwargs):
+        super(LMSCNet_SS_Ensemble, self).__init__(**kwargs)
+        self.num_members = num_members or len(member_checkpoints)
+        self.group_layers(self, shared_input=self.Encoder_block1[0])
+        if member_checkpoints is not None:
+            self.load_members(member_checkpoints)
+
+    def group_layers(self, module, shared_input):
+        for name, child in list(module.named_children()):
+            grouped = self.grouped(child, child is shared_input)
+            if grouped is not None:
+                setattr(module, name, grouped)
+                continue
+            if isinstance(child, SegmentationHead):
+                child.groups = self.num_members
+            self.group_layers(child, shared_input)
+
+    def grouped(self, layer, shared_input=False):
+        """Grouped counterpart of a layer of one member, None for layers without parameters."""
+        groups = self.num_members
+        in_groups = 1 if shared_input else groups
+        if isinstance(layer, (nn.Conv2d, nn.Conv3d)):
+            return type(layer)(layer.in_channels * in_groups, layer.out_channels * groups, layer.kernel_size,
+                               stride=layer.stride, padding=layer.padding, dilation=layer.dilation,
+                               groups=in_groups, bias=layer.bias is not None)
+        if isinstance(layer, nn.ConvTranspose2d):
+            return nn.ConvTranspose2d(layer.in_channels * groups, layer.out_channels * groups, layer.kernel_size,
+                                      stride=layer.stride, padding=layer.padding,
+                                      output_padding=layer.output_padding, groups=groups,
+                                      bias=layer.bias is not None, dilation=layer.dilation)
+        if isinstance(layer, nn.modules.batchnorm._BatchNorm):
+            return type(layer)(layer.num_features * groups, eps=layer.eps, momentum=layer.momentum)
+        return None
+
+    def load_members(self, checkpoints):
+        assert len(checkpoints) == self.num_members, \
+            '{} checkpoints for {} members'.format(len(checkpoints), self.num_members)
+        states = [_load_checkpoint(path, map_location='cpu') for path in checkpoints]
+        states = [state.get('state_dict', state) for state in states]
+        fused = OrderedDict()
+        for key, value in self.state_dict().items():
+            members = [state[key] for state in states]
+            # grouped weights, biases and norm statistics stack the members along their first dim
+            fused[key] = torch.cat(members, 0) if value.dim() > 0 else members[0]
+        self.load_state_dict(fused)
+
+    def cat_features(self, *feats):
+        """Concatenate feature maps along the channels of each member."""
+        bs, _, h, w = feats[0].shape
+        feats = [feat.view(bs, self.num_members, -1, h, w) for feat in feats]
+        return torch.cat(feats, 2).view(bs, -1, h, w)
+
+    def forward(self, return_loss=True, **kwargs):
+        if return_loss:
+            raise ValueError('LMSCNet_SS_Ensemble is test only, train each member with LMSCNet_SS '
+                             '(projects/configs/voxformer/qpn.py) and fuse the checkpoints')
+        return super(LMSCNet_SS_Ensemble, self).forward(return_loss=False, **kwargs)
+
+    def foward_test(self,
+                        img_metas=None,
+                        pseudo_pc=None,
+                        target=None, return_prob=False, **kwargs):
+
+        # for binary classification
+        ones = torch.ones_like(target).to(target.device)
+        target = torch.where(torch.logical_or(target==255, target==0), target, ones) # [bs, 128, 128, 16]
+
+        ssc_pred = self.step(self.decode_input(pseudo_pc))
+        ssc_pred = ssc_pred.view(ssc_pred.size(0), self.num_members, -1, *ssc_pred.shape[2:]) # [bs, M, 2, 128, 128, 16]
+
+        y_pred = ssc_pred.detach().cpu().numpy()
+        for b, img_meta in enumerate(img_metas):
+            sequence_id = str(img_meta['sequence_id']).zfill(2)
+            self.save_proposal(y_pred[b], sequence_id, img_meta['frame_id'])
+
+        # class of the mean member logits, as fused by ProposalStore
+        y_pred = ssc_pred.mean(1).argmax(1).cpu().numpy().astype(np.uint8) # [bs, 128, 128, 16]
+
+        result = dict()
+        result['y_pred'] = y_pred
+        result['y_true'] = target.cpu().numpy()
+        if return_prob:
+            # predictive distribution of the ensemble
+            result['y_prob'] = ssc_pred.softmax(2).mean(1)
+            result['img_metas'] = img_metas
         return result
 
 
@@ -484,9 +542,12 @@ class SegmentationHead(nn.Module):
   3D Segmentation heads to retrieve semantic segmentation at each scale.
   Formed by Dim expansion, Conv3D, ASPP block, Conv3D.
   '''
-  def __init__(self, inplanes, planes, nbr_classes, dilations_conv_list):
+  def __init__(self, inplanes, planes, nbr_classes, dilations_conv_list, groups=1):
     super().__init__()
 
+    # independent heads stacked along the channels, see LMSCNet_SS_Ensemble
+    self.groups = groups
+
     # First convolution
     self.conv0 = nn.Conv3d(inplanes, planes, kernel_size=3, padding=1, stride=1)
 
@@ -506,7 +567,7 @@ class SegmentationHead(nn.Module):
   def forward(self, x_in):
 
     # Dimension exapension
-    x_in = x_in[:, None, :, :, :]
+    x_in = x_in.view(x_in.size(0), self.groups, -1, *x_in.shape[2:])
 
     # Convolution to go from inplanes to planes features...
     x_in = self.relu(self.conv0(x_in))
@@ -13,17 +13,24 @@
 import time
 import copy
 import torch
+import torch.nn as nn
 import numpy as np
 import mmdet3d
 from tkinter.messagebox import NO
-from mmcv.runner import force_fp32, auto_fp16
+from mmcv.runner import force_fp32, auto_fp16, get_dist_info
 from mmdet.models import DETECTORS
 from mmdet3d.core import bbox3d2result
 from mmdet3d.models.detectors.mvx_two_stage import MVXTwoStageDetector
 from projects.mmdet3d_plugin.models.utils.bricks import run_time
+from projects.mmdet3d_plugin.voxformer.utils.predictive_stats import (
+    PredictiveStats, open_summary_store, write_summary)
 
 @DETECTORS.register_module()
 class VoxFormer(MVXTwoStageDetector):
+    # normalization applied by the dataset to decoded images, uint8 images of packed shards are normalized here
+    img_mean = (0.485, 0.456, 0.406)
+    img_std = (0.229, 0.224, 0.225)
+
     def __init__(self,
                  use_grid_mask=False,
                  pts_voxel_layer=None,
@@ -39,8 +46,20 @@ class VoxFormer(MVXTwoStageDetector):
                  img_rpn_head=None,
                  train_cfg=None,
                  test_cfg=None,
-                 pretrained=None
+                 pretrained=None,
+                 mc_dropout=None
                  ):
+        """
+        Args:
+            mc_dropout (dict, optional): Test with MC-dropout, e.g.
+                ``dict(num_samples=10, samples_per_forward=5, out=None)``.
+                The image features are extracted once and the head is run
+                ``num_samples`` times with its dropout layers active,
+                ``samples_per_forward`` of them stacked in the batch. The
+                prediction is the class of the mean probabilities, the
+                per-voxel summary of the samples is written to the
+                FrameStore ``out`` when set.
+        """
 
         super(VoxFormer,
               self).__init__(pts_voxel_layer, pts_voxel_encoder,
@@ -48,13 +67,15 @@ class VoxFormer(MVXTwoStageDetector):
                              img_backbone, pts_backbone, img_neck, pts_neck,
                              pts_bbox_head, img_roi_head, img_rpn_head,
                              train_cfg, test_cfg, pretrained)
+        self.mc_dropout = mc_dropout
+        self._mc_store = None
 
     def extract_img_feat(self, img, img_metas, len_queue=None):
         """Extract features of images."""
 
         B = img.size(0)
         if img is not None:
-            if img.dim() == 5 and img.size(0) == 1:
+            if img.dim() == 5:
                 B, N, C, H, W = img.size()
                 img = img.reshape(B * N, C, H, W)
 
@@ -94,6 +115,16 @@ class VoxFormer(MVXTwoStageDetector):
         losses = self.pts_bbox_head.training_step(outs, target, img_metas)
         return losses
 
+    def normalize_inputs(self, img=None, target=None):
+        """Normalize uint8 images and cast uint8 targets on the device."""
+        if img is not None and img.dtype == torch.uint8:
+            mean = img.new_tensor(self.img_mean, dtype=torch.float32).view(-1, 1, 1)
+            std = img.new_tensor(self.img_std, dtype=torch.float32).view(-1, 1, 1)
+            img = (img.float() / 255.0 - mean) / std
+        if target is not None and not target.is_floating_point():
+            target = target.float()
+        return img, target
+
     def forward(self, return_loss=True, **kwargs):
         """Calls either forward_train or forward_test depending on whether
         return_loss=True.
@@ -104,6 +135,8 @@ class VoxFormer(MVXTwoStageDetector):
         list[list[dict]]), with the outer list indicating test time
         augmentations.
         """
+        if 'img' in kwargs or 'target' in kwargs:
+            kwargs['img'], kwargs['target'] = self.normalize_inputs(kwargs.get('img'), kwargs.get('target'))
         if return_loss:
             return self.forward_train(**kwargs)
         else:
@@ -143,6 +176,7 @@ class VoxFormer(MVXTwoStageDetector):
                      img_metas=None,
                      img=None,
                      target=None,
+                     return_prob=False,
                       **kwargs):
         """Forward testing function.
         Args:
@@ -152,19 +186,97 @@ class VoxFormer(MVXTwoStageDetector):
                 (batch, C, H, W). Defaults to None.
             target (torch.Tensor): ground-truth of semantic scene completion
                 (batch, X_grids, Y_grids, Z_grids)
+            return_prob (bool): Also return the class probabilities
+                (``y_prob``) or logits (``y_logit``) on the device, with
+                the meta information of the key frames.
         Returns:
             dict: Completion result.
         """
 
+        if self.mc_dropout is not None:
+            return self.forward_mc_dropout_test(img_metas, img, target, return_prob)
+        img_metas, outs = self.forward_ssc(img_metas, img, target)
+        completion_results = self.pts_bbox_head.validation_step(outs, target, img_metas)
+        if return_prob:
+            completion_results['img_metas'] = img_metas
+            if 'ssc_logit' in outs:
+                completion_results['y_logit'] = outs['ssc_logit']
+            elif 'ssc_prob' in outs:
+                completion_results['y_prob'] = outs['ssc_prob']
+
+        return completion_results
+
+    def forward_ssc(self, img_metas, img, target=None):
+        """Run the backbone and the head on normalized inputs.
+
+        Returns:
+            tuple: The meta information of the key frames and the output
+                dict of the head, with ``ssc_logit``, ``ssc_prob`` or
+                ``ssc_pred`` as set by the header.
+        """
         len_queue = img.size(1)
-        batch_size = img.shape[0]
-        img_W = img.shape[5]
-        img_H = img.shape[4]
-        
         img_metas = [each[len_queue-1] for each in img_metas]
         img = img[:, -1, ...]
         img_feats = self.extract_feat(img=img) 
         outs = self.pts_bbox_head(img_feats, img_metas, target)
-        completion_results = self.pts_bbox_head.validation_step(outs, target, img_metas)
+        return img_metas, outs
 
-        return completion_results
+    def forward_mc_dropout(self, img_metas, img, num_samples=10, samples_per_forward=5):
+        """MC-dropout on normalized inputs, sharing the image features.
+
+        The backbone and neck run once in eval mode. The head runs with its
+        dropout layers in train mode on the features repeated
+        ``samples_per_forward`` times along the batch, so every copy draws
+        its own dropout masks, until ``num_samples`` samples are folded
+        into the running statistics.
+
+        Returns:
+            tuple: The meta information of the key frames and the
+                PredictiveStats of the samples.
+        """
+        len_queue = img.size(1)
+        img_metas = [each[len_queue-1] for each in img_metas]
+        img = img[:, -1, ...]
+        img_feats = self.extract_feat(img=img)
+        bs = img.size(0)
+
+        dropouts = [m for m in self.pts_bbox_head.modules() if isinstance(m, nn.Dropout)]
+        modes = [m.training for m in dropouts]
+        header = self.pts_bbox_head.header
+        output = header.output
+        stats = PredictiveStats()
+        try:
+            for m in dropouts:
+                m.train()
+            # the samples are averaged as probabilities
+            header.output = 'prob'
+            for start in range(0, num_samples, samples_per_forward):
+                num = min(samples_per_forward, num_samples - start)
+                # sample-major, the copies of sample s are rows [s * bs, (s + 1) * bs)
+                feats = [feat.repeat(num, *[1] * (feat.dim() - 1)) for feat in img_feats]
+                outs = self.pts_bbox_head(feats, img_metas * num, None)
+                prob = outs['ssc_prob']
+                stats.update(prob.view(num, bs, *prob.shape[1:]), stacked=True)
+        finally:
+            header.output = output
+            for m, mode in zip(dropouts, modes):
+                m.train(mode)
+        return img_metas, stats
+
+    def forward_mc_dropout_test(self, img_metas, img, target, return_prob=False):
+        cfg = dict(self.mc_dropout)
+        out = cfg.pop('out', None)
+        img_metas, stats = self.forward_mc_dropout(img_metas, img, **cfg)
+        summary = stats.summary()
+        if out is not None:
+            if self._mc_store is None:
+                self._mc_store = open_summary_store(out, attrs=dict(mc_dropout=self.mc_dropout),
+                                                    rank=get_dist_info()[0])
+            write_summary(self._mc_store, img_metas, summary)
+        result = dict(
+            y_pred=summary['pred'].to(torch.uint8).cpu().numpy(),
+            y_true=target.cpu().numpy())
+        if return_prob:
+            result['y_prob'] = stats.mean()
+            result['img_metas'] = img_metas
+        return result
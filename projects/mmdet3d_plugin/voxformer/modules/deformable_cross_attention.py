@@ -138,23 +138,20 @@ class DeformCrossAttention(BaseModule):
         bs, num_query, _ = query.size()
 
         D = reference_points_cam.size(3)
-        indexes = []
-        for i, mask_per_img in enumerate(bev_mask):
-            index_query_per_img = mask_per_img[0].sum(-1).nonzero().squeeze(-1)
-            indexes.append(index_query_per_img)
-        max_len = max([len(each) for each in indexes])
+        # queries hit by each camera of each sample, (num_cam, bs, num_query)
+        hit = bev_mask.any(-1)
+        cam_idx, batch_idx, query_idx = hit.nonzero(as_tuple=True)
+        # rank of a query among the queries hit by the same camera of the same sample
+        rank = (hit.cumsum(-1) - 1)[cam_idx, batch_idx, query_idx]
+        max_len = int(hit.sum(-1).max()) if hit.numel() > 0 else 0
 
         # each camera only interacts with its corresponding BEV queries. This step can  greatly save GPU memory.
         queries_rebatch = query.new_zeros(
             [bs, self.num_cams, max_len, self.embed_dims])
         reference_points_rebatch = reference_points_cam.new_zeros(
             [bs, self.num_cams, max_len, D, 2])
-        
-        for j in range(bs):
-            for i, reference_points_per_img in enumerate(reference_points_cam):   
-                index_query_per_img = indexes[i]
-                queries_rebatch[j, i, :len(index_query_per_img)] = query[j, index_query_per_img]
-                reference_points_rebatch[j, i, :len(index_query_per_img)] = reference_points_per_img[j, index_query_per_img]
+        queries_rebatch[batch_idx, cam_idx, rank] = query[batch_idx, query_idx]
+        reference_points_rebatch[batch_idx, cam_idx, rank] = reference_points_cam[cam_idx, batch_idx, query_idx]
 
         num_cams, l, bs, embed_dims = key.shape
 
@@ -166,12 +163,12 @@ class DeformCrossAttention(BaseModule):
         queries = self.deformable_attention(query=queries_rebatch.view(bs*self.num_cams, max_len, self.embed_dims), key=key, value=value,
                                             reference_points=reference_points_rebatch.view(bs*self.num_cams, max_len, D, 2), spatial_shapes=spatial_shapes,
                                             level_start_index=level_start_index).view(bs, self.num_cams, max_len, self.embed_dims)
-        for j in range(bs):
-            for i, index_query_per_img in enumerate(indexes):
-                slots[j, index_query_per_img] += queries[j, i, :len(index_query_per_img)]
+        # sum the outputs of the cameras hitting each query
+        slots = slots.view(bs * num_query, self.embed_dims).index_add(
+            0, batch_idx * num_query + query_idx, queries[batch_idx, cam_idx, rank]
+        ).view(bs, num_query, self.embed_dims)
 
-        count = bev_mask.sum(-1) > 0
-        count = count.permute(1, 2, 0).sum(-1)
+        count = hit.sum(0)
         count = torch.clamp(count, min=1.0)
         slots = slots / count[..., None]
         slots = self.output_proj(slots)
@@ -180,10 +180,17 @@ class DeformSelfAttention(BaseModule):
              Tensor: forwarded results with shape [num_query, bs, embed_dims].
         """
 
+        shared_value = False
         if value is None:
             assert self.batch_first
             bs, len_bev, c = query.shape
-            value = torch.stack([query, query], 1).reshape(bs*2, len_bev, c)
+            # without a previous bev both queue slots sample the current one:
+            # it is projected once and sampled by the queries of both slots
+            shared_value = key_padding_mask is None
+            if shared_value:
+                value = query
+            else:
+                value = torch.stack([query, query], 1).reshape(bs*2, len_bev, c)
 
             # value = torch.cat([query, query], 0)
 
@@ -200,13 +207,17 @@ class DeformSelfAttention(BaseModule):
         assert (spatial_shapes[:, 0] * spatial_shapes[:, 1]).sum() == num_value
         assert self.num_bev_queue == 2
 
-        query = torch.cat([value[:bs], query], -1)
+        if shared_value:
+            # the rows the doubled value gives, [q0, q0, q1, q1, ...][:bs]
+            query = torch.cat([value[[i // self.num_bev_queue for i in range(bs)]], query], -1)
+        else:
+            query = torch.cat([value[:bs], query], -1)
         value = self.value_proj(value)
 
         if key_padding_mask is not None:
             value = value.masked_fill(key_padding_mask[..., None], 0.0)
 
-        value = value.reshape(bs*self.num_bev_queue,
+        value = value.reshape(bs if shared_value else bs*self.num_bev_queue,
                               num_value, self.num_heads, -1)
 
         sampling_offsets = self.sampling_offsets(query)
@@ -243,6 +254,13 @@ class DeformSelfAttention(BaseModule):
             raise ValueError(
                 f'Last dim of reference_points must be'
                 f' 2 or 4, but get {reference_points.shape[-1]} instead.')
+        if shared_value:
+            # (bs*num_bev_queue, num_query, ...) -> (bs, num_bev_queue*num_query, ...), a view
+            sampling_locations = sampling_locations.view(
+                bs, self.num_bev_queue*num_query, *sampling_locations.shape[2:])
+            attention_weights = attention_weights.view(
+                bs, self.num_bev_queue*num_query, *attention_weights.shape[2:])
+
         if torch.cuda.is_available() and value.is_cuda:
 
             # using fp16 deformable attention is unstable because it performs many sum operations
@@ -260,6 +278,9 @@ class DeformSelfAttention(BaseModule):
 
         # output shape (bs*num_bev_queue, num_query, embed_dims)
         # (bs*num_bev_queue, num_query, embed_dims)-> (num_query, embed_dims, bs*num_bev_queue)
+        if shared_value:
+            output = output.view(bs*self.num_bev_queue, num_query, embed_dims)
+
         output = output.permute(1, 2, 0)
 
         # fuse history value and current value
@@ -11,8 +11,8 @@
 # ---------------------------------------------
 
 from projects.mmdet3d_plugin.models.utils.bricks import run_time
-from .multi_scale_deformable_attn_3D_custom_function import MultiScaleDeformableAttn3DCustomFunction_fp16, MultiScaleDeformableAttn3DCustomFunction_fp32
-from mmcv.ops.multi_scale_deform_attn import multi_scale_deformable_attn_pytorch
+from .multi_scale_deformable_attn_3D_custom_function import MultiScaleDeformableAttn3DCustomFunction_fp16, MultiScaleDeformableAttn3DCustomFunction_fp32, \
+    multi_scale_deformable_attn_3d_pytorch, ext_module
 import warnings
 import torch
 import torch.nn as nn
@@ -182,10 +182,17 @@ class DeformSelfAttention3DCustom(BaseModule):
         spatial_shapes=torch.tensor(
                         [[128,128, 16]], device=query.device)
 
+        shared_value = False
         if value is None:
             assert self.batch_first
             bs, len_bev, c = query.shape
-            value = torch.stack([query, query], 1).reshape(bs*2, len_bev, c)
+            # without a previous bev both queue slots sample the current one:
+            # it is projected once and sampled by the queries of both slots
+            shared_value = key_padding_mask is None
+            if shared_value:
+                value = query
+            else:
+                value = torch.stack([query, query], 1).reshape(bs*2, len_bev, c)
 
 
 
@@ -202,14 +209,18 @@ class DeformSelfAttention3DCustom(BaseModule):
         assert (spatial_shapes[:, 0] * spatial_shapes[:, 1]* spatial_shapes[:, 2]).sum() == num_value
         assert self.num_bev_queue == 2
 
-        query = torch.cat([value[:bs], query], -1)
+        if shared_value:
+            # the rows the doubled value gives, [q0, q0, q1, q1, ...][:bs]
+            query = torch.cat([value[[i // self.num_bev_queue for i in range(bs)]], query], -1)
+        else:
+            query = torch.cat([value[:bs], query], -1)
         value = self.value_proj(value)
 
 
 
         assert key_padding_mask is None
 
-        value = value.reshape(bs*self.num_bev_queue,
+        value = value.reshape(bs if shared_value else bs*self.num_bev_queue,
                               num_value, self.num_heads, -1)
 
         sampling_offsets = self.sampling_offsets(query)
@@ -238,7 +249,15 @@ class DeformSelfAttention3DCustom(BaseModule):
             / offset_normalizer[None, None, None, :, None, :]
 
 
-        if torch.cuda.is_available() and value.is_cuda:
+        if shared_value:
+            # (bs*num_bev_queue, num_query, ...) -> (bs, num_bev_queue*num_query, ...), a view
+            sampling_locations = sampling_locations.view(
+                bs, self.num_bev_queue*num_query, *sampling_locations.shape[2:])
+            attention_weights = attention_weights.view(
+                bs, self.num_bev_queue*num_query, *attention_weights.shape[2:])
+
+        # the extension runs on both devices, its CPU kernels have no half precision
+        if ext_module is not None and (value.is_cuda or value.dtype != torch.float16):
 
             # using fp16 deformable attention is unstable because it performs many sum operations
             if value.dtype == torch.float16:
@@ -252,9 +271,12 @@ class DeformSelfAttention3DCustom(BaseModule):
                 attention_weights, self.im2col_step)
         else:
 
-            output = multi_scale_deformable_attn_pytorch(
+            output = multi_scale_deformable_attn_3d_pytorch(
                 value, spatial_shapes, sampling_locations, attention_weights)
 
+        if shared_value:
+            output = output.view(bs*self.num_bev_queue, num_query, embed_dims)
+
         output = output.permute(1, 2, 0)
 
         output = output.view(num_query, embed_dims, bs, self.num_bev_queue)
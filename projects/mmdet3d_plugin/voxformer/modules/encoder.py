@@ -19,7 +19,6 @@ import warnings
 from mmcv.cnn.bricks.registry import (ATTENTION, TRANSFORMER_LAYER, TRANSFORMER_LAYER_SEQUENCE)
 from mmcv.cnn.bricks.transformer import TransformerLayerSequence
 from mmcv.runner import force_fp32, auto_fp16
-from mmcv.utils import TORCH_VERSION, digit_version
 from mmcv.utils import ext_loader
 from projects.mmdet3d_plugin.models.utils.bricks import run_time
 # from projects.mmdet3d_plugin.models.utils.visual import save_tensor
@@ -116,35 +115,29 @@ class VoxFormerEncoder(TransformerLayerSequence):
         D, B, num_query = reference_points.size()[:3]
         num_cam = lidar2img.size(1)
 
-        reference_points = reference_points.view(
-            D, B, 1, num_query, 4).repeat(1, 1, num_cam, 1, 1).unsqueeze(-1)
-
-        lidar2img = lidar2img.view(
-            1, B, num_cam, 1, 4, 4).repeat(D, 1, 1, num_query, 1, 1)
-
-        reference_points_cam = torch.matmul(lidar2img.to(torch.float32),
-                                            reference_points.to(torch.float32)).squeeze(-1)
+        # the matrices broadcast over the queries and the points over the cameras,
+        # only the rows giving the image coordinates and the depth are applied
+        reference_points_cam = torch.einsum(
+            'bnij,dbqj->dbnqi', lidar2img[..., :3, :].to(torch.float32),
+            reference_points.to(torch.float32))  # (D, B, N, num_query, 3)
         eps = 1e-5
 
-        bev_mask = (reference_points_cam[..., 2:3] > eps)
-        reference_points_cam = reference_points_cam[..., 0:2] / torch.maximum(
-            reference_points_cam[..., 2:3], torch.ones_like(reference_points_cam[..., 2:3]) * eps)
+        depth = reference_points_cam[..., 2]
+        bev_mask = depth > eps
+        reference_points_cam = reference_points_cam[..., 0:2] / depth.clamp(min=eps).unsqueeze(-1)
 
         reference_points_cam[..., 0] /= img_metas[0]['img_shape'][0][1]
         reference_points_cam[..., 1] /= img_metas[0]['img_shape'][0][0]
 
-        bev_mask = (bev_mask & (reference_points_cam[..., 1:2] > 0.0)
-                    & (reference_points_cam[..., 1:2] < 1.0)
-                    & (reference_points_cam[..., 0:1] < 1.0)
-                    & (reference_points_cam[..., 0:1] > 0.0))
-        if digit_version(TORCH_VERSION) >= digit_version('1.8'):
-            bev_mask = torch.nan_to_num(bev_mask)
-        else:
-            bev_mask = bev_mask.new_tensor(
-                np.nan_to_num(bev_mask.cpu().numpy()))
+        # the mask is narrowed in place, one comparison alive at a time.
+        # Comparisons with NaN are False, so the mask needs no nan_to_num.
+        bev_mask &= reference_points_cam[..., 1] > 0.0
+        bev_mask &= reference_points_cam[..., 1] < 1.0
+        bev_mask &= reference_points_cam[..., 0] < 1.0
+        bev_mask &= reference_points_cam[..., 0] > 0.0
 
         reference_points_cam = reference_points_cam.permute(2, 1, 3, 0, 4)
-        bev_mask = bev_mask.permute(2, 1, 3, 0, 4).squeeze(-1)
+        bev_mask = bev_mask.permute(2, 1, 3, 0)
 
         return reference_points_cam, bev_mask
 
@@ -194,8 +187,12 @@ class VoxFormerEncoder(TransformerLayerSequence):
         hybird_ref_2d = torch.stack([ref_2d, ref_2d], 1).reshape(
                 bs*2, len_bev, num_bev_level, 2)
 
-        reference_points_cam, bev_mask = self.point_sampling(
-            ref_3d, self.pc_range, kwargs['img_metas'])
+        # self attention only layers have no image features to sample
+        if key is not None:
+            reference_points_cam, bev_mask = self.point_sampling(
+                ref_3d, self.pc_range, kwargs['img_metas'])
+        else:
+            reference_points_cam, bev_mask = None, None
 
         # (num_query, bs, embed_dims) -> (bs, num_query, embed_dims)
         bev_query = bev_query.permute(1, 0, 2)
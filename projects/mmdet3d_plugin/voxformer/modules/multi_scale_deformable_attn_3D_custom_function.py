@@ -5,6 +5,7 @@
 # ---------------------------------------------
 
 import torch
+import torch.nn.functional as F
 from torch.cuda.amp import custom_bwd, custom_fwd
 from torch.autograd.function import Function, once_differentiable
 from mmcv.utils import ext_loader
@@ -21,7 +22,63 @@ import sys
 
 
 
-# import deform3dattn_custom_cn as ext_module
+try:
+    # built by deform_attn_3d/setup.py, with CPU kernels and, when CUDA is available, CUDA ones
+    import deform3dattn_custom_cn as ext_module
+except ImportError:
+    ext_module = None
+
+
+def multi_scale_deformable_attn_3d_pytorch(value, value_spatial_shapes,
+                                           sampling_locations, attention_weights):
+    """Pure pytorch 3D multi-scale deformable attention with trilinear grid_sample.
+
+    Reference of the deform3dattn_custom_cn kernels, used when they are not built.
+
+    Args:
+        value (Tensor): The value has shape
+            (bs, num_keys, num_heads, embed_dims//num_heads), the keys of a
+            level being ordered as (h, w, z).
+        value_spatial_shapes (Tensor): Spatial shape of
+            each feature map, has shape (num_levels, 3),
+            last dimension 3 represent (h, w, z)
+        sampling_locations (Tensor): The location of sampling points,
+            has shape
+            (bs ,num_queries, num_heads, num_levels, num_points, 3),
+            the last dimension 3 represent (x, y, z), x indexing w and y indexing h.
+        attention_weights (Tensor): The weight of sampling points used
+            when calculate the attention, has shape
+            (bs ,num_queries, num_heads, num_levels, num_points),
+
+    Returns:
+        Tensor: has shape (bs, num_queries, embed_dims)
+    """
+    bs, _, num_heads, embed_dims = value.shape
+    _, num_queries, num_heads, num_levels, num_points, _ = \
+        sampling_locations.shape
+    value_list = value.split([H_ * W_ * Z_ for H_, W_, Z_ in value_spatial_shapes], dim=1)
+    sampling_grids = 2 * sampling_locations - 1
+    sampling_value_list = []
+    for level, (H_, W_, Z_) in enumerate(value_spatial_shapes):
+        # bs, H_*W_*Z_, num_heads, embed_dims ->
+        # bs*num_heads, embed_dims, Z_, H_, W_ so that the grid (x, y, z) indexes (W_, H_, Z_)
+        value_l_ = value_list[level].flatten(2).transpose(1, 2).reshape(
+            bs * num_heads, embed_dims, H_, W_, Z_).permute(0, 1, 4, 2, 3)
+        # bs, num_queries, num_heads, num_points, 3 ->
+        # bs*num_heads, num_queries, num_points, 1, 3
+        sampling_grid_l_ = sampling_grids[:, :, :, level].transpose(1, 2).flatten(0, 1).unsqueeze(-2)
+        # bs*num_heads, embed_dims, num_queries, num_points
+        sampling_value_l_ = F.grid_sample(
+            value_l_, sampling_grid_l_, mode='bilinear', padding_mode='zeros',
+            align_corners=False).squeeze(-1)
+        sampling_value_list.append(sampling_value_l_)
+    # (bs, num_queries, num_heads, num_levels, num_points) ->
+    # (bs*num_heads, 1, num_queries, num_levels*num_points)
+    attention_weights = attention_weights.transpose(1, 2).reshape(
+        bs * num_heads, 1, num_queries, num_levels * num_points)
+    output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) *
+              attention_weights).sum(-1).view(bs, num_heads * embed_dims, num_queries)
+    return output.transpose(1, 2).contiguous()
 
 
 class MultiScaleDeformableAttn3DCustomFunction_fp16(Function):
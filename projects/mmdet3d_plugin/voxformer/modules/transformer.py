@@ -99,17 +99,20 @@ class PerceptionTransformer(BaseModule):
             **kwargs):
         """
         obtain voxel features.
+        ref_3d, vox_coords and unmasked_idx are tensors on the device of the queries.
+        bev_queries is either shared by the batch, [N, dim], or given per sample, [N, bs, dim].
         """
 
         bs = mlvl_feats[0].size(0)
-        bev_queries = bev_queries.unsqueeze(1).repeat(1, bs, 1) #  #[N, 1, 64]
-        bev_pos = bev_pos.flatten(2).permute(2, 0, 1) # [N, 1, 64]
+        if bev_queries.dim() == 2:
+            bev_queries = bev_queries.unsqueeze(1).repeat(1, bs, 1) #  #[N, bs, 64]
+        bev_pos = bev_pos.flatten(2).permute(2, 0, 1) # [N, bs, 64]
 
         unmasked_bev_queries = bev_queries[vox_coords[unmasked_idx[0], 3], :, :]
         unmasked_bev_bev_pos = bev_pos[vox_coords[unmasked_idx[0], 3], :, :]
 
-        unmasked_ref_3d = torch.from_numpy(ref_3d[vox_coords[unmasked_idx[0], 3], :]) 
-        unmasked_ref_3d = unmasked_ref_3d.unsqueeze(0).unsqueeze(0).to(unmasked_bev_queries.device)
+        unmasked_ref_3d = ref_3d[vox_coords[unmasked_idx[0], 3], :]
+        unmasked_ref_3d = unmasked_ref_3d[None, None].expand(bs, 1, -1, -1) # [bs, 1, N, 3]
         
         feat_flatten = []
         spatial_shapes = []
@@ -169,11 +172,12 @@ class PerceptionTransformer(BaseModule):
         """
 
         bs = mlvl_feats[0].size(0)
-        bev_queries = bev_queries.unsqueeze(1).repeat(1, bs, 1) 
+        if bev_queries.dim() == 2:
+            bev_queries = bev_queries.unsqueeze(1).repeat(1, bs, 1) 
         bev_pos = bev_pos.flatten(2).permute(2, 0, 1)
 
-        unmasked_ref_3d = torch.from_numpy(ref_3d[vox_coords[unmasked_idx[0], 3], :]) 
-        unmasked_ref_3d = unmasked_ref_3d.unsqueeze(0).unsqueeze(0).to(bev_queries.device)
+        unmasked_ref_3d = ref_3d[vox_coords[unmasked_idx[0], 3], :]
+        unmasked_ref_3d = unmasked_ref_3d[None, None].expand(bs, 1, -1, -1) # [bs, 1, N, 3]
         
         bev_embed = self.encoder(
             bev_queries,
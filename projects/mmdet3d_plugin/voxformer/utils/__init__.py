@@ -1,3 +1,9 @@
 from .header import *
 from .ssc_loss import *
 from .ssc_metric import *
+from .frame_store import *
+from .ensemble_proposal import *
+from .predictive_stats import *
+from .uq_metric import *
+from .crps import *
+from .logit_cache import *
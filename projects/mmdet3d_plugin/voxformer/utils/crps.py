@@ -0,0 +1,74 @@
+import torch
+
+
+def crps_ensemble(observations, forecasts, dim=-1, chunk_size=None):
+    """CRPS of ensemble forecasts, the torch counterpart of properscoring.crps_ensemble.
+
+    The empirical distribution of the members is scored with the energy form
+    ``E|X - y| - E|X - X'| / 2``, the member spread being taken over all
+    pairs of members instead of sorting them. Computed in float32, float64
+    for float64 forecasts, on the device of the forecasts. NaN members are
+    not skipped as in properscoring.
+
+    Args:
+        observations (Tensor | np.ndarray): Observations [...].
+        forecasts (Tensor | np.ndarray): Members along ``dim``, the other
+            dimensions matching the observations. Forecasts of the shape of
+            the observations are deterministic and scored ``|x - y|``.
+        dim (int): Member dimension of the forecasts. Default: -1.
+        chunk_size (int, optional): Number of observations scored at once,
+            bounds the [chunk_size, M, M] pairwise differences. By default
+            the chunks hold at most ``2 ** 24`` differences.
+
+    Returns:
+        Tensor: CRPS with the shape of the observations.
+    """
+    forecasts = torch.as_tensor(forecasts)
+    observations = torch.as_tensor(observations, device=forecasts.device)
+    dtype = torch.float64 if forecasts.dtype == torch.float64 else torch.float32
+    if observations.shape == forecasts.shape:
+        return (forecasts.to(dtype) - observations.to(dtype)).abs()
+    forecasts = forecasts.movedim(dim, -1)
+    if observations.shape != forecasts.shape[:-1]:
+        raise ValueError('observations {} do not match forecasts {} without dim {}'.format(
+            tuple(observations.shape), tuple(forecasts.shape), dim))
+
+    num_members = forecasts.size(-1)
+    x = forecasts.reshape(-1, num_members)
+    y = observations.reshape(-1)
+    crps = torch.empty(y.shape, dtype=dtype, device=x.device)
+    if chunk_size is None:
+        chunk_size = (1 << 24) // (num_members * num_members)
+    chunk_size = max(chunk_size, 1)
+    for start in range(0, y.numel(), chunk_size):
+        xc = x[start:start + chunk_size].to(dtype)
+        yc = y[start:start + chunk_size].to(dtype)
+        skill = (xc - yc.unsqueeze(1)).abs().mean(1)
+        spread = (xc.unsqueeze(2) - xc.unsqueeze(1)).abs().mean((1, 2))
+        crps[start:start + chunk_size] = skill - 0.5 * spread
+    return crps.view(observations.shape)
+
+
+def categorical_crps(prob, target, dim=1, ignore_index=255):
+    """CRPS of class probabilities against labels.
+
+    With the distance 1 between distinct classes, the energy form
+    ``E d(X, y) - E d(X, X') / 2`` of the categorical distribution ``p`` is
+    ``(1 - p_y) - (1 - sum_k p_k^2) / 2``, i.e. half the Brier score
+    ``sum_k (p_k - [k == y])^2 / 2``, so no one-hot target is built.
+
+    Args:
+        prob (Tensor): Class probabilities, classes along ``dim``.
+        target (Tensor): Labels, the shape of ``prob`` without ``dim``.
+        dim (int): Class dimension. Default: 1.
+        ignore_index (int): Label of the voxels left out. Default: 255.
+
+    Returns:
+        Tensor: Flattened CRPS of the voxels not labeled ``ignore_index``.
+    """
+    prob = prob.movedim(dim, -1)
+    target = torch.as_tensor(target, device=prob.device).long()
+    keep = target != ignore_index
+    prob = prob[keep].float()  # [N, C]
+    p_true = prob.gather(1, target[keep].unsqueeze(1)).squeeze(1)
+    return (1 - p_true) - 0.5 * (1 - (prob * prob).sum(1))
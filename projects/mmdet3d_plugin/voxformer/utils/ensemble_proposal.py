@@ -0,0 +1,272 @@
+import os
+import shutil
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .frame_store import FrameStore
+
+
+def _sigmoid(x):
+    with np.errstate(over='ignore'):
+        return 1. / (1. + np.exp(-x))
+
+
+def _binary_entropy(p):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hp = -p * np.log(p) - (1 - p) * np.log1p(-p)
+    return np.nan_to_num(hp)
+
+
+class ProposalStore(FrameStore):
+    """Compact store of fused QPN ensemble outputs.
+
+    Members are merged into one running aggregate per frame as they are
+    written, so only a single record per frame is ever kept on disk. The
+    aggregate is the mean over members of the occupancy logit
+    ``l_occupied - l_empty``, whose sigmoid equals the softmax of the mean
+    member logits. Two record formats are supported:
+
+    - ``uint8``: occupancy probability quantized to 255 levels.
+    - ``float16``: mean logit and binary entropy of the fused probability.
+
+    A bitmask of the merged members makes re-running a member idempotent.
+    The ``uint8`` records are quantized from the float32 sum of the member
+    logits, kept next to them under ``<root>/_sums`` so that merging does
+    not accumulate rounding nor depend on the order of the members.
+    :meth:`finalize` drops the sums once all members are merged.
+
+    Args:
+        root (str): Root folder of the store.
+        fmt (str, optional): ``'uint8'`` or ``'float16'``. Read from the
+            store when omitted.
+        shape (tuple[int]): Shape of the proposal volume.
+            Default: (128, 128, 16).
+        rank (int): Rank of the writing process. Default: 0.
+    """
+
+    FORMATS = ('uint8', 'float16')
+    SUMS = '_sums'
+
+    def __init__(self, root, fmt=None, shape=(128, 128, 16), rank=0):
+        fields = None
+        if fmt is not None:
+            assert fmt in self.FORMATS, 'unknown proposal format {}'.format(fmt)
+            num_voxels = int(np.prod(shape))
+            if fmt == 'uint8':
+                fields = [('members', '<u4', ()), ('prob', 'u1', (num_voxels,))]
+            else:
+                fields = [('members', '<u4', ()), ('logit', '<f2', (num_voxels,)),
+                          ('entropy', '<f2', (num_voxels,))]
+        super(ProposalStore, self).__init__(
+            root, fields, attrs=dict(fmt=fmt, shape=list(shape)), rank=rank)
+        self.fmt = self.attrs['fmt']
+        self.shape = tuple(self.attrs['shape'])
+        self._sums = None
+
+    def sequences(self):
+        return [name for name in super(ProposalStore, self).sequences() if name != self.SUMS]
+
+    def sums(self):
+        """Store of the member count and float32 logit sum of the ``uint8`` frames."""
+        if self._sums is None:
+            fields = [('members', '<u4', ()), ('logit_sum', '<f4', (int(np.prod(self.shape)),))]
+            self._sums = FrameStore(os.path.join(self.root, self.SUMS), fields, rank=self.rank)
+        return self._sums
+
+    def finalize(self):
+        """Drop the logit sums of the ``uint8`` format, leaving only the
+        quantized probabilities. No member can be merged into the frames
+        stored so far afterwards.
+        """
+        shutil.rmtree(os.path.join(self.root, self.SUMS), ignore_errors=True)
+        self._sums = None
+
+    def add_member(self, sequence_id, frame_id, logits, member):
+        """Merge the output of one ensemble member into the frame aggregate.
+
+        Args:
+            logits (np.ndarray): Member logits with shape [2, H, W, Z].
+            member (int): Index of the ensemble member, below 32.
+        """
+        self.add_members(sequence_id, frame_id, logits[None], [member])
+
+    def add_members(self, sequence_id, frame_id, logits, members):
+        """Merge the outputs of several ensemble members with a single write.
+
+        Args:
+            logits (np.ndarray): Member logits with shape [M, 2, H, W, Z].
+            members (list[int]): Indexes of the M ensemble members, below 32.
+        """
+        if self.fmt == 'uint8':
+            record = self.sums().read(sequence_id, frame_id)
+            if record is None and self.contains(sequence_id, frame_id):
+                raise ValueError('frame {} of sequence {} in {} is finalized, no member can be merged'.format(
+                    frame_id, sequence_id, self.root))
+        else:
+            record = self.read(sequence_id, frame_id)
+        merged = 0 if record is None else int(record['members'])
+        new = []
+        for i, member in enumerate(members):
+            if not merged & (1 << member):
+                new.append(i)
+                merged |= 1 << member
+        if not new:
+            return
+        logit = (logits[new, 1] - logits[new, 0]).reshape(len(new), -1).astype(np.float32).sum(0)
+        if self.fmt == 'uint8':
+            if record is not None:
+                logit += record['logit_sum']
+            self.sums().write(sequence_id, frame_id, members=merged, logit_sum=logit)
+            p = _sigmoid(logit / bin(merged).count('1'))
+            self.write(sequence_id, frame_id, members=merged,
+                       prob=np.floor(p * 255 + 0.5).astype(np.uint8))
+        else:
+            if record is None:
+                logit /= len(new)
+            else:
+                num = bin(int(record['members'])).count('1')
+                logit = (record['logit'].astype(np.float32) * num + logit) / (num + len(new))
+            p = _sigmoid(logit)
+            self.write(sequence_id, frame_id, members=merged,
+                       logit=logit.astype(np.float16),
+                       entropy=_binary_entropy(p).astype(np.float16))
+
+    def load(self, sequence_id, frame_id):
+        """Fused occupancy probability of a frame.
+
+        Returns:
+            tuple[np.ndarray]: Flattened probability and binary entropy, the
+                latter None for the ``uint8`` format.
+        """
+        record = self.read(sequence_id, frame_id)
+        if record is None:
+            raise IOError('frame {} of sequence {} not in {}'.format(
+                frame_id, sequence_id, self.root))
+        if self.fmt == 'uint8':
+            return record['prob'], None
+        return _sigmoid(record['logit'].astype(np.float32)), record['entropy']
+
+
+class EnsembleProposalProvider(object):
+    """Entropy-weighted query prior from a deep ensemble of QPN outputs.
+
+    The member logit volumes of a frame are memory-mapped, averaged and turned
+    into an occupancy probability ``p`` in one batched pass on the model's
+    device, or read already fused from a :class:`ProposalStore`. Each voxel
+    query is then weighted by ``1 - 0.5 * H(p)`` where the ensemble predicts
+    occupied and by ``0.5 * H(p)`` elsewhere, ``H`` being the binary entropy.
+    The priors of the last ``cache_size`` frames are kept, which only spares
+    the disk for repeated or adjacent accesses of a frame, e.g. by several
+    models sharing the provider, not across shuffled training epochs.
+
+    Args:
+        root (str): Folder of the member outputs, laid out as
+            ``<root>/<member>/<sequence>/<frame>.npy`` for the ``npy`` format.
+        num_members (int): Number of ensemble members. Default: 5.
+        cache_size (int): Number of frame priors kept on device. Default: 64.
+        fmt (str): ``'npy'`` for per-member logits, ``'store'`` for a
+            :class:`ProposalStore`. Default: 'npy'.
+    """
+
+    def __init__(self, root, num_members=5, cache_size=64, fmt='npy'):
+        assert fmt in ('npy', 'store'), 'unknown proposal format {}'.format(fmt)
+        self.root = root
+        self.num_members = num_members
+        self.cache_size = cache_size
+        self.fmt = fmt
+        self.store = ProposalStore(root) if fmt == 'store' else None
+        self._cache = OrderedDict()
+
+    def member_paths(self, sequence_id, frame_id):
+        """Paths of the member logits of one frame."""
+        filename = str(frame_id).zfill(8) + ".npy"
+        return [
+            os.path.join(self.root, str(i).zfill(2), sequence_id, filename)
+            for i in range(self.num_members)
+        ]
+
+    def load_members(self, sequence_id, frame_id):
+        """Memory-map the member logits of one frame.
+
+        Returns:
+            list[np.memmap]: One ``[1, 2, H, W, Z]`` volume per available member.
+        """
+        members, missing = [], []
+        for path in self.member_paths(sequence_id, frame_id):
+            try:
+                members.append(np.load(path, mmap_mode='r'))
+            except IOError:
+                missing.append(path)
+        if not members:
+            raise IOError('no member proposal of frame {} of sequence {} in {}'.format(
+                frame_id, sequence_id, self.root))
+        if missing:
+            warnings.warn('frame {} of sequence {}: the prior averages {} of {} members, missing {}'.format(
+                frame_id, sequence_id, len(members), self.num_members, ', '.join(missing)))
+        return members
+
+    @staticmethod
+    def compute_prior(logits):
+        """Compute the entropy-weighted query prior.
+
+        Args:
+            logits (Tensor): Member logits with shape [M, B, 2, H, W, Z].
+
+        Returns:
+            Tensor: Query prior with shape [B, H, W, Z].
+        """
+        prob = torch.softmax(logits.mean(0), dim=1)
+        return EnsembleProposalProvider.prior_from_prob(prob[:, 1], occupied=prob[:, 1] > prob[:, 0])
+
+    @staticmethod
+    def prior_from_prob(p, hp=None, occupied=None):
+        """Query prior from the fused occupancy probability ``p``."""
+        if hp is None:
+            hp = -torch.xlogy(p, p) - torch.xlogy(1 - p, 1 - p)
+        if occupied is None:
+            occupied = p > 0.5
+        return torch.where(occupied, 1 - 0.5 * hp, 0.5 * hp)
+
+    def get(self, sequence_id, frame_id, device):
+        """Query prior of one frame, flattened to [H*W*Z]."""
+        key = (sequence_id, str(frame_id))
+        prior = self._cache.get(key)
+        if prior is not None:
+            self._cache.move_to_end(key)
+            return prior
+
+        if self.store is not None:
+            prob, entropy = self.store.load(sequence_id, frame_id)
+            prob = torch.from_numpy(prob).to(device)
+            if self.store.fmt == 'uint8':
+                prior = self.prior_from_prob(prob.float() / 255)
+            else:
+                prior = self.prior_from_prob(prob, torch.from_numpy(entropy).to(device).float())
+        else:
+            logits = torch.from_numpy(np.stack(self.load_members(sequence_id, frame_id)))
+            prior = self.compute_prior(logits.to(device)).reshape(-1)
+
+        if self.cache_size > 0:
+            self._cache[key] = prior
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return prior
+
+    def __call__(self, img_metas, device):
+        """Query priors of a batch.
+
+        Args:
+            img_metas (list[dict]): Meta information with ``sequence_id`` and
+                ``frame_id`` of each sample.
+            device (torch.device): Device of the returned priors.
+
+        Returns:
+            Tensor: Query priors with shape [B, H*W*Z].
+        """
+        return torch.stack([
+            self.get(img_meta['sequence_id'], img_meta['frame_id'], device)
+            for img_meta in img_metas
+        ])
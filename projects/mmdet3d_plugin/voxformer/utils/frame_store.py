@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+
+class FrameStore(object):
+    """Indexed per-sequence container of fixed-size frame records.
+
+    Every sequence is a folder holding one ``part_<rank>.bin`` file per writing
+    process. A part file is a flat array of records whose numpy structured
+    dtype is described in ``<root>/meta.json``, the first field always being
+    the integer frame id. The frame ids of a sequence are indexed once when
+    the sequence is first accessed, after which reading or updating a frame
+    costs a single seek. Updates of an indexed frame are written in place.
+
+    Args:
+        root (str): Root folder of the store.
+        fields (list[tuple], optional): ``(name, dtype, shape)`` of the record
+            fields following the frame id. Read from ``meta.json`` when
+            omitted, written to it when the store is created.
+        attrs (dict, optional): Extra attributes kept in ``meta.json``.
+        rank (int): Rank of the writing process, selects the part file new
+            records are appended to. Default: 0.
+    """
+
+    def __init__(self, root, fields=None, attrs=None, rank=0):
+        self.root = root
+        self.rank = rank
+        meta_path = os.path.join(root, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if fields is not None and self._normalize(fields) != self._normalize(meta['fields']):
+                raise ValueError('fields {} do not match the store at {}: {}'.format(
+                    fields, root, meta['fields']))
+        elif fields is not None:
+            meta = dict(fields=self._normalize(fields), attrs=attrs or {})
+            os.makedirs(root, exist_ok=True)
+            # all ranks write identical content, the rename keeps readers from a partial file
+            tmp_path = '{}.{}.tmp'.format(meta_path, rank)
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+        else:
+            raise IOError('no frame store at {}'.format(root))
+
+        self.fields = meta['fields']
+        self.attrs = meta['attrs']
+        self.dtype = np.dtype([('frame', '<i4')] + [
+            (name, dtype, tuple(shape)) for name, dtype, shape in self.fields])
+        self._index = {}
+
+    @staticmethod
+    def _normalize(fields):
+        return [[name, np.dtype(dtype).str, list(shape)] for name, dtype, shape in fields]
+
+    def sequences(self):
+        """Sequences with at least one stored frame."""
+        return sorted(
+            name for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name)))
+
+    def index(self, sequence_id):
+        """Map of frame id to ``(part path, record position)`` of a sequence."""
+        if sequence_id not in self._index:
+            index = {}
+            for path in sorted(glob.glob(os.path.join(self.root, sequence_id, 'part_*.bin'))):
+                frames = np.memmap(path, dtype=self.dtype, mode='r')['frame']
+                for pos, frame in enumerate(frames.tolist()):
+                    index[frame] = (path, pos)
+            self._index[sequence_id] = index
+        return self._index[sequence_id]
+
+    def frames(self, sequence_id):
+        return sorted(self.index(sequence_id))
+
+    def contains(self, sequence_id, frame_id):
+        return int(frame_id) in self.index(sequence_id)
+
+    def read(self, sequence_id, frame_id, mmap=False):
+        """Read the record of a frame.
+
+        Args:
+            mmap (bool): Memory-map the record instead of reading it, so
+                that only the slices accessed are read from disk.
+
+        Returns:
+            np.void | None: The record, None if the frame is not stored.
+        """
+        loc = self.index(sequence_id).get(int(frame_id))
+        if loc is None:
+            return None
+        path, pos = loc
+        if mmap:
+            return np.memmap(path, dtype=self.dtype, mode='r', offset=pos * self.dtype.itemsize, shape=(1,))[0]
+        return np.fromfile(path, dtype=self.dtype, count=1, offset=pos * self.dtype.itemsize)[0]
+
+    def write(self, sequence_id, frame_id, **values):
+        """Write the record of a frame, in place if it is already stored."""
+        record = np.zeros(1, dtype=self.dtype)
+        record['frame'] = int(frame_id)
+        for name, value in values.items():
+            record[name] = value
+
+        index = self.index(sequence_id)
+        loc = index.get(int(frame_id))
+        if loc is None:
+            path = os.path.join(self.root, sequence_id, 'part_{}.bin'.format(self.rank))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                pos = f.tell() // self.dtype.itemsize
+                f.write(record.tobytes())
+            index[int(frame_id)] = (path, pos)
+        else:
+            path, pos = loc
+            with open(path, 'r+b') as f:
+                f.seek(pos * self.dtype.itemsize)
+                f.write(record.tobytes())
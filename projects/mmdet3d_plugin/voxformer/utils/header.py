@@ -10,15 +10,39 @@ import torch.nn.functional as F
 import numpy as np
 
 class Header(nn.Module):
+    """Upsamples the voxel features twice and classifies every voxel.
+
+    Args:
+        class_num (int): Number of classes.
+        norm_layer: Unused, kept for the config signature.
+        feature (int): Dimension of the voxel features.
+        tile_size (int, optional): At inference, number of output slices
+            along the first axis upsampled and classified at once, the
+            results being written into a preallocated buffer. Peak memory
+            then scales with the tile instead of the full 256x256x32 grid.
+            Default: None, the whole grid at once.
+        output (str): Output at inference, 'logits' (``ssc_logit``), 'prob'
+            (softmax probabilities, ``ssc_prob``) or 'argmax' (uint8 labels,
+            ``ssc_pred``). Training always outputs the logits.
+            Default: 'logits'.
+    """
+
+    OUTPUT_KEYS = dict(logits="ssc_logit", prob="ssc_prob", argmax="ssc_pred")
+
     def __init__(
         self,
         class_num,
         norm_layer,
         feature,
+        tile_size=None,
+        output='logits',
     ):
         super(Header, self).__init__()
+        assert output in self.OUTPUT_KEYS, 'output must be one of {}'.format(list(self.OUTPUT_KEYS))
         self.feature = feature
         self.class_num = class_num
+        self.tile_size = tile_size
+        self.output = output
         self.mlp_head = nn.Sequential(
             nn.LayerNorm(self.feature),
             nn.Linear(self.feature, self.class_num),
@@ -30,16 +54,64 @@ class Header(nn.Module):
     def forward(self, input_dict):
         res = {}
 
-        x3d_l1 = input_dict["x3d"] # [1, 64, 128, 128, 16]
+        x3d_l1 = input_dict["x3d"] # [bs, 64, 128, 128, 16]
 
-        x3d_up_l1 = self.up_scale_2(x3d_l1) # [1, dim, 128, 128, 16] -> [1, dim, 256, 256, 32]
+        if not self.training and self.tile_size is not None:
+            res[self.OUTPUT_KEYS[self.output]] = self.forward_tiled(x3d_l1)
+            return res
 
-        _, feat_dim, w, l, h  = x3d_up_l1.shape
+        x3d_up_l1 = self.up_scale_2(x3d_l1) # [bs, dim, 128, 128, 16] -> [bs, dim, 256, 256, 32]
 
-        x3d_up_l1 = x3d_up_l1.squeeze().permute(1,2,3,0).reshape(-1, feat_dim)
+        bs, feat_dim, w, l, h  = x3d_up_l1.shape
+
+        x3d_up_l1 = x3d_up_l1.permute(0,2,3,4,1).reshape(-1, feat_dim)
 
         ssc_logit_full = self.mlp_head(x3d_up_l1)
 
-        res["ssc_logit"] = ssc_logit_full.reshape(w, l, h, self.class_num).permute(3,0,1,2).unsqueeze(0)
+        ssc_logit = ssc_logit_full.reshape(bs, w, l, h, self.class_num).permute(0,4,1,2,3)
+
+        if self.training or self.output == 'logits':
+            res["ssc_logit"] = ssc_logit
+        elif self.output == 'prob':
+            res["ssc_prob"] = ssc_logit.softmax(1)
+        else:
+            res["ssc_pred"] = ssc_logit.argmax(1).to(torch.uint8)
 
         return res
+
+    def forward_tiled(self, x3d):
+        """Upsample and classify slabs of output slices one at a time.
+
+        The trilinear upsampling with aligned corners is split into a linear
+        interpolation along the first axis, computed for the slices of the
+        tile only, and a bilinear one over the two other axes. The results
+        match the full upsampling up to float rounding.
+        """
+        bs, feat_dim, w, l, h = x3d.shape
+        out_w, out_l, out_h = 2 * w, 2 * l, 2 * h
+        if self.output == 'argmax':
+            out = x3d.new_empty((bs, out_w, out_l, out_h), dtype=torch.uint8)
+        else:
+            out = x3d.new_empty((bs, self.class_num, out_w, out_l, out_h))
+
+        scale = (w - 1) / (out_w - 1)
+        for start in range(0, out_w, self.tile_size):
+            end = min(start + self.tile_size, out_w)
+            src = torch.arange(start, end, device=x3d.device, dtype=torch.float32) * scale
+            low = src.floor().long().clamp(max=w - 1)
+            high = (low + 1).clamp(max=w - 1)
+            lam = (src - low.to(src.dtype)).to(x3d.dtype).view(1, 1, -1, 1, 1)
+
+            slab = x3d[:, :, low] * (1 - lam) + x3d[:, :, high] * lam # [bs, dim, tile, 128, 16]
+            slab = slab.permute(0, 2, 1, 3, 4).reshape(bs * (end - start), feat_dim, l, h)
+            slab = F.interpolate(slab, size=(out_l, out_h), mode='bilinear', align_corners=True)
+            slab = slab.view(bs, end - start, feat_dim, out_l, out_h).permute(0, 1, 3, 4, 2)
+
+            logits = self.mlp_head(slab) # [bs, tile, 256, 32, class_num]
+            if self.output == 'argmax':
+                out[:, start:end] = logits.argmax(-1)
+            elif self.output == 'prob':
+                out[:, :, start:end] = logits.softmax(-1).permute(0, 4, 1, 2, 3)
+            else:
+                out[:, :, start:end] = logits.permute(0, 4, 1, 2, 3)
+        return out
@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+from .frame_store import FrameStore
+
+
+class LogitStore(FrameStore):
+    """Cache of the per-voxel class scores of a test run, with the labels.
+
+    Frames are stored as log-probabilities, the logits minus their
+    log-sum-exp, which leaves the softmax at any temperature and the mean
+    over members of the logits unchanged. Two record formats are supported:
+
+    - ``float16``: log-probabilities clamped at ``-log_range``.
+    - ``uint8``: log-probabilities in [-log_range, 0] quantized to 255 levels,
+      a step of 0.063 for the default range.
+
+    Records are one per frame in per-sequence files and are memory-mapped
+    on read, so that scores can be decoded a slice of voxels at a time.
+
+    Args:
+        root (str): Root folder of the store.
+        fmt (str, optional): ``'float16'`` or ``'uint8'``. Read from the
+            store when omitted.
+        num_classes (int): Number of classes. Default: 20.
+        shape (tuple[int]): Shape of the voxel grid. Default: (256, 256, 32).
+        log_range (float): Lowest stored log-probability, negated.
+            Default: 16.
+        attrs (dict, optional): Extra attributes kept with the store.
+        rank (int): Rank of the writing process. Default: 0.
+    """
+
+    FORMATS = ('float16', 'uint8')
+
+    def __init__(self, root, fmt=None, num_classes=20, shape=(256, 256, 32), log_range=16., attrs=None,
+                 rank=0):
+        fields = None
+        if fmt is not None:
+            assert fmt in self.FORMATS, 'unknown logit format {}'.format(fmt)
+            num_voxels = int(np.prod(shape))
+            fields = [('logit', '<f2' if fmt == 'float16' else 'u1', (num_classes, num_voxels)),
+                      ('target', 'u1', (num_voxels,))]
+            attrs = dict(attrs or {}, fmt=fmt, num_classes=num_classes, shape=list(shape), log_range=log_range)
+        super(LogitStore, self).__init__(root, fields, attrs=attrs, rank=rank)
+        self.fmt = self.attrs['fmt']
+        self.num_classes = self.attrs['num_classes']
+        self.shape = tuple(self.attrs['shape'])
+        self.log_range = self.attrs['log_range']
+
+    def add(self, sequence_id, frame_id, logit, target):
+        """Write the scores of a frame.
+
+        Args:
+            logit (Tensor): Logits or log-probabilities [C, ...], encoded on
+                their device.
+            target (Tensor | np.ndarray): Labels of the frame.
+        """
+        log_prob = logit.float().reshape(self.num_classes, -1).log_softmax(0).clamp_(min=-self.log_range)
+        if self.fmt == 'uint8':
+            log_prob = (log_prob * (-255. / self.log_range)).round_().to(torch.uint8)
+        else:
+            log_prob = log_prob.half()
+        target = torch.as_tensor(target).reshape(-1).to(torch.uint8)
+        self.write(str(sequence_id), frame_id, logit=log_prob.cpu().numpy(), target=target.cpu().numpy())
+
+    def frames(self, sequence_id=None):
+        """Frame ids of a sequence, or ``(sequence_id, frame_id)`` of all frames."""
+        if sequence_id is not None:
+            return super(LogitStore, self).frames(sequence_id)
+        return [(sequence, frame) for sequence in self.sequences() for frame in self.frames(sequence)]
+
+    def load(self, sequence_id, frame_id):
+        """Memory-mapped record of a frame, decoded with :meth:`log_prob`."""
+        record = self.read(str(sequence_id), frame_id, mmap=True)
+        if record is None:
+            raise IOError('frame {} of sequence {} not in {}'.format(frame_id, sequence_id, self.root))
+        return record
+
+    def decode(self, logit, device=None):
+        """Log-probabilities from stored values [C, ...]."""
+        log_prob = torch.from_numpy(np.ascontiguousarray(logit)).to(device)
+        if self.fmt == 'uint8':
+            return log_prob.float() * (-self.log_range / 255.)
+        return log_prob.float()
+
+    def log_prob(self, record, start=0, stop=None, device=None):
+        """Decode the log-probabilities [C, stop - start] of a slice of voxels."""
+        return self.decode(record['logit'][:, start:stop], device)
+
+    def target(self, record, start=0, stop=None, device=None):
+        """Labels of a slice of voxels."""
+        return torch.from_numpy(np.ascontiguousarray(record['target'][start:stop])).to(device)
@@ -0,0 +1,108 @@
+import torch
+
+from .frame_store import FrameStore
+
+
+def entropy(prob, dim=1):
+    """Entropy of class probabilities along ``dim``, 0 log 0 being 0."""
+    return -torch.xlogy(prob, prob).sum(dim)
+
+
+class PredictiveStats(object):
+    """Running per-voxel statistics of sampled class probabilities.
+
+    Samples are the members of an ensemble or the passes of MC-dropout. Only
+    running sums are kept on the device of the samples, so memory does not
+    grow with the number of samples.
+
+    Example:
+        >>> stats = PredictiveStats()
+        >>> for model in members:
+        ...     stats.update(model(x).softmax(1))  # [bs, C, ...]
+        >>> out = stats.summary()
+    """
+
+    def __init__(self):
+        self.num = 0
+        self.sum_prob = None
+        self.sum_sq_prob = None
+        self.sum_entropy = None
+
+    def update(self, prob, stacked=False):
+        """Add a sample of class probabilities.
+
+        Args:
+            prob (Tensor): Probabilities [bs, C, ...], or [S, bs, C, ...]
+                holding S samples when ``stacked``.
+        """
+        prob = prob.float()
+        if stacked:
+            num = prob.size(0)
+            sum_prob, sum_sq_prob = prob.sum(0), (prob * prob).sum(0)
+            sum_entropy = entropy(prob, dim=2).sum(0)
+        else:
+            num = 1
+            sum_prob, sum_sq_prob, sum_entropy = prob, prob * prob, entropy(prob)
+        if self.num == 0:
+            self.sum_prob = sum_prob if stacked else sum_prob.clone()
+            self.sum_sq_prob, self.sum_entropy = sum_sq_prob, sum_entropy
+        else:
+            self.sum_prob += sum_prob
+            self.sum_sq_prob += sum_sq_prob
+            self.sum_entropy += sum_entropy
+        self.num += num
+
+    def mean(self):
+        """Predictive distribution [bs, C, ...], the mean of the samples."""
+        return self.sum_prob / self.num
+
+    def variance(self):
+        """Variance of the class probabilities over the samples [bs, C, ...]."""
+        mean = self.mean()
+        return (self.sum_sq_prob / self.num - mean * mean).clamp_(min=0)
+
+    def summary(self):
+        """Per-voxel summary of the samples.
+
+        Returns:
+            dict[str, Tensor]: With shape [bs, ...]:
+
+                - pred: class of the predictive distribution.
+                - prob: its mean probability.
+                - variance: the variance of its probability over the samples.
+                - entropy: entropy of the predictive distribution.
+                - mutual_info: the entropy minus the mean entropy of the
+                  samples, the part of the uncertainty due to the model.
+        """
+        mean = self.mean()
+        prob, pred = mean.max(1)
+        sq_prob = self.sum_sq_prob.gather(1, pred.unsqueeze(1)).squeeze(1) / self.num
+        predictive_entropy = entropy(mean)
+        return dict(
+            pred=pred,
+            prob=prob,
+            variance=(sq_prob - prob * prob).clamp_(min=0),
+            entropy=predictive_entropy,
+            mutual_info=(predictive_entropy - self.sum_entropy / self.num).clamp_(min=0))
+
+
+# per-voxel fields of a summary in a FrameStore, probabilities and entropies in float16
+SUMMARY_FIELDS = [('pred', 'u1'), ('prob', '<f2'), ('variance', '<f2'), ('entropy', '<f2'), ('mutual_info', '<f2')]
+
+
+def open_summary_store(root, num_voxels=256 * 256 * 32, attrs=None, rank=0):
+    """FrameStore of the flattened fields of PredictiveStats.summary."""
+    fields = [(name, dtype, (num_voxels,)) for name, dtype in SUMMARY_FIELDS]
+    return FrameStore(root, fields, attrs=attrs, rank=rank)
+
+
+def write_summary(store, img_metas, summary, num_frames=None):
+    """Write the summaries of the first ``num_frames`` frames of a batch."""
+    num_frames = len(img_metas) if num_frames is None else num_frames
+    fields = dict()
+    for name, dtype in SUMMARY_FIELDS:
+        value = summary[name][:num_frames].flatten(1)
+        fields[name] = value.to(torch.uint8 if dtype == 'u1' else torch.float16).cpu().numpy()
+    for b in range(num_frames):
+        store.write(str(img_metas[b]['sequence_id']), img_metas[b]['frame_id'],
+                    **{name: value[b] for name, value in fields.items()})
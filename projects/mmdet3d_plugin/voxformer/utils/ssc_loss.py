@@ -12,7 +12,85 @@ def KL_sep(p, target):
     return kl_term
 
 
+def scal_statistics(prob, ssc_target):
+    """Per-class sums of a softmax output over the known voxels.
+
+    The probabilities are masked once, the sums over the voxels of each
+    class are a single scatter of the probability of their label.
+
+    Returns:
+        tuple[Tensor]: Number of known voxels, then per class [C]: the summed
+            probability, the summed probability on the voxels of the class
+            and the number of voxels of the class.
+    """
+    mask = ssc_target != 255
+    p = prob.movedim(1, -1)[mask].float()  # [N, C]
+    target = ssc_target[mask].long()
+    n_classes = p.shape[1]
+    p_true = p.gather(1, target.unsqueeze(1)).squeeze(1)
+    nominator = p.new_zeros(n_classes).index_add_(0, target, p_true)
+    count = torch.bincount(target, minlength=n_classes).to(p.dtype)
+    return p.new_tensor(target.numel()), p.sum(0), nominator, count
+
+
+def _bce_to_one(x):
+    # F.binary_cross_entropy(x, 1), with no check of the range of x
+    return -torch.log(x).clamp(min=-100)
+
+
+def _safe_ratio(nominator, denominator, valid):
+    # the masked terms are 1, neither dividing by 0 nor taking log(0), their gradient would be nan
+    ratio = nominator / torch.where(valid, denominator, torch.ones_like(denominator))
+    return torch.where(valid, ratio, torch.ones_like(ratio))
+
+
+def _masked_bce_to_one(terms):
+    # sum of the terms (value, denominator, valid) whose denominator is valid, 0 if none is
+    loss = 0
+    for value, denominator, valid in terms:
+        loss = loss + torch.where(
+            valid, _bce_to_one(_safe_ratio(value, denominator, valid)), torch.zeros_like(value)).sum()
+    return loss
+
+
+def scal_losses(pred, ssc_target, sem=True, geo=True):
+    """sem_scal_loss and geo_scal_loss from one softmax and one reduction.
+
+    Terms with an empty denominator are left out, so a batch without any
+    known voxel gives zero losses, still part of the graph, instead of nan.
+
+    Returns:
+        tuple[Tensor | None]: The semantic and geometric scal losses, None
+            when not requested.
+    """
+    n, sum_p, nominator, count = scal_statistics(F.softmax(pred, dim=1), ssc_target)
+    negatives = n - count
+    loss_sem = loss_geo = None
+    if sem:
+        # classes without voxel are left out, as are the terms of empty denominators
+        present = count > 0
+        loss_sem = _masked_bce_to_one([
+            (nominator, sum_p, present & (sum_p > 0)),  # precision
+            (nominator, count, present),  # recall
+            (negatives - (sum_p - nominator), negatives, present & (negatives > 0))])  # specificity
+        loss_sem = loss_sem / present.sum().clamp(min=1)
+    if geo:
+        # empty against any other class
+        intersection = negatives[0] - (sum_p[0] - nominator[0])
+        nonempty_p = n - sum_p[0]
+        loss_geo = _masked_bce_to_one([
+            (intersection, nonempty_p, nonempty_p > 0),  # precision
+            (intersection, negatives[0], negatives[0] > 0),  # recall
+            (nominator[0], count[0], count[0] > 0)])  # spec
+    return loss_sem, loss_geo
+
+
 def geo_scal_loss(pred, ssc_target):
+    return scal_losses(pred, ssc_target, sem=False)[1]
+
+
+def _geo_scal_loss_loop(pred, ssc_target):
+    """Reference of geo_scal_loss, used by tools/check_scal_loss.py."""
 
     # Get softmax probabilities
     pred = F.softmax(pred, dim=1)
@@ -61,6 +139,11 @@ def precision_loss(pred, ssc_target):
     )
 
 def sem_scal_loss(pred, ssc_target):
+    return scal_losses(pred, ssc_target, geo=False)[0]
+
+
+def _sem_scal_loss_loop(pred, ssc_target):
+    """Per-class reference of sem_scal_loss, used by tools/check_scal_loss.py."""
     # Get softmax probabilities
     pred = F.softmax(pred, dim=1)
     loss = 0
@@ -2,6 +2,8 @@
 Part of the code is taken from https://github.com/waterljwant/SSC/blob/master/sscMetrics.py
 """
 import numpy as np
+import torch
+import torch.distributed as dist
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 
 def get_iou(iou_sum, cnt_class):
@@ -71,24 +73,39 @@ class SSCMetrics:
         mask = y_true != 255
         if nonempty is not None:
             mask = mask & nonempty
+        hist = self.confusion_matrix(y_pred, y_true, mask)
+
+        # completion and semantics share the confusion matrix unless a surface mask is given
         if nonsurface is not None:
-            mask = mask & nonsurface
-        tp, fp, fn = self.get_score_completion(y_pred, y_true, mask)
+            tp, fp, fn = self.get_score_completion(y_pred, y_true, mask & nonsurface)
+        else:
+            tp, fp, fn = self.completion_from_hist(hist)
 
         self.completion_tp += tp
         self.completion_fp += fp
         self.completion_fn += fn
 
-        mask = y_true != 255
-        if nonempty is not None:
-            mask = mask & nonempty
-        tp_sum, fp_sum, fn_sum = self.get_score_semantic_and_completion(
-            y_pred, y_true, mask
-        )
+        tp_sum, fp_sum, fn_sum = self.semantic_from_hist(hist)
         self.tps += tp_sum
         self.fps += fp_sum
         self.fns += fn_sum
 
+    def all_reduce(self):
+        """Sum the counters over all ranks, a no-op outside distributed runs."""
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+        device = torch.device('cuda', torch.cuda.current_device()) \
+            if dist.get_backend() == 'nccl' else torch.device('cpu')
+        counters = torch.tensor(
+            np.concatenate([
+                [self.completion_tp, self.completion_fp, self.completion_fn, self.count],
+                self.tps, self.fps, self.fns]),
+            dtype=torch.float64, device=device)
+        dist.all_reduce(counters)
+        counters = counters.cpu().numpy()
+        self.completion_tp, self.completion_fp, self.completion_fn, self.count = counters[:4].tolist()
+        self.tps, self.fps, self.fns = np.split(counters[4:], 3)
+
     def get_stats(self):
         if self.completion_tp != 0:
             precision = self.completion_tp / (self.completion_tp + self.completion_fp)
@@ -127,77 +144,79 @@ class SSCMetrics:
         self.iou_ssc = np.zeros(self.n_classes, dtype=np.float32)
         self.cnt_class = np.zeros(self.n_classes, dtype=np.float32)
 
-    def get_score_completion(self, predict, target, nonempty=None):
-        predict = np.copy(predict)
-        target = np.copy(target)
+    def confusion_matrix(self, predict, target, nonempty=None):
+        """Confusion matrix of the voxels selected by nonempty, indexed by [target, predict].
+
+        As in the per-class counting, a voxel whose target is 255 counts as
+        empty in both target and prediction. Labels above the class range
+        fall in bin n_classes and negative labels in bin n_classes + 1, so the
+        matrix has shape (n_classes + 2, n_classes + 2). Torch tensors are
+        counted on their device.
+        """
+        if isinstance(predict, torch.Tensor) or isinstance(target, torch.Tensor):
+            return self._confusion_matrix_torch(predict, target, nonempty)
+
+        n_bins = self.n_classes + 2
+        predict = np.asarray(predict).reshape(-1)
+        target = np.asarray(target).reshape(-1)
+        if nonempty is not None:
+            keep = np.asarray(nonempty).reshape(-1) == 1
+            predict = predict[keep]
+            target = target[keep]
+        ignore = target == 255
+        if not ignore.any():
+            ignore = None
+
+        bins = self._to_bins(target, ignore) * n_bins + self._to_bins(predict, ignore)
+        return np.bincount(bins, minlength=n_bins ** 2).reshape(n_bins, n_bins)
+
+    def _to_bins(self, labels, ignore):
+        labels = labels.astype(np.int64)
+        if ignore is not None:
+            labels[ignore] = 0
+        if labels.size and (labels.min() < 0 or labels.max() >= self.n_classes):
+            labels = np.where(labels < 0, self.n_classes + 1, np.minimum(labels, self.n_classes))
+        return labels
+
+    def _confusion_matrix_torch(self, predict, target, nonempty=None):
+        device = predict.device if isinstance(predict, torch.Tensor) else target.device
+        n_bins = self.n_classes + 2
+        predict = torch.as_tensor(predict, device=device).reshape(-1)
+        target = torch.as_tensor(target, device=device).reshape(-1)
+        if nonempty is not None:
+            keep = torch.as_tensor(nonempty, device=device).reshape(-1) == 1
+            predict = predict[keep]
+            target = target[keep]
+        ignore = target == 255
+
+        bins = self._to_bins_torch(target, ignore) * n_bins + self._to_bins_torch(predict, ignore)
+        hist = torch.bincount(bins, minlength=n_bins ** 2).reshape(n_bins, n_bins)
+        return hist.cpu().numpy()
+
+    def _to_bins_torch(self, labels, ignore):
+        labels = labels.long().masked_fill(ignore, 0)
+        return labels.clamp(max=self.n_classes).masked_fill(labels < 0, self.n_classes + 1)
+
+    def completion_from_hist(self, hist):
+        """TP, FP and FN of occupancy, i.e. any label above 0 vs. the rest."""
+        occupied = np.zeros(hist.shape[0], dtype=bool)
+        occupied[1:self.n_classes + 1] = True
+        tp = hist[occupied][:, occupied].sum()
+        fp = hist[~occupied][:, occupied].sum()
+        fn = hist[occupied][:, ~occupied].sum()
+        return int(tp), int(fp), int(fn)
+
+    def semantic_from_hist(self, hist):
+        """Per-class TP, FP and FN."""
+        _C = self.n_classes
+        tp_sum = np.diag(hist)[:_C]
+        fp_sum = hist.sum(0)[:_C] - tp_sum
+        fn_sum = hist.sum(1)[:_C] - tp_sum
+        return tp_sum, fp_sum, fn_sum
 
+    def get_score_completion(self, predict, target, nonempty=None):
         """for scene completion, treat the task as two-classes problem, just empty or occupancy"""
-        _bs = predict.shape[0]  # batch size
-        # ---- ignore
-        predict[target == 255] = 0
-        target[target == 255] = 0
-        # ---- flatten
-        target = target.reshape(_bs, -1)  # (_bs, 129600)
-        predict = predict.reshape(_bs, -1)  # (_bs, _C, 129600), 60*36*60=129600
-        # ---- treat all non-empty object class as one category, set them to label 1
-        b_pred = np.zeros(predict.shape)
-        b_true = np.zeros(target.shape)
-        b_pred[predict > 0] = 1
-        b_true[target > 0] = 1
-        p, r, iou = 0.0, 0.0, 0.0
-        tp_sum, fp_sum, fn_sum = 0, 0, 0
-        for idx in range(_bs):
-            y_true = b_true[idx, :]  # GT
-            y_pred = b_pred[idx, :]
-            if nonempty is not None:
-                nonempty_idx = nonempty[idx, :].reshape(-1)
-                y_true = y_true[nonempty_idx == 1]
-                y_pred = y_pred[nonempty_idx == 1]
-
-            tp = np.array(np.where(np.logical_and(y_true == 1, y_pred == 1))).size
-            fp = np.array(np.where(np.logical_and(y_true != 1, y_pred == 1))).size
-            fn = np.array(np.where(np.logical_and(y_true == 1, y_pred != 1))).size
-            tp_sum += tp
-            fp_sum += fp
-            fn_sum += fn
-        return tp_sum, fp_sum, fn_sum
+        return self.completion_from_hist(self.confusion_matrix(predict, target, nonempty))
 
     def get_score_semantic_and_completion(self, predict, target, nonempty=None):
-        target = np.copy(target)
-        predict = np.copy(predict)
-        _bs = predict.shape[0]  # batch size
-        _C = self.n_classes  # _C = 12
-        # ---- ignore
-        predict[target == 255] = 0
-        target[target == 255] = 0
-        # ---- flatten
-        target = target.reshape(_bs, -1)  # (_bs, 129600)
-        predict = predict.reshape(_bs, -1)  # (_bs, 129600), 60*36*60=129600
-
-        cnt_class = np.zeros(_C, dtype=np.int32)  # count for each class
-        iou_sum = np.zeros(_C, dtype=np.float32)  # sum of iou for each class
-        tp_sum = np.zeros(_C, dtype=np.int32)  # tp
-        fp_sum = np.zeros(_C, dtype=np.int32)  # fp
-        fn_sum = np.zeros(_C, dtype=np.int32)  # fn
-
-        for idx in range(_bs):
-            y_true = target[idx, :]  # GT
-            y_pred = predict[idx, :]
-            if nonempty is not None:
-                nonempty_idx = nonempty[idx, :].reshape(-1)
-                y_pred = y_pred[
-                    np.where(np.logical_and(nonempty_idx == 1, y_true != 255))
-                ]
-                y_true = y_true[
-                    np.where(np.logical_and(nonempty_idx == 1, y_true != 255))
-                ]
-            for j in range(_C):  # for each class
-                tp = np.array(np.where(np.logical_and(y_true == j, y_pred == j))).size
-                fp = np.array(np.where(np.logical_and(y_true != j, y_pred == j))).size
-                fn = np.array(np.where(np.logical_and(y_true == j, y_pred != j))).size
-
-                tp_sum[j] += tp
-                fp_sum[j] += fp
-                fn_sum[j] += fn
-
-        return tp_sum, fp_sum, fn_sum
+        return self.semantic_from_hist(self.confusion_matrix(predict, target, nonempty))
@@ -0,0 +1,126 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class UQMetrics(object):
+    """Streaming uncertainty metrics of class probabilities.
+
+    Per-voxel NLL and Brier score are summed, and the confidences are
+    histogrammed in ``n_bins`` equal-width bins, both for the top label (ECE)
+    and for every class (marginal ECE). Everything is accumulated in float64
+    on the device of the probabilities, so frames are folded in without
+    copying them to the host. Voxels labeled ``ignore_index`` are skipped.
+
+    The marginal ECE uses fixed-width bins and the L1 norm, so it is not the
+    debiased, equal-mass estimate of the ``calibration`` package.
+
+    Args:
+        n_classes (int): Number of classes.
+        n_bins (int): Number of confidence bins. Default: 15.
+        ignore_index (int): Label of unknown voxels. Default: 255.
+    """
+
+    eps = 1e-12
+
+    def __init__(self, n_classes, n_bins=15, ignore_index=255):
+        self.n_classes = n_classes
+        self.n_bins = n_bins
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self):
+        self.counters = None
+
+    def _init_counters(self, device):
+        # count, nll, brier | top-label count, conf, acc | per-class conf, acc
+        size = 3 + 3 * self.n_bins + 2 * self.n_classes * self.n_bins
+        self.counters = torch.zeros(size, dtype=torch.float64, device=device)
+
+    def _split(self, counters):
+        # views of the counters, tensors or arrays
+        n = self.n_bins
+        return counters[:3], counters[3:3 + 3 * n].reshape(3, n), counters[3 + 3 * n:].reshape(2, -1)
+
+    def add_batch(self, prob, target):
+        """Add a batch of probabilities.
+
+        Args:
+            prob (Tensor): Class probabilities [bs, C, ...].
+            target (Tensor | np.ndarray): Labels [bs, ...], moved to the
+                device of ``prob``.
+        """
+        if self.counters is None:
+            self._init_counters(prob.device)
+        target = torch.as_tensor(target, device=prob.device)
+        n_bins, n_classes = self.n_bins, self.n_classes
+        classes = torch.arange(n_classes, device=prob.device).unsqueeze(1)
+        frame = torch.zeros_like(self.counters)
+        totals, top, cls = self._split(frame)
+        # one frame at a time bounds the temporary copies
+        for p, t in zip(prob, target):
+            t = t.reshape(-1).long()
+            keep = t != self.ignore_index
+            t = t[keep]
+            p = p.reshape(n_classes, -1)[:, keep].float()  # [C, N]
+            if t.numel() == 0:
+                continue
+            p_true = p.gather(0, t.unsqueeze(0)).squeeze(0)
+            totals[0] += t.numel()
+            totals[1] += -torch.log(p_true.clamp(min=self.eps)).double().sum()
+            # squared distance to the one-hot label, in [0, 2]
+            totals[2] += ((p * p).sum(0) - 2 * p_true + 1).double().sum()
+
+            conf, pred = p.max(0)
+            bins = (conf * n_bins).long().clamp_(max=n_bins - 1)
+            top[0] += torch.bincount(bins, minlength=n_bins).double()
+            top[1] += torch.bincount(bins, weights=conf, minlength=n_bins).double()
+            top[2] += torch.bincount(bins, weights=(pred == t).float(), minlength=n_bins).double()
+
+            # bins of class c are offset by c * n_bins
+            bins = ((p * n_bins).long().clamp_(max=n_bins - 1) + classes * n_bins).view(-1)
+            cls[0] += torch.bincount(bins, weights=p.view(-1), minlength=n_classes * n_bins).double()
+            cls[1] += torch.bincount(bins, weights=(t.unsqueeze(0) == classes).float().view(-1),
+                                     minlength=n_classes * n_bins).double()
+        self.counters += frame
+
+    def all_reduce(self):
+        """Sum the counters over all ranks, a no-op outside distributed runs."""
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+        if self.counters is None:
+            # ranks without any frame still take part in the reduction
+            self._init_counters(torch.device('cuda', torch.cuda.current_device())
+                                if dist.get_backend() == 'nccl' else torch.device('cpu'))
+        dist.all_reduce(self.counters)
+
+    def get_stats(self):
+        """Dataset-level metrics.
+
+        Returns:
+            dict: ``count`` of evaluated voxels, mean ``nll`` and ``brier``
+                score, ``ece``, ``marginal_ece`` averaged over the classes,
+                and the reliability diagram of the top label as per-bin
+                ``bin_count``, ``bin_confidence`` and ``bin_accuracy``.
+        """
+        if self.counters is None:
+            self._init_counters(torch.device('cpu'))
+        totals, top, cls = self._split(self.counters.cpu().numpy())
+        count, nll, brier = totals.tolist()
+        cls = cls.reshape(2, self.n_classes, self.n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {
+                'count': count,
+                'nll': nll / count if count else np.nan,
+                'brier': brier / count if count else np.nan,
+                'ece': np.abs(top[2] - top[1]).sum() / count if count else np.nan,
+                'marginal_ece': np.abs(cls[1] - cls[0]).sum(1).mean() / count if count else np.nan,
+                'bin_count': top[0],
+                'bin_confidence': top[1] / top[0],
+                'bin_accuracy': top[2] / top[0],
+            }
+
+
+def print_uq_stats(stats):
+    print('NLL {:.4f} Brier {:.4f} ECE {:.4f} marginal ECE {:.4f} over {:d} voxels'.format(
+        stats['nll'], stats['brier'], stats['ece'], stats['marginal_ece'], int(stats['count'])))
@@ -0,0 +1,94 @@
+"""
+Bit packing of binary voxel grids, as in the SemanticKITTI .invalid, .occluded,
+.pseudo and .query files: one bit per voxel, most significant bit first.
+"""
+import numpy as np
+import torch
+
+_LUTS = {}
+
+
+def _lut(dtype):
+    """[256, 8] table of the bits of every byte value, in the given dtype."""
+    dtype = np.dtype(dtype)
+    if dtype not in _LUTS:
+        _LUTS[dtype] = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(dtype)
+    return _LUTS[dtype]
+
+
+def pack(array):
+    """ convert a boolean array into a bitwise array. """
+    return np.packbits(np.asarray(array).reshape(-1))
+
+
+def unpack(compressed, out=None, dtype=np.uint8):
+    """ given a bit encoded voxel grid, make a normal voxel grid out of it.
+
+    Args:
+        compressed (np.ndarray): Bitwise array of uint8.
+        out (np.ndarray | torch.Tensor, optional): Contiguous buffer of
+            ``8 * compressed.size`` elements the voxels are decoded into.
+            CUDA tensors are decoded on their device.
+        dtype (np.dtype): Dtype of the returned grid when out is not given.
+            Default: np.uint8.
+
+    Returns:
+        np.ndarray | torch.Tensor: The flattened voxel grid, out if given.
+    """
+    compressed = np.asarray(compressed, dtype=np.uint8).reshape(-1)
+    if out is None:
+        if np.dtype(dtype) == np.uint8:
+            return np.unpackbits(compressed)
+        out = np.empty(compressed.size * 8, dtype=dtype)
+    elif isinstance(out, torch.Tensor):
+        if out.is_cuda:
+            return unpack_torch(compressed, out=out)
+        np_out = out.numpy()
+        unpack(compressed, out=np_out)
+        return out
+
+    assert out.flags.c_contiguous and out.size == compressed.size * 8
+    # one table lookup per byte writes its 8 voxels straight into the buffer
+    np.take(_lut(out.dtype), compressed, axis=0, out=out.reshape(compressed.size, 8))
+    return out
+
+
+def unpack_torch(compressed, device=None, dtype=torch.uint8, out=None):
+    """Decode bitwise bytes on a device, only the packed bytes are transferred.
+
+    Args:
+        compressed (np.ndarray | torch.Tensor): Bitwise array of uint8, with
+            an optional leading batch dimension.
+        device (torch.device, optional): Device to decode on, the device of
+            out or compressed by default.
+        dtype (torch.dtype): Dtype of the returned grid when out is not given.
+            Default: torch.uint8.
+        out (torch.Tensor, optional): Buffer the voxels are decoded into.
+
+    Returns:
+        torch.Tensor: The voxel grid with shape [..., 8 * num_bytes].
+    """
+    if not isinstance(compressed, torch.Tensor):
+        compressed = torch.from_numpy(np.asarray(compressed, dtype=np.uint8))
+    if device is None:
+        device = out.device if out is not None else compressed.device
+    compressed = compressed.to(device, non_blocking=True)
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=device)
+    bits = (compressed.unsqueeze(-1) >> shifts) & 1
+    bits = bits.reshape(*compressed.shape[:-1], compressed.shape[-1] * 8)
+    if out is not None:
+        out.view(bits.shape).copy_(bits)
+        return out
+    return bits.to(dtype)
+
+
+def read_occupancy(path, out=None, dtype=np.float32):
+    """Read and decode a bitwise voxel file.
+
+    Args:
+        path (str): Path of the file.
+        out (np.ndarray | torch.Tensor, optional): Buffer to decode into.
+        dtype (np.dtype): Dtype of the returned grid when out is not given.
+            Default: np.float32.
+    """
+    return unpack(np.fromfile(path, dtype=np.uint8), out=out, dtype=dtype)
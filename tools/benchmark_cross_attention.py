@@ -0,0 +1,139 @@
+"""Micro-benchmark of DeformCrossAttention against the former per-camera loops.
+
+Queries are drawn uniformly in the 128x128x16 grid of stage-2 and projected
+with random camera hits, each camera seeing a fraction of the queries as the
+temporal frames of ``voxformer-T`` do. Both implementations share the same
+weights and inputs, their outputs are compared.
+
+    python tools/benchmark_cross_attention.py --num-cams 1 3 5 --num-queries 10000 50000 262144
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.modules.deformable_cross_attention import DeformCrossAttention  # noqa: E402
+
+
+class LegacyDeformCrossAttention(DeformCrossAttention):
+    """Per-sample and per-camera loops, as DeformCrossAttention did before the packed indices."""
+
+    def forward(self, query, key, value, residual=None, query_pos=None, key_padding_mask=None,
+                reference_points=None, spatial_shapes=None, reference_points_cam=None,
+                bev_mask=None, level_start_index=None, flag='encoder', **kwargs):
+        inp_residual = query
+        slots = torch.zeros_like(query)
+        if query_pos is not None:
+            query = query + query_pos
+
+        bs, num_query, _ = query.size()
+
+        D = reference_points_cam.size(3)
+        indexes = [[mask_per_img[j].sum(-1).nonzero().squeeze(-1) for mask_per_img in bev_mask]
+                   for j in range(bs)]
+        max_len = max([len(each) for indexes_per_sample in indexes for each in indexes_per_sample])
+
+        queries_rebatch = query.new_zeros([bs, self.num_cams, max_len, self.embed_dims])
+        reference_points_rebatch = reference_points_cam.new_zeros([bs, self.num_cams, max_len, D, 2])
+        for j in range(bs):
+            for i, reference_points_per_img in enumerate(reference_points_cam):
+                index_query_per_img = indexes[j][i]
+                queries_rebatch[j, i, :len(index_query_per_img)] = query[j, index_query_per_img]
+                reference_points_rebatch[j, i, :len(index_query_per_img)] = \
+                    reference_points_per_img[j, index_query_per_img]
+
+        num_cams, l, bs, embed_dims = key.shape
+        key = key.permute(2, 0, 1, 3).reshape(bs * self.num_cams, l, self.embed_dims)
+        value = value.permute(2, 0, 1, 3).reshape(bs * self.num_cams, l, self.embed_dims)
+
+        queries = self.deformable_attention(
+            query=queries_rebatch.view(bs * self.num_cams, max_len, self.embed_dims), key=key, value=value,
+            reference_points=reference_points_rebatch.view(bs * self.num_cams, max_len, D, 2),
+            spatial_shapes=spatial_shapes, level_start_index=level_start_index,
+        ).view(bs, self.num_cams, max_len, self.embed_dims)
+        for j in range(bs):
+            for i, index_query_per_img in enumerate(indexes[j]):
+                slots[j, index_query_per_img] += queries[j, i, :len(index_query_per_img)]
+
+        count = bev_mask.sum(-1) > 0
+        count = count.permute(1, 2, 0).sum(-1)
+        count = torch.clamp(count, min=1.0)
+        slots = slots / count[..., None]
+        slots = self.output_proj(slots)
+
+        return self.dropout(slots) + inp_residual
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark DeformCrossAttention')
+    parser.add_argument('--num-cams', type=int, nargs='+', default=[1, 2, 3, 4, 5])
+    parser.add_argument('--num-queries', type=int, nargs='+', default=[10000, 50000, 262144])
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--embed-dims', type=int, default=128)
+    parser.add_argument('--num-points', type=int, default=8)
+    parser.add_argument('--feat-size', type=int, nargs=2, default=[24, 77], metavar=('H', 'W'),
+                        help='size of the 1/16 image features')
+    parser.add_argument('--hit-ratio', type=float, default=0.4,
+                        help='fraction of the queries projected into each camera')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def build_inputs(args, num_cams, num_query, device):
+    g = torch.Generator().manual_seed(0)
+    bs, C, D = args.batch_size, args.embed_dims, 1
+    h, w = args.feat_size
+    query = torch.randn(bs, num_query, C, generator=g)
+    query_pos = torch.randn(bs, num_query, C, generator=g)
+    feats = torch.randn(num_cams, h * w, bs, C, generator=g)
+    reference_points_cam = torch.rand(num_cams, bs, num_query, D, 2, generator=g)
+    bev_mask = torch.rand(num_cams, bs, num_query, D, generator=g) < args.hit_ratio
+    inputs = dict(
+        query=query, key=feats, value=feats, query_pos=query_pos,
+        reference_points_cam=reference_points_cam, bev_mask=bev_mask,
+        spatial_shapes=torch.tensor([[h, w]]), level_start_index=torch.tensor([0]))
+    return {name: tensor.to(device) for name, tensor in inputs.items()}
+
+
+def run(module, inputs, repeat, device):
+    with torch.no_grad():
+        output = module(**inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            output = module(**inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, output
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    print('{:>5s} {:>8s} {:>12s} {:>12s} {:>8s}  {}'.format(
+        'cams', 'queries', 'loops (ms)', 'packed (ms)', 'speedup', 'max abs diff'))
+    for num_cams in args.num_cams:
+        cfg = dict(
+            embed_dims=args.embed_dims, num_cams=num_cams, dropout=0.,
+            deformable_attention=dict(
+                type='MSDeformableAttention3D', embed_dims=args.embed_dims,
+                num_points=args.num_points, num_levels=1))
+        packed = DeformCrossAttention(**cfg).to(device).eval()
+        legacy = LegacyDeformCrossAttention(**cfg).to(device).eval()
+        legacy.load_state_dict(packed.state_dict())
+        for num_query in args.num_queries:
+            inputs = build_inputs(args, num_cams, num_query, device)
+            legacy_time, legacy_out = run(legacy, inputs, args.repeat, device)
+            packed_time, packed_out = run(packed, inputs, args.repeat, device)
+            print('{:>5d} {:>8d} {:>12.2f} {:>12.2f} {:>7.2f}x  {:.2e}'.format(
+                num_cams, num_query, legacy_time * 1000, packed_time * 1000,
+                legacy_time / packed_time, (legacy_out - packed_out).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
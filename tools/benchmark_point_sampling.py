@@ -0,0 +1,134 @@
+"""Memory and time of VoxFormerEncoder.point_sampling against the former repeat-based projection.
+
+The encoder of the cross transformer is built from a stage-2 config and fed
+the reference points of the full 128x128x16 grid. Every camera gets the
+KITTI projection of the left color camera, shifted a little per temporal
+frame. Peak memory is measured on CUDA devices only.
+
+    python tools/benchmark_point_sampling.py projects/configs/voxformer/voxformer-T.py --num-cams 1 2 3 4 5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from mmcv import Config
+from mmcv.cnn.bricks.transformer import build_transformer_layer_sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.modules.encoder import VoxFormerEncoder  # noqa: E402
+
+
+class LegacyVoxFormerEncoder(VoxFormerEncoder):
+    """Projection with repeated matrices and points, as point_sampling did before the einsum."""
+
+    def point_sampling(self, reference_points, pc_range, img_metas):
+        lidar2img = reference_points.new_tensor(np.asarray([img_meta['lidar2img'] for img_meta in img_metas]))
+        reference_points = reference_points.clone()
+        for i in range(3):
+            reference_points[..., i:i + 1] = reference_points[..., i:i + 1] * \
+                (pc_range[i + 3] - pc_range[i]) + pc_range[i]
+        reference_points = torch.cat((reference_points, torch.ones_like(reference_points[..., :1])), -1)
+
+        reference_points = reference_points.permute(1, 0, 2, 3)
+        D, B, num_query = reference_points.size()[:3]
+        num_cam = lidar2img.size(1)
+        reference_points = reference_points.view(D, B, 1, num_query, 4).repeat(1, 1, num_cam, 1, 1).unsqueeze(-1)
+        lidar2img = lidar2img.view(1, B, num_cam, 1, 4, 4).repeat(D, 1, 1, num_query, 1, 1)
+        reference_points_cam = torch.matmul(lidar2img.to(torch.float32),
+                                            reference_points.to(torch.float32)).squeeze(-1)
+        eps = 1e-5
+        bev_mask = (reference_points_cam[..., 2:3] > eps)
+        reference_points_cam = reference_points_cam[..., 0:2] / torch.maximum(
+            reference_points_cam[..., 2:3], torch.ones_like(reference_points_cam[..., 2:3]) * eps)
+        reference_points_cam[..., 0] /= img_metas[0]['img_shape'][0][1]
+        reference_points_cam[..., 1] /= img_metas[0]['img_shape'][0][0]
+        bev_mask = (bev_mask & (reference_points_cam[..., 1:2] > 0.0)
+                    & (reference_points_cam[..., 1:2] < 1.0)
+                    & (reference_points_cam[..., 0:1] < 1.0)
+                    & (reference_points_cam[..., 0:1] > 0.0))
+        bev_mask = torch.nan_to_num(bev_mask)
+        reference_points_cam = reference_points_cam.permute(2, 1, 3, 0, 4)
+        bev_mask = bev_mask.permute(2, 1, 3, 0, 4).squeeze(-1)
+        return reference_points_cam, bev_mask
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark VoxFormerEncoder.point_sampling')
+    parser.add_argument('config', help='stage-2 config the cross transformer encoder is built from')
+    parser.add_argument('--num-cams', type=int, nargs='+', default=[1, 2, 3, 4, 5])
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def kitti_lidar2img(num_cams, shift=0.5):
+    """lidar2img of the KITTI left color camera, moved back along x for every temporal frame."""
+    cam_k = np.eye(4)
+    cam_k[:3, :3] = [[707.09, 0., 601.89], [0., 707.09, 183.11], [0., 0., 1.]]
+    velo2cam = np.array([[0., -1., 0., 0.], [0., 0., -1., -0.08], [1., 0., 0., -0.27], [0., 0., 0., 1.]])
+    mats = []
+    for i in range(num_cams):
+        move = np.eye(4)
+        move[0, 3] = i * shift
+        mats.append(cam_k @ velo2cam @ move)
+    return np.stack(mats)
+
+
+def grid_reference_points(bs, device):
+    xs, ys, zs = torch.meshgrid(torch.arange(128), torch.arange(128), torch.arange(16))
+    ref_3d = torch.stack([(xs + 0.5) / 128, (ys + 0.5) / 128, (zs + 0.5) / 16], -1).reshape(-1, 3)
+    return ref_3d.to(device, torch.float64)[None, None].expand(bs, 1, -1, -1)
+
+
+def run(encoder, ref_3d, img_metas, repeat, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    with torch.no_grad():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs = encoder.point_sampling(ref_3d, encoder.pc_range, img_metas)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / repeat
+    peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return seconds, peak, outputs
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    cfg = Config.fromfile(args.config)
+    encoder_cfg = cfg.model.pts_bbox_head.cross_transformer.encoder
+    encoder = build_transformer_layer_sequence(encoder_cfg).to(device).eval()
+    legacy_cfg = encoder_cfg.copy()
+    legacy_cfg.pop('type')
+    legacy = LegacyVoxFormerEncoder(**legacy_cfg).to(device).eval()
+    ref_3d = grid_reference_points(args.batch_size, device)
+
+    print('{} queries, peak memory above the inputs{}'.format(
+        ref_3d.shape[2], '' if device.type == 'cuda' else ' (not measured on cpu)'))
+    print('{:>5s} {:>12s} {:>12s} {:>12s} {:>12s}  {}'.format(
+        'cams', 'repeat (MB)', 'einsum (MB)', 'repeat (ms)', 'einsum (ms)', 'max abs diff / mask mismatches'))
+    for num_cams in args.num_cams:
+        img_metas = [dict(lidar2img=kitti_lidar2img(num_cams), img_shape=[(370, 1220, 3)] * num_cams)
+                     for _ in range(args.batch_size)]
+        legacy_time, legacy_peak, (legacy_cam, legacy_mask) = run(legacy, ref_3d, img_metas, args.repeat, device)
+        del legacy_cam, legacy_mask
+        new_time, new_peak, (new_cam, new_mask) = run(encoder, ref_3d, img_metas, args.repeat, device)
+        _, _, (legacy_cam, legacy_mask) = run(legacy, ref_3d, img_metas, 1, device)
+        valid = new_mask & legacy_mask
+        diff = (new_cam - legacy_cam)[valid].abs().max().item() if valid.any() else 0.
+        print('{:>5d} {:>12.1f} {:>12.1f} {:>12.2f} {:>12.2f}  {:.2e} / {}'.format(
+            num_cams, legacy_peak, new_peak, legacy_time * 1000, new_time * 1000,
+            diff, int((new_mask != legacy_mask).sum())))
+        del legacy_cam, legacy_mask, new_cam, new_mask
+
+
+if __name__ == '__main__':
+    main()
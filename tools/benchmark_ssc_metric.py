@@ -0,0 +1,161 @@
+"""Micro-benchmark of SSCMetrics against the former per-class implementation.
+
+Labels are read from the preprocessed ``<label-root>/<sequence>/*_1_1.npy``
+volumes when given, otherwise random scenes are drawn. Predictions are the
+labels with a fraction of the voxels replaced by random classes.
+
+    python tools/benchmark_ssc_metric.py --label-root ./kitti/dataset/labels --sequence 08
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics  # noqa: E402
+
+
+class LegacySSCMetrics(SSCMetrics):
+    """Per-class np.where counting, as SSCMetrics did before the confusion matrix."""
+
+    def add_batch(self, y_pred, y_true, nonempty=None, nonsurface=None):
+        self.count += 1
+        mask = y_true != 255
+        tp, fp, fn = self.get_score_completion(y_pred, y_true, mask)
+        self.completion_tp += tp
+        self.completion_fp += fp
+        self.completion_fn += fn
+        tp_sum, fp_sum, fn_sum = self.get_score_semantic_and_completion(y_pred, y_true, mask)
+        self.tps += tp_sum
+        self.fps += fp_sum
+        self.fns += fn_sum
+
+    def get_score_completion(self, predict, target, nonempty=None):
+        predict = np.copy(predict)
+        target = np.copy(target)
+        _bs = predict.shape[0]
+        predict[target == 255] = 0
+        target[target == 255] = 0
+        target = target.reshape(_bs, -1)
+        predict = predict.reshape(_bs, -1)
+        b_pred = np.zeros(predict.shape)
+        b_true = np.zeros(target.shape)
+        b_pred[predict > 0] = 1
+        b_true[target > 0] = 1
+        tp_sum, fp_sum, fn_sum = 0, 0, 0
+        for idx in range(_bs):
+            y_true = b_true[idx, :]
+            y_pred = b_pred[idx, :]
+            if nonempty is not None:
+                nonempty_idx = nonempty[idx, :].reshape(-1)
+                y_true = y_true[nonempty_idx == 1]
+                y_pred = y_pred[nonempty_idx == 1]
+            tp_sum += np.array(np.where(np.logical_and(y_true == 1, y_pred == 1))).size
+            fp_sum += np.array(np.where(np.logical_and(y_true != 1, y_pred == 1))).size
+            fn_sum += np.array(np.where(np.logical_and(y_true == 1, y_pred != 1))).size
+        return tp_sum, fp_sum, fn_sum
+
+    def get_score_semantic_and_completion(self, predict, target, nonempty=None):
+        target = np.copy(target)
+        predict = np.copy(predict)
+        _bs = predict.shape[0]
+        _C = self.n_classes
+        predict[target == 255] = 0
+        target[target == 255] = 0
+        target = target.reshape(_bs, -1)
+        predict = predict.reshape(_bs, -1)
+        tp_sum = np.zeros(_C, dtype=np.int32)
+        fp_sum = np.zeros(_C, dtype=np.int32)
+        fn_sum = np.zeros(_C, dtype=np.int32)
+        for idx in range(_bs):
+            y_true = target[idx, :]
+            y_pred = predict[idx, :]
+            if nonempty is not None:
+                nonempty_idx = nonempty[idx, :].reshape(-1)
+                keep = np.where(np.logical_and(nonempty_idx == 1, y_true != 255))
+                y_pred = y_pred[keep]
+                y_true = y_true[keep]
+            for j in range(_C):
+                tp_sum[j] += np.array(np.where(np.logical_and(y_true == j, y_pred == j))).size
+                fp_sum[j] += np.array(np.where(np.logical_and(y_true != j, y_pred == j))).size
+                fn_sum[j] += np.array(np.where(np.logical_and(y_true == j, y_pred != j))).size
+        return tp_sum, fp_sum, fn_sum
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark SSCMetrics')
+    parser.add_argument('--label-root', help='root of the preprocessed labels')
+    parser.add_argument('--sequence', default='08')
+    parser.add_argument('--num-frames', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=0.3,
+                        help='fraction of voxels given a random class in the predictions')
+    parser.add_argument('--n-classes', type=int, default=20)
+    parser.add_argument('--skip-legacy', action='store_true')
+    return parser.parse_args()
+
+
+def load_frames(args):
+    rng = np.random.RandomState(0)
+    if args.label_root is not None:
+        paths = sorted(glob.glob(os.path.join(args.label_root, args.sequence, '*_1_1.npy')))
+        paths = paths[:args.num_frames]
+        targets = [np.load(path).reshape(1, 256, 256, 32) for path in paths]
+    else:
+        targets = []
+        for _ in range(args.num_frames):
+            target = rng.randint(0, args.n_classes, size=(1, 256, 256, 32)).astype(np.float32)
+            target[rng.rand(*target.shape) < 0.6] = 0
+            target[rng.rand(*target.shape) < 0.1] = 255
+            targets.append(target)
+
+    frames = []
+    for target in targets:
+        pred = np.where(target == 255, 0, target).astype(np.uint8)
+        noise = rng.rand(*pred.shape) < args.noise
+        pred[noise] = rng.randint(0, args.n_classes, size=int(noise.sum()))
+        frames.append((pred, target))
+    return frames
+
+
+def run(metric, frames, to_device=None):
+    metric.reset()
+    if to_device is not None:
+        frames = [(to_device(pred), to_device(target)) for pred, target in frames]
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for pred, target in frames:
+        metric.add_batch(pred, target)
+    stats = metric.get_stats()
+    return (time.perf_counter() - start) / len(frames), stats, metric
+
+
+def main():
+    args = parse_args()
+    frames = load_frames(args)
+    print('{} frames of {} voxels'.format(len(frames), frames[0][1].size))
+
+    runs = [('numpy bincount', SSCMetrics(args.n_classes), None)]
+    if torch.cuda.is_available():
+        runs.append(('torch bincount (cuda)', SSCMetrics(args.n_classes),
+                     lambda x: torch.from_numpy(x).cuda()))
+    if not args.skip_legacy:
+        runs.insert(0, ('legacy per-class', LegacySSCMetrics(args.n_classes), None))
+
+    reference = None
+    for name, metric, to_device in runs:
+        seconds, stats, metric = run(metric, frames, to_device)
+        counters = (metric.completion_tp, metric.completion_fp, metric.completion_fn,
+                    metric.tps.tolist(), metric.fps.tolist(), metric.fns.tolist())
+        if reference is None:
+            reference = counters
+        match = 'identical' if counters == reference else 'MISMATCH'
+        print('{:<24s} {:8.2f} ms/frame  mIoU {:.4f}  IoU {:.4f}  counters {}'.format(
+            name, seconds * 1000, stats['iou_ssc_mean'], stats['iou'], match))
+
+
+if __name__ == '__main__':
+    main()
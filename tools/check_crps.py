@@ -0,0 +1,114 @@
+"""Check the torch CRPS against properscoring and time both.
+
+crps_ensemble is compared with properscoring.crps_ensemble on random
+ensembles, with the members along the last and a middle dimension and with
+deterministic forecasts. categorical_crps is compared with the energy form
+summed over all pairs of classes.
+
+    python tools/check_crps.py
+    python tools/check_crps.py --device cuda --num-voxels 2097152 --num-members 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.utils.crps import categorical_crps, crps_ensemble  # noqa: E402
+
+try:
+    import properscoring
+except ImportError:
+    properscoring = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the torch CRPS against properscoring')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--num-voxels', type=int, default=256 * 256 * 32 // 8,
+                        help='observations of the timed ensemble')
+    parser.add_argument('--num-members', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='observations scored at once, 2 ** 24 / members ** 2 by default')
+    return parser.parse_args()
+
+
+def report(name, a, b, tol):
+    diff = np.abs(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)).max()
+    print('  {:<32s} max abs diff {:.3e} {}'.format(name, diff, 'ok' if diff < tol else 'MISMATCH'))
+    return diff < tol
+
+
+def categorical_reference(prob, target):
+    # E d(X, y) - E d(X, X') / 2 with d(i, j) = [i != j], over all pairs of classes
+    num_classes = prob.shape[1]
+    distance = 1 - np.eye(num_classes)
+    skill = (prob * distance[target]).sum(1)
+    spread = np.einsum('ni,ij,nj->n', prob, distance, prob)
+    return skill - 0.5 * spread
+
+
+def compare(device):
+    rng = np.random.RandomState(0)
+    ok = True
+    observations = rng.rand(500, 3)
+    forecasts = rng.rand(500, 7, 3)
+    expected = properscoring.crps_ensemble(observations, forecasts, axis=1)
+    for dtype in (torch.float32, torch.float64):
+        result = crps_ensemble(torch.from_numpy(observations), torch.from_numpy(forecasts).to(device, dtype),
+                               dim=1, chunk_size=128)
+        ok &= report('ensemble, middle dim, {}'.format(dtype), result.cpu(), expected,
+                     1e-5 if dtype == torch.float32 else 1e-12)
+    forecasts = rng.rand(500, 3, 5)
+    ok &= report('ensemble, last dim', crps_ensemble(observations, torch.from_numpy(forecasts).to(device)).cpu(),
+                 properscoring.crps_ensemble(observations, forecasts), 1e-5)
+    forecasts = rng.rand(500, 3)
+    ok &= report('deterministic', crps_ensemble(observations, torch.from_numpy(forecasts).to(device)).cpu(),
+                 properscoring.crps_ensemble(observations, forecasts), 1e-5)
+
+    prob = rng.dirichlet(np.ones(20), size=1000)
+    target = rng.randint(0, 20, size=1000)
+    target[:100] = 255
+    result = categorical_crps(torch.from_numpy(prob).to(device), torch.from_numpy(target))
+    ok &= report('categorical', result.cpu(), categorical_reference(prob[100:], target[100:]), 1e-5)
+    return ok
+
+
+def benchmark(args, device):
+    rng = np.random.RandomState(1)
+    observations = rng.rand(args.num_voxels).astype(np.float32)
+    forecasts = rng.rand(args.num_voxels, args.num_members).astype(np.float32)
+    start = time.perf_counter()
+    properscoring.crps_ensemble(observations, forecasts)
+    reference = time.perf_counter() - start
+
+    observations_t = torch.from_numpy(observations).to(device)
+    forecasts_t = torch.from_numpy(forecasts).to(device)
+    crps_ensemble(observations_t, forecasts_t, chunk_size=args.chunk_size)
+    start = time.perf_counter()
+    crps_ensemble(observations_t, forecasts_t, chunk_size=args.chunk_size)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    print('  properscoring {:8.1f} ms, torch {:8.1f} ms ({:.1f}x), {} threads'.format(
+        reference * 1000, elapsed * 1000, reference / elapsed, torch.get_num_threads()))
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    if properscoring is None:
+        sys.exit('properscoring is not installed, pip install properscoring')
+
+    print('{} CRPS against properscoring'.format(device.type))
+    ok = compare(device)
+    print('{} observations of {} members'.format(args.num_voxels, args.num_members))
+    benchmark(args, device)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
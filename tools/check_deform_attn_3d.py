@@ -0,0 +1,120 @@
+"""Check the deform3dattn_custom_cn kernels against the pure pytorch grid_sample reference.
+
+Forward outputs and the gradients of the values, sampling locations and
+attention weights are compared on random inputs, then the kernels are run
+through torch.autograd.gradcheck in double precision. Sampling locations
+spill a little outside [0, 1] to cover the borders of the volumes.
+
+    python tools/check_deform_attn_3d.py --device cpu
+    python tools/check_deform_attn_3d.py --device cpu --benchmark   # 128x128x16 self attention
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.modules.multi_scale_deformable_attn_3D_custom_function import (  # noqa: E402
+    MultiScaleDeformableAttn3DCustomFunction_fp32, ext_module, multi_scale_deformable_attn_3d_pytorch)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the 3D deformable attention kernels')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='also time forward and backward on the stage-2 volume')
+    parser.add_argument('--num-queries', type=int, default=128 * 128 * 16)
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+def random_inputs(spatial_shapes, bs, num_queries, num_heads, channels, num_points, dtype, device, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long)
+    level_start_index = torch.cat((spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1]))
+    num_keys = int(spatial_shapes.prod(1).sum())
+    num_levels = spatial_shapes.size(0)
+    value = torch.rand(bs, num_keys, num_heads, channels, generator=g, dtype=dtype)
+    sampling_locations = torch.rand(bs, num_queries, num_heads, num_levels, num_points, 3,
+                                    generator=g, dtype=dtype) * 1.2 - 0.1
+    attention_weights = torch.rand(bs, num_queries, num_heads, num_levels, num_points, generator=g, dtype=dtype)
+    attention_weights = attention_weights / attention_weights.sum((-1, -2), keepdim=True)
+    return [t.to(device) for t in (value, spatial_shapes, level_start_index, sampling_locations, attention_weights)]
+
+
+def kernel(value, spatial_shapes, level_start_index, sampling_locations, attention_weights):
+    return MultiScaleDeformableAttn3DCustomFunction_fp32.apply(
+        value, spatial_shapes, level_start_index, sampling_locations, attention_weights, 64)
+
+
+def reference(value, spatial_shapes, level_start_index, sampling_locations, attention_weights):
+    return multi_scale_deformable_attn_3d_pytorch(value, spatial_shapes, sampling_locations, attention_weights)
+
+
+def forward_backward(fn, inputs, grad_output):
+    inputs = [t.detach().clone().requires_grad_(t.is_floating_point()) for t in inputs]
+    output = fn(*inputs)
+    output.backward(grad_output)
+    value, _, _, sampling_locations, attention_weights = inputs
+    return output.detach(), value.grad, sampling_locations.grad, attention_weights.grad
+
+
+def compare(device, dtype):
+    inputs = random_inputs([[6, 5, 4], [3, 3, 2]], bs=2, num_queries=30, num_heads=2, channels=8,
+                           num_points=4, dtype=dtype, device=device)
+    grad_output = torch.rand(2, 30, 16, dtype=dtype, generator=torch.Generator().manual_seed(1)).to(device)
+    results = forward_backward(kernel, inputs, grad_output)
+    expected = forward_backward(reference, inputs, grad_output)
+    ok = True
+    for name, a, b in zip(['output', 'grad value', 'grad sampling loc', 'grad attn weight'], results, expected):
+        diff = (a - b).abs().max().item()
+        tol = 1e-4 if dtype == torch.float32 else 1e-10
+        ok &= diff < tol
+        print('  {:<20s} max abs diff {:.3e} {}'.format(name, diff, 'ok' if diff < tol else 'MISMATCH'))
+    return ok
+
+
+def benchmark(args, device):
+    inputs = random_inputs([[128, 128, 16]], bs=2, num_queries=args.num_queries, num_heads=8, channels=16,
+                           num_points=8, dtype=torch.float32, device=device)
+    grad_output = torch.rand(2, args.num_queries, 128, device=device)
+    for name, fn in [('kernel', kernel), ('grid_sample', reference)]:
+        forward_backward(fn, inputs, grad_output)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            forward_backward(fn, inputs, grad_output)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('  {:<12s} {:8.1f} ms forward + backward, {} threads'.format(
+            name, (time.perf_counter() - start) / args.repeat * 1000, torch.get_num_threads()))
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    if ext_module is None:
+        sys.exit('deform3dattn_custom_cn is not built, see deform_attn_3d/setup.py')
+
+    ok = True
+    for dtype in (torch.float32, torch.float64):
+        print('{} kernels against grid_sample, {}'.format(device.type, dtype))
+        ok &= compare(device, dtype)
+
+    inputs = random_inputs([[4, 3, 3], [2, 2, 2]], bs=1, num_queries=5, num_heads=2, channels=3,
+                           num_points=2, dtype=torch.float64, device=device)
+    for t in inputs:
+        t.requires_grad_(t.is_floating_point())
+    gradcheck = torch.autograd.gradcheck(kernel, inputs, eps=1e-6, atol=1e-5, raise_exception=False)
+    print('gradcheck {}'.format('ok' if gradcheck else 'FAILED'))
+    ok &= gradcheck
+
+    if args.benchmark:
+        print('{} queries sampling a 128x128x16 volume'.format(args.num_queries))
+        benchmark(args, device)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Check the fused scal losses against the per-class loops and time both.
+
+sem_scal_loss and geo_scal_loss are compared with their former per-class
+implementations, values and gradients of the logits, on random logits and
+labels with unknown voxels and absent classes. A batch without any known
+voxel must give zero losses and gradients. The timing covers forward and
+backward of both losses on the stage-2 output.
+
+    python tools/check_scal_loss.py
+    python tools/check_scal_loss.py --device cuda --shape 256 256 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.utils.ssc_loss import (  # noqa: E402
+    _geo_scal_loss_loop, _sem_scal_loss_loop, scal_losses)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the fused scal losses')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 16],
+                        help='voxel grid of the timed output')
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+def random_inputs(shape, device, n_classes=20, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    pred = torch.randn(2, n_classes, *shape, generator=g) * 3
+    target = torch.randint(0, n_classes, (2, *shape), generator=g)
+    target[target == 7] = 0  # an absent class
+    target[torch.rand(2, *shape, generator=g) < 0.3] = 255
+    return pred.to(device), target.to(torch.uint8).to(device)
+
+
+def reference(pred, target):
+    return _sem_scal_loss_loop(pred, target), _geo_scal_loss_loop(pred, target)
+
+
+def fused(pred, target):
+    return scal_losses(pred, target)
+
+
+def forward_backward(fn, pred, target):
+    pred = pred.detach().clone().requires_grad_()
+    losses = fn(pred, target)
+    sum(losses).backward()
+    return [loss.detach() for loss in losses] + [pred.grad]
+
+
+def compare(device):
+    pred, target = random_inputs((16, 16, 8), device)
+    ok = True
+    for name, a, b in zip(['sem_scal_loss', 'geo_scal_loss', 'grad of the logits'],
+                          forward_backward(fused, pred, target), forward_backward(reference, pred, target)):
+        diff = (a - b).abs().max().item()
+        tol = 1e-5 * max(b.abs().max().item(), 1)
+        ok &= diff < tol
+        print('  {:<20s} max abs diff {:.3e} {}'.format(name, diff, 'ok' if diff < tol else 'MISMATCH'))
+
+    target = torch.full_like(target, 255)
+    empty = all(bool((value == 0).all()) for value in forward_backward(fused, pred, target))
+    ok &= empty
+    print('  {:<20s} {}'.format('no known voxel', 'ok' if empty else 'NOT ZERO'))
+    return ok
+
+
+def benchmark(args, device):
+    pred, target = random_inputs(args.shape, device)
+    for name, fn in [('fused', fused), ('per-class', reference)]:
+        forward_backward(fn, pred, target)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            forward_backward(fn, pred, target)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        memory = ', peak {:.0f} MB'.format(torch.cuda.max_memory_allocated() / 2 ** 20) \
+            if device.type == 'cuda' else ''
+        print('  {:<10s} {:8.1f} ms forward + backward{}'.format(
+            name, (time.perf_counter() - start) / args.repeat * 1000, memory))
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    print('{} fused scal losses against the per-class loops'.format(device.type))
+    ok = compare(device)
+    print('2 x 20 x {} logits'.format('x'.join(map(str, args.shape))))
+    benchmark(args, device)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Test a deep ensemble of VoxFormer checkpoints in a single pass over the data.
+
+Every batch is loaded and moved to the GPU once, then run through each member
+in turn. Their softmax probabilities are folded into running per-voxel sums,
+so no per-member output is ever written. The summary of every frame goes to
+one FrameStore under ``--out`` with the flattened 256x256x32 fields:
+
+- ``pred`` (uint8): class of the mean probabilities,
+- ``prob``, ``variance`` (float16): mean and member variance of its probability,
+- ``entropy``, ``mutual_info`` (float16): predictive entropy and its model part.
+
+All members share the config, e.g. the ``toexe/voxformer-S-ensemble_*``
+configs only differ in their work_dir.
+
+    python tools/ensemble_test.py projects/configs/voxformer/voxformer-S.py \\
+        result/voxformer-S-ensemble_{1..10}/latest.pth --out ./ensemble_S --eval
+    python -m torch.distributed.launch --nproc_per_node=4 tools/ensemble_test.py \\
+        projects/configs/voxformer/voxformer-S.py result/voxformer-S-ensemble_{1..10}/latest.pth \\
+        --out ./ensemble_S --launcher pytorch
+"""
+import argparse
+import importlib
+import math
+import os
+import sys
+
+import mmcv
+import torch
+from mmcv import Config, DictAction
+from mmcv.parallel import scatter
+from mmcv.runner import get_dist_info, init_dist, load_checkpoint
+from mmdet3d.datasets import build_dataset
+from mmdet3d.models import build_model
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.datasets.builder import build_dataloader  # noqa: E402
+from projects.mmdet3d_plugin.voxformer.utils.predictive_stats import (  # noqa: E402
+    PredictiveStats, open_summary_store, write_summary)
+from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics  # noqa: E402
+from projects.mmdet3d_plugin.voxformer.utils.uq_metric import UQMetrics, print_uq_stats  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Test a VoxFormer ensemble in one data pass')
+    parser.add_argument('config', help='test config shared by the members')
+    parser.add_argument('checkpoints', nargs='+', help='checkpoints of the members')
+    parser.add_argument('--out', help='FrameStore root the per-voxel summaries are written to')
+    parser.add_argument('--eval', action='store_true',
+                        help='evaluate the mean probabilities on the fly, SSC and uncertainty metrics')
+    parser.add_argument('--samples-per-gpu', type=int, default=1)
+    parser.add_argument('--cfg-options', nargs='+', action=DictAction,
+                        help='override some settings in the used config')
+    parser.add_argument('--launcher', choices=['none', 'pytorch', 'slurm', 'mpi'], default='none')
+    parser.add_argument('--local_rank', type=int, default=0)
+    args = parser.parse_args()
+    if 'LOCAL_RANK' not in os.environ:
+        os.environ['LOCAL_RANK'] = str(args.local_rank)
+    if not args.out and not args.eval:
+        parser.error('specify at least one of --out and --eval')
+    return args
+
+
+def build_members(cfg, checkpoints, device, samples_per_gpu=1):
+    # the head outputs softmax probabilities, tiled or not as configured
+    header_cfg = dict(cfg.model.pts_bbox_head.get('header_cfg') or {})
+    header_cfg['output'] = 'prob'
+    cfg.model.pts_bbox_head.header_cfg = header_cfg
+    cfg.model.pretrained = None
+    cfg.model.train_cfg = None
+    members = []
+    for path in checkpoints:
+        model = build_model(cfg.model, test_cfg=cfg.get('test_cfg'))
+        load_checkpoint(model, path, map_location='cpu')
+        members.append(model.to(device).eval())
+
+    # the members share one proposal provider, whose cache holds a batch and serves every
+    # member after the first, so the QPN volumes of a frame are loaded and fused once
+    provider = members[0].pts_bbox_head.ensemble_proposal
+    if provider is not None:
+        provider.cache_size = max(provider.cache_size, samples_per_gpu)
+        for model in members[1:]:
+            model.pts_bbox_head.ensemble_proposal = provider
+    return members
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    if cfg.get('plugin', False):
+        importlib.import_module(os.path.dirname(cfg.plugin_dir).replace('/', '.'))
+
+    distributed = args.launcher != 'none'
+    if distributed:
+        init_dist(args.launcher, **cfg.dist_params)
+    rank, world_size = get_dist_info()
+    device = torch.device('cuda', torch.cuda.current_device())
+
+    cfg.data.test.test_mode = True
+    cfg.data.test.pop('samples_per_gpu', None)
+    dataset = build_dataset(cfg.data.test)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu=args.samples_per_gpu,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=distributed,
+        shuffle=False,
+        nonshuffler_sampler=cfg.data.nonshuffler_sampler)
+    members = build_members(cfg, args.checkpoints, device, args.samples_per_gpu)
+
+    store = None
+    if args.out:
+        store = open_summary_store(args.out, attrs=dict(config=args.config, checkpoints=args.checkpoints),
+                                   rank=rank)
+    metrics = SSCMetrics(dataset.metrics.n_classes) if args.eval else None
+    uq_metrics = UQMetrics(dataset.metrics.n_classes) if args.eval else None
+
+    # the sampler pads the last rank with samples from the start of the dataset,
+    # each rank handling a contiguous chunk, so padded samples have positions >= len(dataset)
+    position = rank * int(math.ceil(len(dataset) / world_size))
+    if rank == 0:
+        prog_bar = mmcv.ProgressBar(len(dataset))
+    for data in data_loader:
+        data = scatter(data, [device.index])[0]
+        with torch.no_grad():
+            # images and targets are normalized once for all members
+            img, target = members[0].normalize_inputs(data['img'], data['target'])
+            stats = PredictiveStats()
+            for model in members:
+                img_metas, outs = model.forward_ssc(data['img_metas'], img, target)
+                stats.update(outs['ssc_prob'])
+            summary = stats.summary()
+
+        batch_size = len(img_metas)
+        num_valid = max(min(batch_size, len(dataset) - position), 0)
+        position += batch_size
+        if metrics is not None and num_valid > 0:
+            metrics.add_batch(summary['pred'][:num_valid], target[:num_valid])
+            uq_metrics.add_batch(stats.mean()[:num_valid], target[:num_valid])
+        if store is not None:
+            write_summary(store, img_metas, summary, num_valid)
+        if rank == 0:
+            for _ in range(batch_size * world_size):
+                prog_bar.update()
+
+    if metrics is not None:
+        metrics.all_reduce()
+        uq_metrics.all_reduce()
+        if rank == 0:
+            stats = metrics.get_stats()
+            print('\n{} members'.format(len(members)))
+            for class_name, iou in zip(dataset.class_names, stats['iou_ssc']):
+                print('{:>16s} {:.4f}'.format(class_name, iou))
+            print('mIoU {:.4f} IoU {:.4f} Precision {:.4f} Recall {:.4f}'.format(
+                stats['iou_ssc_mean'], stats['iou'], stats['precision'], stats['recall']))
+            print_uq_stats(uq_metrics.get_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Evaluate, calibrate and ensemble cached class scores without running the model.
+
+A cache is written once by ``tools/test.py --logit-cache``. Several caches
+are the members of an ensemble, combined per voxel by averaging their
+probabilities, or their logits with ``--combine logit``. Temperature scaling
+divides the logits of every member by the same temperature, which
+``--fit-temperature`` fits by minimizing the NLL of the combined
+distribution on a random subset of the labeled voxels. Scores are decoded
+from the memory-mapped records ``--chunk-size`` voxels at a time.
+
+    python tools/test.py projects/configs/voxformer/voxformer-S.py ckpt.pth --logit-cache ./logits_S
+    python tools/logit_cache_eval.py ./logits_S --fit-temperature
+    python tools/logit_cache_eval.py ./logits_S_{1..5} --combine logit --temperature 1.3 --device cuda
+"""
+import argparse
+import math
+import os
+import sys
+
+import mmcv
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.voxformer.utils.logit_cache import LogitStore  # noqa: E402
+from projects.mmdet3d_plugin.voxformer.utils.ssc_metric import SSCMetrics  # noqa: E402
+from projects.mmdet3d_plugin.voxformer.utils.uq_metric import UQMetrics, print_uq_stats  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Evaluate cached class scores')
+    parser.add_argument('caches', nargs='+', help='LogitStore roots, the members of an ensemble')
+    parser.add_argument('--combine', choices=['prob', 'logit'], default='prob',
+                        help='average the member probabilities or logits')
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--fit-temperature', action='store_true',
+                        help='fit the temperature before evaluating')
+    parser.add_argument('--fit-voxels', type=int, default=1000000,
+                        help='labeled voxels sampled over all frames to fit the temperature')
+    parser.add_argument('--n-bins', type=int, default=15, help='confidence bins of the ECE')
+    parser.add_argument('--chunk-size', type=int, default=1 << 20, help='voxels decoded at once')
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def open_caches(paths):
+    stores = [LogitStore(path) for path in paths]
+    for store in stores[1:]:
+        if (store.num_classes, store.shape) != (stores[0].num_classes, stores[0].shape):
+            raise ValueError('{} does not hold the classes and grid of {}'.format(store.root, stores[0].root))
+    frames = set(stores[0].frames())
+    for store in stores[1:]:
+        frames &= set(store.frames())
+    if any(len(store.frames()) != len(frames) for store in stores):
+        print('{} frames are in every cache, the others are skipped'.format(len(frames)))
+    return stores, sorted(frames)
+
+
+def combine(log_probs, temperature, mode):
+    """Log-probabilities of the members [M, C, n] combined into [C, n]."""
+    if mode == 'logit':
+        return torch.log_softmax(log_probs.mean(0) / temperature, 0)
+    return torch.logsumexp(torch.log_softmax(log_probs / temperature, 1), 0) - math.log(log_probs.size(0))
+
+
+def sample_voxels(stores, frames, num_voxels, device, seed=0):
+    rng = np.random.RandomState(seed)
+    per_frame = int(math.ceil(num_voxels / len(frames)))
+    log_probs, targets = [], []
+    for sequence_id, frame_id in frames:
+        records = [store.load(sequence_id, frame_id) for store in stores]
+        target = np.asarray(records[0]['target'])
+        labeled = np.flatnonzero(target != 255)
+        index = np.sort(rng.choice(labeled, min(per_frame, labeled.size), replace=False))
+        log_probs.append(torch.stack([
+            store.decode(record['logit'][:, index], device)
+            for store, record in zip(stores, records)]))
+        targets.append(torch.from_numpy(target[index]).to(device))
+    return torch.cat(log_probs, 2), torch.cat(targets).long()
+
+
+def fit_temperature(stores, frames, args, device):
+    log_probs, target = sample_voxels(stores, frames, args.fit_voxels, device)
+    log_t = torch.zeros(1, device=device, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=100, line_search_fn='strong_wolfe')
+
+    def nll():
+        optimizer.zero_grad()
+        loss = -combine(log_probs, log_t.exp(), args.combine).gather(0, target.unsqueeze(0)).mean()
+        loss.backward()
+        return loss
+
+    before = nll().item()
+    optimizer.step(nll)
+    temperature = log_t.exp().item()
+    print('temperature {:.4f} fitted on {} voxels, NLL {:.4f} -> {:.4f}'.format(
+        temperature, target.numel(), before, nll().item()))
+    return temperature
+
+
+def evaluate(stores, frames, temperature, args, device):
+    num_classes = stores[0].num_classes
+    num_voxels = int(np.prod(stores[0].shape))
+    metrics = SSCMetrics(num_classes)
+    uq_metrics = UQMetrics(num_classes, n_bins=args.n_bins)
+    prog_bar = mmcv.ProgressBar(len(frames))
+    for sequence_id, frame_id in frames:
+        records = [store.load(sequence_id, frame_id) for store in stores]
+        for start in range(0, num_voxels, args.chunk_size):
+            stop = min(start + args.chunk_size, num_voxels)
+            log_probs = torch.stack([
+                store.log_prob(record, start, stop, device) for store, record in zip(stores, records)])
+            target = stores[0].target(records[0], start, stop, device)
+            prob = combine(log_probs, temperature, args.combine).exp()
+            metrics.add_batch(prob.argmax(0), target)
+            uq_metrics.add_batch(prob.unsqueeze(0), target.unsqueeze(0))
+        prog_bar.update()
+    return metrics.get_stats(), uq_metrics.get_stats()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    stores, frames = open_caches(args.caches)
+    if not frames:
+        sys.exit('no frame in common to the caches')
+
+    temperature = args.temperature
+    if args.fit_temperature:
+        temperature = fit_temperature(stores, frames, args, device)
+    with torch.no_grad():
+        stats, uq_stats = evaluate(stores, frames, temperature, args, device)
+
+    print('\n{} frames, {} members, temperature {:.4f}'.format(len(frames), len(stores), temperature))
+    for i, iou in enumerate(stats['iou_ssc']):
+        print('{:>16d} {:.4f}'.format(i, iou))
+    print('mIoU {:.4f} IoU {:.4f} Precision {:.4f} Recall {:.4f}'.format(
+        stats['iou_ssc_mean'], stats['iou'], stats['precision'], stats['recall']))
+    print_uq_stats(uq_stats)
+
+
+if __name__ == '__main__':
+    main()
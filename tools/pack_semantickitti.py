@@ -0,0 +1,109 @@
+"""Pack SemanticKITTI sequences into memory-mapped shards for stage-2.
+
+Every sequence becomes one ``<out>/<sequence>.bin`` file with an offset index
+``<out>/<sequence>.json`` holding:
+
+- the cropped uint8 RGB images of the key frames and their temporal frames,
+- the full-scale labels ``<sequence>/<frame>_1_1.npy`` or ``<sequence>.npz`` as uint8,
+- the bit-packed query proposals, as produced by stage-1.
+
+Set ``shard_root`` of SemanticKittiDatasetStage2 to ``<out>`` to train or
+test from the shards.
+
+    python tools/pack_semantickitti.py --data-root ./kitti --out ./kitti/dataset/shards \
+        --split train val --temporal -12 -9 -6 -3
+"""
+import argparse
+import glob
+import os
+import sys
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projects.mmdet3d_plugin.datasets.semantic_kitti_label import SemanticKittiLabels  # noqa: E402
+from projects.mmdet3d_plugin.datasets.semantic_kitti_shard import write_shard  # noqa: E402
+
+SPLITS = {
+    "train": ["00", "01", "02", "03", "04", "05", "06", "07", "09", "10"],
+    "val": ["08"],
+    "test": ["11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack SemanticKITTI sequences into shards')
+    parser.add_argument('--data-root', default='./kitti')
+    parser.add_argument('--preprocess-root', help='root of the preprocessed labels, '
+                        'defaults to <data-root>/dataset')
+    parser.add_argument('--labels-tag', default='labels')
+    parser.add_argument('--out', required=True, help='folder of the packed sequences')
+    parser.add_argument('--split', nargs='+', default=['train', 'val'], choices=list(SPLITS))
+    parser.add_argument('--sequences', nargs='+', help='pack these sequences instead of the splits')
+    parser.add_argument('--depthmodel', default='msnet3d')
+    parser.add_argument('--nsweep', type=int, default=10)
+    parser.add_argument('--query-tag', default='query_iou5203_pre7712_rec6153')
+    parser.add_argument('--temporal', type=int, nargs='*', default=[],
+                        help='frame offsets of the temporal images to pack, as in the config')
+    parser.add_argument('--img-size', type=int, nargs=2, default=[370, 1220], metavar=('H', 'W'))
+    return parser.parse_args()
+
+
+def load_image(path, img_h, img_w):
+    img = np.array(Image.open(path).convert("RGB"), dtype=np.uint8)
+    return img[:img_h, :img_w, :].transpose(2, 0, 1)  # crop image, [3, H, W]
+
+
+def pack_sequence(args, sequence):
+    sequence_root = os.path.join(args.data_root, "dataset", "sequences", sequence)
+    query_root = os.path.join(
+        args.data_root, "dataset", "sequences_" + args.depthmodel + "_sweep" + str(args.nsweep),
+        sequence, "queries")
+    label_reader = SemanticKittiLabels(os.path.join(
+        args.preprocess_root or os.path.join(args.data_root, "dataset"), args.labels_tag))
+
+    proposal_paths = sorted(glob.glob(os.path.join(query_root, "*." + args.query_tag)))
+    frame_ids = [os.path.splitext(os.path.basename(path))[0] for path in proposal_paths]
+    seq_len = len(glob.glob(os.path.join(sequence_root, "image_2", "*.png")))
+
+    # images of the key frames and of their temporal frames, clamped as in the dataset
+    image_ids = set(frame_ids)
+    for frame_id in frame_ids:
+        for i in args.temporal:
+            id = int(frame_id)
+            if 0 <= id + i <= seq_len - 1:
+                image_ids.add(str(id + i).zfill(6))
+
+    images = [
+        (image_id, partial(load_image, os.path.join(sequence_root, "image_2", image_id + ".png"),
+                           *args.img_size))
+        for image_id in sorted(image_ids)
+    ]
+    labels = [
+        (frame_id, partial(label_reader.read, sequence, frame_id))
+        for frame_id in frame_ids
+        if label_reader.has_label(sequence, frame_id)
+    ]
+    proposals = [
+        (frame_id, partial(np.fromfile, path, dtype=np.uint8))
+        for frame_id, path in zip(frame_ids, proposal_paths)
+    ]
+    print('sequence {}: {} frames, {} images, {} labels'.format(
+        sequence, len(frame_ids), len(images), len(labels)))
+
+    write_shard(args.out, sequence, images, labels, proposals, attrs=dict(
+        query_tag=args.query_tag, depthmodel=args.depthmodel, nsweep=args.nsweep,
+        temporal=args.temporal, img_size=args.img_size))
+
+
+def main():
+    args = parse_args()
+    sequences = args.sequences or [seq for split in args.split for seq in SPLITS[split]]
+    for sequence in sequences:
+        pack_sequence(args, sequence)
+
+
+if __name__ == '__main__':
+    main()
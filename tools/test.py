@@ -15,12 +15,13 @@ from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
 from mmcv.runner import (get_dist_info, init_dist, load_checkpoint,
                          wrap_fp16_model)
 
-from mmdet3d.apis import single_gpu_test
 from mmdet3d.datasets import build_dataset
 from projects.mmdet3d_plugin.datasets.builder import build_dataloader
 from mmdet3d.models import build_model
 from mmdet.apis import set_random_seed
 from projects.mmdet3d_plugin.voxformer.apis.test import custom_multi_gpu_test
+from projects.mmdet3d_plugin.voxformer.utils.logit_cache import LogitStore
+from projects.mmdet3d_plugin.voxformer.utils.uq_metric import UQMetrics, print_uq_stats
 from mmdet.datasets import replace_ImageToTensor
 import time
 import os.path as osp
@@ -30,7 +31,11 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description='MMDet test (and eval) a model')
     parser.add_argument('config', help='test config file path')
-    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument(
+        'checkpoint',
+        nargs='?',
+        help='checkpoint file, optional for models loading their own weights '
+        'such as LMSCNet_SS_Ensemble')
     parser.add_argument('--out', help='output result file in pickle format')
     parser.add_argument(
         '--fuse-conv-bn',
@@ -49,9 +54,10 @@ def parse_args():
         nargs='+',
         help='evaluation metrics, which depends on the dataset, e.g., "bbox",'
         ' "segm", "proposal" for COCO, and "mAP", "recall" for PASCAL VOC')
-    parser.add_argument('--show', action='store_true', help='show results')
+    parser.add_argument('--show', action='store_true',
+                        help='not supported, the SSC results are not visualized')
     parser.add_argument(
-        '--show-dir', help='directory where results will be saved')
+        '--show-dir', help='not supported, the SSC results are not visualized')
     parser.add_argument(
         '--gpu-collect',
         action='store_true',
@@ -60,6 +66,36 @@ def parse_args():
         '--tmpdir',
         help='tmp directory used for collecting results from multiple '
         'workers, available when gpu-collect is not specified')
+    parser.add_argument(
+        '--streaming-eval',
+        action='store_true',
+        help='fold predictions into the metrics on the fly instead of '
+        'collecting the results of every frame, only valid with --eval')
+    parser.add_argument(
+        '--uq-eval',
+        action='store_true',
+        help='accumulate NLL, Brier score and ECE of the class probabilities '
+        'on the device and print them at the end')
+    parser.add_argument(
+        '--logit-cache',
+        help='LogitStore root the class scores and labels of every frame are '
+        'written to, see tools/logit_cache_eval.py')
+    parser.add_argument(
+        '--logit-cache-format',
+        choices=LogitStore.FORMATS,
+        default='float16',
+        help='float16 or 8-bit quantized log-probabilities')
+    parser.add_argument(
+        '--logit-cache-shape',
+        type=int,
+        nargs=3,
+        default=[256, 256, 32],
+        help='voxel grid of the outputs, 128 128 16 for the stage-1 QPN')
+    parser.add_argument(
+        '--samples-per-gpu',
+        type=int,
+        help='number of frames per forward, overrides the samples_per_gpu '
+        'of the test config')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
     parser.add_argument(
         '--deterministic',
@@ -111,15 +147,21 @@ def parse_args():
 def main():
     args = parse_args()
 
-    assert args.out or args.eval or args.format_only or args.show \
-        or args.show_dir, \
-        ('Please specify at least one operation (save/eval/format/show the '
-         'results / save the results) with the argument "--out", "--eval"'
-         ', "--format-only", "--show" or "--show-dir"')
+    if args.show or args.show_dir:
+        raise ValueError('--show and --show-dir are not supported by the SSC test')
+
+    assert args.out or args.eval or args.uq_eval or args.logit_cache or args.format_only, \
+        ('Please specify at least one operation (save/eval/format the '
+         'results) with the argument "--out", "--eval", "--uq-eval"'
+         ', "--logit-cache" or "--format-only"')
 
     if args.eval and args.format_only:
         raise ValueError('--eval and --format_only cannot be both specified')
 
+    if args.streaming_eval and (args.out or args.format_only or not args.eval):
+        raise ValueError('--streaming-eval only computes the metrics, use it '
+                         'with --eval and without --out or --format-only')
+
     if args.out is not None and not args.out.endswith(('.pkl', '.pickle')):
         raise ValueError('The output file must be a pkl file.')
 
@@ -177,6 +219,8 @@ def main():
         if samples_per_gpu > 1:
             for ds_cfg in cfg.data.test:
                 ds_cfg.pipeline = replace_ImageToTensor(ds_cfg.pipeline)
+    if args.samples_per_gpu is not None:
+        samples_per_gpu = args.samples_per_gpu
 
     # init distributed env first, since logger depends on the dist info.
     if args.launcher == 'none':
@@ -212,7 +256,9 @@ def main():
     fp16_cfg = cfg.get('fp16', None)
     if fp16_cfg is not None:
         wrap_fp16_model(model)
-    checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
+    checkpoint = {}
+    if args.checkpoint is not None:
+        checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
     if args.fuse_conv_bn:
         model = fuse_conv_bn(model)
     # old versions did not save class info in checkpoints, this walkaround is
@@ -228,17 +274,28 @@ def main():
         # segmentation dataset has `PALETTE` attribute
         model.PALETTE = dataset.PALETTE
 
+    uq_metrics = UQMetrics(dataset.metrics.n_classes) if args.uq_eval else None
+    logit_cache = None
+    if args.logit_cache:
+        logit_cache = LogitStore(args.logit_cache, fmt=args.logit_cache_format,
+                                 num_classes=dataset.metrics.n_classes, shape=args.logit_cache_shape,
+                                 attrs=dict(config=args.config, checkpoint=args.checkpoint),
+                                 rank=get_dist_info()[0])
     if not distributed:
         # assert False
         model = MMDataParallel(model, device_ids=[0])
-        outputs = single_gpu_test(model, data_loader, args.show, args.show_dir)
+        # single_gpu_test of mmdet3d expects detection results, the SSC results go through the custom test
+        outputs = custom_multi_gpu_test(model, data_loader, args.tmpdir,
+                                        args.gpu_collect, streaming=args.streaming_eval,
+                                        uq_metrics=uq_metrics, logit_cache=logit_cache)
     else:
         model = MMDistributedDataParallel(
             model.cuda(),
             device_ids=[torch.cuda.current_device()],
             broadcast_buffers=False)
         outputs = custom_multi_gpu_test(model, data_loader, args.tmpdir,
-                                        args.gpu_collect)
+                                        args.gpu_collect, streaming=args.streaming_eval,
+                                        uq_metrics=uq_metrics, logit_cache=logit_cache)
 
     rank, _ = get_dist_info()
     if rank == 0:
@@ -263,6 +320,8 @@ def main():
             eval_kwargs.update(dict(metric=args.eval, **kwargs))
 
             print(dataset.evaluate(outputs, **eval_kwargs))
+        if uq_metrics is not None:
+            print_uq_stats(uq_metrics.get_stats())
 
 
 if __name__ == '__main__':